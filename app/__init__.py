@@ -5,4 +5,7 @@ app = Flask(__name__)
 app.config.from_object('config.BaseConfiguration')
 db = SQLAlchemy(app)
 
-from app import api, models, constants
+from app import (api, models, constants, metrics, workers, writebehind,
+                 events, overview, timers,
+                 archive, housekeeping, stats, idempotency, ratelimit,
+                 store, shards)
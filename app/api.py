@@ -1,12 +1,23 @@
 """This module receives, processes, and responds to Slack requests."""
 
 from flask import request, jsonify
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 import random
 import os
 
 from app import app
-from models import *
 from constants import *
+from metrics import timing_render, command_type
+from workers import submit_command, channel_lock
+from board import render_board
+from solver import choose_move
+from idempotency import run_once, command_fingerprint
+from ratelimit import allow_command
+from archive import WIN, DRAW
+from stats import TEAM_SCOPE
+from store import get_store
+from shards import bind_team
 
 @app.route('/', methods=['GET'])
 def certificate_verification():
@@ -15,10 +26,28 @@ def certificate_verification():
 
 @app.route('/', methods=['POST'])
 def request_handler():
-    """Dispatches different commands to their respective handlers."""
+    """Dispatches different commands to their respective handlers.
+
+    A command that Slack delivers more than once is only handled once, and
+    its repeated deliveries get the first one's response. A command turned
+    away as busy, over its rate limit or while its team is being moved runs
+    again when it is delivered again.
+    """
+
     token = request.form['token']
     if token != os.environ['SLACK_TOKEN']:
         return UNAUTHORIZED_ERROR
+    return run_once(command_fingerprint(request.form, request.headers),
+                    handle_request,
+                    retry_on=(BUSY_ERROR, RATE_LIMITED_ERROR,
+                              TEAM_MOVING_ERROR))
+
+def handle_request():
+    """Handles an authorized command right away or in the background.
+
+    A command from a user or team over its rate limit is turned away before
+    the database is touched.
+    """
 
     team_id = request.form['team_id']
     channel_id = request.form['channel_id']
@@ -26,68 +55,148 @@ def request_handler():
     user_name = request.form['user_name']
     command = request.form['text']
 
+    if not allow_command(team_id, user_id, command_type(command)):
+        return RATE_LIMITED_ERROR
+
+    response_url = request.form.get('response_url')
+    if (app.config['ASYNC_RESPONSES'] and response_url and
+            is_database_command(command)):
+        if submit_command(response_url, dispatch_command, team_id,
+                          channel_id, command, team_id, channel_id, user_id,
+                          user_name, command, response_url):
+            return ('', 200)
+        return BUSY_ERROR
+
+    if is_database_command(command):
+        with channel_lock(team_id, channel_id):
+            return dispatch_command(team_id, channel_id, user_id, user_name,
+                                    command, response_url)
+    return dispatch_command(team_id, channel_id, user_id, user_name, command,
+                            response_url)
+
+def is_database_command(command):
+    """Returns whether a command has to go to the database to be answered."""
+    command_list = command.split(' ', 1)
+    return ((command_list[0] == "challenge" and len(command_list) == 2) or
+            command_list[0] == "accept" or
+            command in ("status", "stats") or
+            command in LEADERBOARD_COMMANDS or command in MOVES)
+
+def dispatch_command(team_id, channel_id, user_id, user_name, command,
+                     response_url=None):
+    """Runs a command and returns its response.
+
+    Args:
+        team_id: A string representing a Slack team's id
+        channel_id: A string representing a Slack channel's id
+        user_id: A string representing a Slack user's id
+        user_name: A string representing the user's name
+        command: A string representing the text typed after the slash command
+        response_url: A string representing the URL Slack gave the command,
+            kept on the games it starts or moves in for later messages
+
+    Returns:
+        The response of the command's handler. Commands that go to the
+        database run against their team's shard, and are turned away while
+        the team is being moved.
+    """
+
+    if is_database_command(command) and not bind_team(team_id):
+        return TEAM_MOVING_ERROR
     command_list = command.split(' ', 1)
 
     if command_list[0] == "challenge" and len(command_list) == 2:
         opponent = command_list[1]
         if opponent[0] == '@':
             opponent = opponent[1:]
-        return handle_challenge(team_id, channel_id, user_id, user_name, opponent)
-    elif command == "accept":
-        return handle_accept(team_id, channel_id, user_id, user_name)
+        return run_command(handle_challenge, team_id, channel_id, user_id,
+                           user_name, opponent, response_url)
+    elif command_list[0] == "accept":
+        challenger = None
+        if len(command_list) == 2:
+            challenger = command_list[1].strip()
+            if challenger.startswith('@'):
+                challenger = challenger[1:]
+            # Without a name, the latest challenge is accepted.
+            challenger = challenger or None
+        return run_command(handle_accept, team_id, channel_id, user_id,
+                           user_name, challenger, response_url)
     elif command == "help":
         return handle_help()
     elif command == "moves":
         return handle_get_moves()
     elif command == "status":
-        return handle_status(team_id, channel_id)
+        return run_command(handle_status, team_id, channel_id, user_id)
+    elif command == "stats":
+        return handle_stats(team_id, channel_id, user_id, user_name)
+    elif command in LEADERBOARD_COMMANDS:
+        return handle_leaderboard(team_id, channel_id,
+                                  command == "leaderboard team")
     elif command in MOVES:
         (x, y) = MOVES.get(command)
-        return handle_move(team_id, channel_id, user_id, user_name, x, y)
+        return run_command(handle_move, team_id, channel_id, user_id,
+                           user_name, x, y, response_url)
     else:
         return INVALID_COMMAND_ERROR
 
-def handle_challenge(team_id, channel_id, user_id, user_name, opponent_name):
-    """Initializes a new challenge.
+def run_command(handler, team_id, channel_id, user_id, *args):
+    """Runs a handler on a freshly loaded context, retrying on conflicts.
 
-    Creates a new team and a new channel if they are not in the database yet.
-    After that, the method generates a new challenge.
+    Games and challenges are versioned, so a command that read them before a
+    concurrent command changed them fails to commit rather than overwriting
+    the other command's changes. Such a command is rolled back and run again
+    on a reloaded context, where it sees the other command's result.
+    Concurrently created teams, channels and players conflict through their
+    unique indexes and are retried the same way.
 
     Args:
+        handler: A function taking a GameContext followed by args
         team_id: A string representing a Slack team's id
         channel_id: A string representing a Slack channel's id
-        user_id: A string representing a Slack user's id
+        user_id: A string representing a Slack user's id, or None
+        args: The remaining arguments of the handler
+
+    Returns:
+        The handler's response.
+    """
+
+    store = get_store()
+    for attempt in range(MAX_COMMAND_ATTEMPTS):
+        context = store.load(team_id, channel_id, user_id)
+        try:
+            return handler(context, *args)
+        except (StaleDataError, IntegrityError):
+            store.discard()
+            if attempt == MAX_COMMAND_ATTEMPTS - 1:
+                raise
+
+def handle_challenge(context, user_name, opponent_name, response_url=None):
+    """Initializes a new challenge.
+
+    The store adds the team, the channel and the user if they are new, along
+    with a challenge addressed to the opponent. Any number of games can be
+    played in a channel at once, but a user who is playing one has to finish
+    it first. Challenging the bot starts a game against it right away.
+
+    Args:
+        context: A GameContext object for the calling user
         user_name: A string representing the user's name
         opponent_name: A string representing the user being challenged
+        response_url: A string representing the URL Slack gave the command
 
     Returns:
         A JSON response containing the details of a challenge. If the
-        challenge fails because there is an ongoing game, the method returns
+        challenge fails because the user is playing a game, the method returns
         an error as a string.
     """
 
-    team = Team.query.filter_by(team_id=team_id).first()
-    if team == None:
-        team = Team(team_id)
-        db.session.add(team)
-
-    channel = team.channels.filter_by(channel_id=channel_id).first()
-    if channel == None:
-        channel = Channel(channel_id, team)
-        db.session.add(channel)
-    
-    most_recent_game = channel.games.order_by(Game.id.desc()).first()
-    if most_recent_game != None and not most_recent_game.finished:
-        return CANNOT_CHALLENGE_ERROR
-
-    curr_player = channel.players.filter_by(user_id=user_id).first()
-    if curr_player == None:
-        curr_player = Player(user_id, user_name, channel)
-        db.session.add(curr_player)
-    
-    challenge = Challenge(opponent_name, channel, curr_player)
-    db.session.add(challenge)
-    db.session.commit()
+    if context.active_game != None:
+        return ALREADY_PLAYING_ERROR
+
+    if opponent_name == BOT_NAME:
+        return start_bot_game(context, user_name, response_url)
+
+    get_store().create_challenge(context, user_name, opponent_name)
     resp_text = ("{0} has challenged {1} to a game of tic-tac-toe!\n"
                  "Type `/ttt accept` to start the game."
                  .format(user_name, opponent_name))
@@ -96,50 +205,45 @@ def handle_challenge(team_id, channel_id, user_id, user_name, opponent_name):
         "text": resp_text
     })
 
-def handle_accept(team_id, channel_id, user_id, user_name):
+def handle_accept(context, user_name, challenger_name=None,
+                  response_url=None):
     """Accepts a challenge.
 
-    Creates a new game if the user accepting is the one specified by the 
-    most recent challenge.
+    Creates a new game from the most recent challenge addressed to the user
+    that is younger than CHALLENGE_TTL, or from the most recent one made by
+    challenger_name if it is given. Neither player may be playing another
+    game in the channel.
 
     Args:
-        team_id: A string representing a Slack team's id
-        channel_id: A string representing a Slack channel's id
-        user_id: A string representing a Slack user's id
+        context: A GameContext object for the calling user
         user_name: A string representing the user's name
+        challenger_name: A string representing the user whose challenge to
+            accept, or None for the most recent challenge
+        response_url: A string representing the URL Slack gave the command
 
     Returns:
         A JSON response announcing the start of the game. If the accept
-        command fails because nobody challenged the player, the method returns
-        an error as a string.
+        command fails because nobody challenged the player or one of the
+        players is busy, the method returns an error as a string.
     """
 
-    team = Team.query.filter_by(team_id=team_id).first()
-    if team == None:
-        return NO_CHALLENGE_ERROR
-
-    channel = team.channels.filter_by(channel_id=channel_id).first()
-    if channel == None:
+    if context.channel == None:
         return NO_CHALLENGE_ERROR
+    if context.active_game != None:
+        return ALREADY_PLAYING_ERROR
 
-    challenges = channel.challenges
-    most_recent_challenge = challenges.order_by(Challenge.id.desc()).first()
-    if (most_recent_challenge == None or 
-            most_recent_challenge.expired or 
-            most_recent_challenge.opponent_name != user_name):
+    store = get_store()
+    challenge = store.find_challenge(context, user_name, challenger_name)
+    if challenge == None:
         return NO_CHALLENGE_ERROR
 
-    most_recent_challenge.expired = True
-    challenger = most_recent_challenge.challenger
-    curr_player = channel.players.filter_by(user_id=user_id).first()
-    if curr_player == None:
-        curr_player = Player(user_id, user_name, channel)
-        db.session.add(curr_player)
+    challenger = challenge.challenger
+    if store.is_busy(challenger):
+        return OPPONENT_BUSY_ERROR.format(challenger.user_name)
 
     starter = random.choice([user_name, challenger.user_name])
-    game = Game(BOARD_SIZE, starter, channel, challenger, curr_player)
-    db.session.add(game)
-    db.session.commit()
+    game = store.create_game(context, user_name, starter, challenge,
+                             response_url)
     curr_board = get_current_board(game)
     resp_text = ("{0} {1} has accepted the challenge!\n{2} has Xs and {1} has "
                  "Os, {3} has the first turn, good luck!\nHint: `/ttt moves` "
@@ -150,12 +254,56 @@ def handle_accept(team_id, channel_id, user_id, user_name):
         "text": resp_text
     })
 
+def start_bot_game(context, user_name, response_url=None):
+    """Starts a game between a user and the bot.
+
+    The bot joins the channel as a player the first time it is challenged
+    there. If the bot has the first turn, it makes its move right away.
+
+    Args:
+        context: A GameContext object for the calling user
+        user_name: A string representing the user's name
+        response_url: A string representing the URL Slack gave the command
+
+    Returns:
+        A JSON response announcing the start of the game.
+    """
+
+    store = get_store()
+    starter = random.choice([user_name, BOT_NAME])
+    game = store.create_game(context, user_name, starter,
+                             response_url=response_url)
+
+    resp_text = ("{0} has challenged the bot!\n{0} has Xs and {1} has Os, "
+                 "{2} has the first turn, good luck!"
+                 .format(user_name, BOT_NAME, starter))
+    if starter == BOT_NAME:
+        (x, y) = choose_move(game, game.player2)
+        resp_text += "\n" + make_move(game, game.player2, x, y,
+                                       response_url)
+    curr_board = get_current_board(game)
+    if starter == BOT_NAME:
+        store.save()
+    return jsonify({
+        "response_type": "in_channel",
+        "text": "{0} {1}".format(curr_board, resp_text)
+    })
+
+def is_bot(player):
+    """Returns whether a player is the built-in bot."""
+    return player.user_id == BOT_USER_ID
+
 def handle_help():
     """Returns a list of basic commands."""
     resp_text = ("Play tic-tac-toe in Slack! Here are some basic commands:\n"
                  "`/ttt challenge [someone]` to challenge them to a game\n"
-                 "`/ttt accept` to accept a challenge\n"
-                 "`/ttt status` to see the condition of the current game\n"
+                 "`/ttt challenge bot` to play against the computer\n"
+                 "`/ttt accept` to accept the latest challenge to you, or "
+                 "`/ttt accept [someone]` to accept theirs\n"
+                 "`/ttt status` to see the condition of your game\n"
+                 "`/ttt stats` to see your wins, losses and draws\n"
+                 "`/ttt leaderboard` to see the best players of the channel "
+                 "(`/ttt leaderboard team` for the whole team)\n"
                  "`/ttt moves` to see a list of available moves")
     return jsonify({
         "response_type": "ephemeral",
@@ -179,52 +327,131 @@ def handle_get_moves():
         "text": resp_text
     })
 
-def handle_status(team_id, channel_id):
-    """Returns the current game board and whose turn it is.
+def handle_status(context):
+    """Returns the user's game board and whose turn it is.
+
+    A user who is not playing gets a list of the games being played in the
+    channel instead.
 
     Args:
-        team_id: A string representing a Slack team's id
-        channel_id: A string representing a Slack channel's id
+        context: A GameContext object for the calling user
 
     Returns:
         A JSON response containing the current game board and the player who
-        holds the current turn. If there is no game happening, the method
-        returns an error as a string.
+        holds the current turn, or the list of games. If there is no game
+        happening, the method returns an error as a string.
     """
 
-    team = Team.query.filter_by(team_id=team_id).first()
-    if team == None:
-        return NO_ACTIVE_GAME_ERROR
+    game = context.active_game
+    if game == None:
+        return handle_channel_status(context)
 
-    channel = team.channels.filter_by(channel_id=channel_id).first()
-    if channel == None:
+    curr_board = get_current_board(game)
+    resp_text = ("{0} It's {1}'s turn right now."
+                .format(curr_board, game.current_player_name))
+    return jsonify({
+        "response_type": "ephemeral",
+        "text": resp_text
+    })
+
+def handle_channel_status(context):
+    """Returns the players of every game being played in the channel."""
+    if context.channel == None:
         return NO_ACTIVE_GAME_ERROR
 
-    most_recent_game = channel.games.order_by(Game.id.desc()).first()
-    if most_recent_game == None or most_recent_game.finished:
+    games = get_store().channel_games(context.channel)
+    if not games:
         return NO_ACTIVE_GAME_ERROR
 
-    curr_board = get_current_board(most_recent_game)
-    resp_text = ("{0} It's {1}'s turn right now."
-                .format(curr_board, most_recent_game.current_player_name))
+    lines = ["{0} vs {1}, it's {2}'s turn".format(
+        game.player1.user_name, game.player2.user_name,
+        game.current_player_name) for game in games]
+
+    return jsonify({
+        "response_type": "ephemeral",
+        "text": "Games in this channel:\n" + "\n".join(lines)
+    })
+
+def handle_stats(team_id, channel_id, user_id, user_name):
+    """Returns a user's record in the channel and in the team.
+
+    Args:
+        team_id: A string representing a Slack team's id
+        channel_id: A string representing a Slack channel's id
+        user_id: A string representing the user's id
+        user_name: A string representing the user's name
+
+    Returns:
+        A JSON response containing the user's wins, losses and draws. If the
+        user has not finished a game in the team, the method returns an error
+        as a string.
+    """
+
+    (channel_record, team_record) = get_store().player_stats(
+        team_id, channel_id, user_id)
+    if team_record == None:
+        return NO_RECORD_ERROR
+
+    resp_text = ("{0} has {1} in this channel and {2} in this team."
+                 .format(user_name, describe_record(channel_record),
+                         describe_record(team_record)))
     return jsonify({
         "response_type": "ephemeral",
         "text": resp_text
     })
 
-def handle_move(team_id, channel_id, user_id, user_name, x, y):
+def handle_leaderboard(team_id, channel_id, whole_team):
+    """Returns the best players of the channel or of the team.
+
+    Args:
+        team_id: A string representing a Slack team's id
+        channel_id: A string representing a Slack channel's id
+        whole_team: A boolean representing whether to rank the players of the
+            whole team rather than the channel
+
+    Returns:
+        A JSON response listing the players with the most wins. If no game
+        has been finished there yet, the method returns an error as a string.
+    """
+
+    records = get_store().leaderboard(
+        team_id, TEAM_SCOPE if whole_team else channel_id)
+    if not records:
+        return NO_LEADERBOARD_ERROR
+
+    lines = ["Leaderboard of this {0}:"
+             .format("team" if whole_team else "channel")]
+    for (rank, record) in enumerate(records, 1):
+        lines.append("{0}. {1} with {2}".format(
+            rank, record.user_name, describe_record(record)))
+    return jsonify({
+        "response_type": "ephemeral",
+        "text": "\n".join(lines)
+    })
+
+def describe_record(record):
+    """Returns a player's wins, losses and draws as a phrase."""
+    if record == None:
+        return "no finished games"
+    return "{0} {1}, {2} {3} and {4} {5}".format(
+        record.wins, "win" if record.wins == 1 else "wins",
+        record.losses, "loss" if record.losses == 1 else "losses",
+        record.draws, "draw" if record.draws == 1 else "draws")
+
+def handle_move(context, user_name, x, y, response_url=None):
     """Makes a move and returns the current state of the game.
 
     Adds a new piece to the board and analyzes if a player has won or if the 
-    game ended in a draw.
+    game ended in a draw. A game is a draw as soon as every line holds pieces
+    of both players, even if there are open squares left. In a game against
+    the bot, the bot answers with its own move in the same response.
 
     Args:
-        team_id: A string representing a Slack team's id
-        channel_id: A string representing a Slack channel's id
-        user_id: A string representing a Slack user's id
+        context: A GameContext object for the calling user
         user_name: A string representing the user's name
         x: An integer representing the x coordinate of the new piece
         y: An integer representing the y coordinate of the new piece
+        response_url: A string representing the URL Slack gave the command
 
     Returns:
         A JSON response containing the updated game board and the player with
@@ -233,100 +460,65 @@ def handle_move(team_id, channel_id, user_id, user_name, x, y):
         invalid, the method returns an error as a string.
     """
 
-    team = Team.query.filter_by(team_id=team_id).first()
-    if team == None:
+    if not context.is_playing():
         return NOT_IN_A_GAME_ERROR
 
-    channel = team.channels.filter_by(channel_id=channel_id).first()
-    if channel == None:
-        return NOT_IN_A_GAME_ERROR
-
-    curr_player = channel.players.filter_by(user_id=user_id).first()
-    most_recent_game = channel.games.order_by(Game.id.desc()).first()
-    if (most_recent_game == None or 
-            most_recent_game.finished or 
-            (most_recent_game.player1 != curr_player and 
-                most_recent_game.player2 != curr_player)):
-        return NOT_IN_A_GAME_ERROR
+    curr_player = context.player
+    most_recent_game = context.active_game
 
     if most_recent_game.current_player_name != user_name:
         return INCORRECT_TURN_ERROR
 
-    pieces = most_recent_game.pieces
-    if pieces.filter_by(x_coord=x, y_coord=y).count() > 0:
+    if most_recent_game.is_taken(x, y):
         return SQUARE_TAKEN_ERROR
 
-    new_piece = Piece(x, y, curr_player, most_recent_game)
-    db.session.add(new_piece)
-    
-    curr_player_pieces = pieces.filter_by(player=curr_player)
+    resp_text = make_move(most_recent_game, curr_player, x, y, response_url)
+    opponent = (most_recent_game.player1
+                if curr_player == most_recent_game.player2
+                else most_recent_game.player2)
+    if not most_recent_game.finished and is_bot(opponent):
+        (bot_x, bot_y) = choose_move(most_recent_game, opponent)
+        resp_text = make_move(most_recent_game, opponent, bot_x, bot_y,
+                              response_url)
+
     curr_board = get_current_board(most_recent_game)
-    if victory(curr_player_pieces):
-        most_recent_game.finished = True
-        resp_text = "{0} Game over! {1} has won the game :fire:".format(curr_board, user_name)
-    elif pieces.count() == BOARD_SIZE * BOARD_SIZE:
-        most_recent_game.finished = True
-        resp_text = "{0} The game ended in a draw!".format(curr_board)
-    else:
-        player1 = most_recent_game.player1
-        player2 = most_recent_game.player2
-        opponent = player1 if curr_player == player2 else player2
-        most_recent_game.current_player_name = opponent.user_name
-        resp_text = ("{0} {1} has made a move, now it's {2}'s turn."
-                    .format(curr_board, user_name, opponent.user_name))
-
-    db.session.commit()
+    get_store().save()
     return jsonify({
         "response_type": "in_channel",
-        "text": resp_text
+        "text": "{0} {1}".format(curr_board, resp_text)
     })
 
-def victory(pieces):
-    """Returns whether or not a player has attained victory.
+def make_move(game, player, x, y, response_url=None):
+    """Places a piece and advances the game.
 
-    Converts a list of pieces into a 2D array and analyzes that array to see
-    if the pieces are in a winning pattern.
+    The game is marked finished if the move wins it or leaves it a certain
+    draw; otherwise the turn passes to the other player. The store counts
+    the result of a finished game in its players' records and frees the
+    players to start other games.
 
     Args:
-        pieces: A list of Piece objects
+        game: The Game object the move is made in
+        player: The Player object making the move
+        x: An integer representing the x coordinate of the new piece
+        y: An integer representing the y coordinate of the new piece
+        response_url: A string representing the URL Slack gave the command
 
     Returns:
-        A boolean representing whether or not the pieces are in a winning
-        configuration.
+        A string describing the outcome of the move.
     """
 
-    board = [[0 for i in range(BOARD_SIZE)] for j in range(BOARD_SIZE)]
-    for piece in pieces:
-        x = piece.x_coord
-        y = piece.y_coord
-        board[x][y] = 1
-
-    diagonal1 = 0
-    diagonal2 = 0
-    for i in range(BOARD_SIZE):
-        horizontal = 0
-        vertical = 0
-        for j in range(BOARD_SIZE):
-            if board[i][j] == 1:
-                horizontal += 1
-            if board[j][i] == 1:
-                vertical += 1
-        if horizontal == BOARD_SIZE or vertical == BOARD_SIZE:
-            return True
-        if board[i][i] == 1:
-            diagonal1 += 1
-        if board[i][BOARD_SIZE - i - 1] == 1:
-            diagonal2 += 1
-    if diagonal1 == BOARD_SIZE or diagonal2 == BOARD_SIZE:
-        return True
-    return False
+    outcome = get_store().apply_move(game, player, x, y, response_url)
+    if outcome == WIN:
+        return "Game over! {0} has won the game :fire:".format(
+            player.user_name)
+    if outcome == DRAW:
+        return "The game ended in a draw!"
+    return ("{0} has made a move, now it's {1}'s turn."
+            .format(player.user_name, game.current_player_name))
 
 def get_current_board(game):
     """Gets the current game board and returns its string representation.
 
-    Converts the pieces of a game into a 2D array and converts that 2D array
-    into a string.
-
     Args:
         game: A Game object
 
@@ -334,31 +526,5 @@ def get_current_board(game):
         A string representing the game board.
     """
 
-    pieces = game.pieces
-    board_matrix = [[' ' for i in range(BOARD_SIZE)] for j in range(BOARD_SIZE)]
-    for piece in pieces:
-        x = piece.x_coord
-        y = piece.y_coord
-        if piece.player == game.player1:
-            board_matrix[x][y] = 'X'
-        else:
-            board_matrix[x][y] = 'O'
-
-    board_string = "```"
-    for i in range(BOARD_SIZE):
-        for j in range(BOARD_SIZE):
-            board_string += ' '
-            board_string += board_matrix[i][j]
-            board_string += ' '
-            if j != BOARD_SIZE - 1:
-                board_string += '|'
-        if i != BOARD_SIZE - 1:
-            board_string += '\n'
-            for k in range(BOARD_SIZE):
-                board_string += '---'
-                if k != BOARD_SIZE - 1:
-                    board_string += '+'
-            board_string += '\n'
-
-    board_string += "```"
-    return board_string
+    with timing_render():
+        return render_board(game.board_size, game.x_mask, game.o_mask)
@@ -0,0 +1,236 @@
+"""This module keeps finished games out of the tables commands work on.
+
+Housekeeping moves every finished game into the game_archive table, a single
+row per game, and deletes the game's rows from the game, piece, move_event
+and game_snapshot tables. The live tables then only hold the games being
+played, so their indexes stay small however many games a team finishes.
+
+An archived row keeps the final bitmasks, the result, the moves packed into
+a string and the Slack ids of the team, channel and players. History is read
+from that table alone, through history() or the /teams/<team_id>/history
+endpoint, and never touches the live tables.
+"""
+
+from datetime import datetime
+import os
+
+from flask import abort, jsonify, request
+
+from app import app, db
+from app.board import victory, all_lines_dead, board_full
+from app.constants import HISTORY_PAGE_SIZE, MAX_HISTORY_PAGE_SIZE
+from app.models import (ArchivedGame, Channel, Game, GameSnapshot, MoveEvent,
+                        Piece)
+from app.shards import bind_team
+
+WIN = "win"
+DRAW = "draw"
+FORFEIT = "forfeit"
+
+
+def pack_moves(cells, board_size):
+    """Packs a sequence of squares into a string.
+
+    Each square is written as its bit index in the same number of hexadecimal
+    digits, which is one digit per move on boards of up to 16 squares.
+
+    Args:
+        cells: A list of tuples (x, y) in the order they were played
+        board_size: An integer representing the width of the board
+
+    Returns:
+        A string of hexadecimal digits.
+    """
+
+    width = _move_width(board_size)
+    return "".join("%0*x" % (width, x * board_size + y) for (x, y) in cells)
+
+
+def unpack_moves(packed, board_size):
+    """Returns the list of squares (x, y) packed by pack_moves."""
+    width = _move_width(board_size)
+    return [divmod(int(packed[start:start + width], 16), board_size)
+            for start in range(0, len(packed or ""), width)]
+
+
+def _move_width(board_size):
+    return len("%x" % max(board_size * board_size - 1, 1))
+
+
+def game_result(game):
+    """Works out how a finished game ended.
+
+    A finished game without a winning line and with lines left to play was
+    ended by a forfeit, and its current player is the winner.
+
+    Returns:
+        A tuple (result, winner_name), where winner_name is None for a draw.
+    """
+
+    if victory(game.x_mask, game.board_size, game.win_length):
+        return (WIN, game.player1.user_name)
+    if victory(game.o_mask, game.board_size, game.win_length):
+        return (WIN, game.player2.user_name)
+    if (all_lines_dead(game.dead_lines, game.board_size, game.win_length) or
+            board_full(game.x_mask, game.o_mask, game.board_size)):
+        return (DRAW, None)
+    return (FORFEIT, game.current_player_name)
+
+
+def archive_games(game_ids):
+    """Moves finished games into the archive.
+
+    The games, their channels and players are read in one query and their
+    moves in another. Games that are not finished are left alone. The
+    changes are made in the session, not committed.
+
+    Args:
+        game_ids: A list of integers representing the ids of the games
+
+    Returns:
+        The number of games archived.
+    """
+
+    games = (Game.query
+             .options(db.joinedload(Game.channel).joinedload(Channel.team),
+                      db.joinedload(Game.player1),
+                      db.joinedload(Game.player2))
+             .filter(Game.id.in_(game_ids), Game.finished == True)
+             .all())
+    if not games:
+        return 0
+    ids = [game.id for game in games]
+
+    moves = dict((game_id, []) for game_id in ids)
+    times = {}
+    for (game_id, x, y, created_at) in (
+            db.session.query(MoveEvent.game_id, MoveEvent.x_coord,
+                             MoveEvent.y_coord, MoveEvent.created_at)
+            .filter(MoveEvent.game_id.in_(ids))
+            .order_by(MoveEvent.game_id, MoveEvent.sequence)):
+        moves[game_id].append((x, y))
+        if created_at != None:
+            first = times.get(game_id, (created_at, None))[0]
+            times[game_id] = (first, created_at)
+
+    # Games finished before the move log existed only have their pieces.
+    unlogged = [game_id for game_id in ids if not moves[game_id]]
+    if unlogged:
+        for (game_id, x, y) in (
+                db.session.query(Piece.game_id, Piece.x_coord, Piece.y_coord)
+                .filter(Piece.game_id.in_(unlogged))
+                .order_by(Piece.game_id, Piece.id)):
+            moves[game_id].append((x, y))
+
+    now = datetime.utcnow()
+    rows = []
+    for game in games:
+        (result, winner_name) = game_result(game)
+        (first_move_at, last_move_at) = times.get(game.id, (None, None))
+        rows.append({
+            "game_id": game.id,
+            "team_id": game.channel.team.team_id,
+            "channel_id": game.channel.channel_id,
+            "player1_user_id": game.player1.user_id,
+            "player1_name": game.player1.user_name,
+            "player2_user_id": game.player2.user_id,
+            "player2_name": game.player2.user_name,
+            "winner_name": winner_name,
+            "result": result,
+            "board_size": game.board_size,
+            "win_length": game.win_length,
+            "x_mask": game.x_mask,
+            "o_mask": game.o_mask,
+            "move_count": game.move_count,
+            "moves": pack_moves(moves[game.id], game.board_size),
+            "first_move_at": first_move_at,
+            "last_move_at": last_move_at,
+            "archived_at": now
+        })
+    db.session.execute(ArchivedGame.__table__.insert(), rows)
+
+    for model in (MoveEvent, GameSnapshot, Piece):
+        table = model.__table__
+        db.session.execute(table.delete().where(table.c.game_id.in_(ids)))
+    table = Game.__table__
+    db.session.execute(table.delete().where(table.c.id.in_(ids)))
+    for game in games:
+        db.session.expunge(game)
+    return len(ids)
+
+
+def history(team_id, channel_id=None, user_id=None, before=None,
+            limit=HISTORY_PAGE_SIZE):
+    """Returns a page of a team's finished games, newest first.
+
+    Only the archive is read. Pages are keyed by archive id, so the next page
+    starts before the id of the last game of this one.
+
+    Args:
+        team_id: A string representing a Slack team's id
+        channel_id: A string representing a Slack channel's id, to only
+            return the games played in that channel
+        user_id: A string representing a Slack user's id, to only return the
+            games that user played
+        before: An integer representing an archive id to return older games
+            than
+        limit: An integer representing the most games to return
+
+    Returns:
+        A list of dictionaries, one per game.
+    """
+
+    query = ArchivedGame.query.filter(ArchivedGame.team_id == team_id)
+    if channel_id != None:
+        query = query.filter(ArchivedGame.channel_id == channel_id)
+    if user_id != None:
+        query = query.filter(db.or_(ArchivedGame.player1_user_id == user_id,
+                                    ArchivedGame.player2_user_id == user_id))
+    if before != None:
+        query = query.filter(ArchivedGame.id < before)
+    games = query.order_by(ArchivedGame.id.desc()).limit(limit)
+    return [_describe(game) for game in games]
+
+
+def _describe(game):
+    return {
+        "id": game.id,
+        "game_id": game.game_id,
+        "channel_id": game.channel_id,
+        "player1": game.player1_name,
+        "player2": game.player2_name,
+        "result": game.result,
+        "winner": game.winner_name,
+        "board_size": game.board_size,
+        "win_length": game.win_length,
+        "move_count": game.move_count,
+        "moves": unpack_moves(game.moves, game.board_size),
+        "first_move_at": _isoformat(game.first_move_at),
+        "last_move_at": _isoformat(game.last_move_at),
+        "archived_at": _isoformat(game.archived_at)
+    }
+
+
+def _isoformat(value):
+    return value.isoformat() if value != None else None
+
+
+@app.route('/teams/<team_id>/history', methods=['GET'])
+def history_endpoint(team_id):
+    """Returns a page of a team's finished games as JSON.
+
+    The request has to carry the app's Slack token as its token parameter,
+    and may filter by channel_id or user_id and page with before and limit.
+    """
+
+    if request.args.get('token') != os.environ['SLACK_TOKEN']:
+        abort(403)
+    if not bind_team(team_id):
+        abort(503)
+    limit = min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int),
+                MAX_HISTORY_PAGE_SIZE)
+    games = history(team_id, request.args.get('channel_id'),
+                    request.args.get('user_id'),
+                    request.args.get('before', type=int), limit)
+    return jsonify(games=games,
+                   next=games[-1]["id"] if len(games) == limit else None)
@@ -0,0 +1,244 @@
+"""This module implements the bitboard representation of a game board.
+
+Each player's pieces are stored as a single integer in which the bit at
+position x * board_size + y is set when the player owns the square (x, y).
+Win and draw checks then reduce to a handful of bitwise operations against
+precomputed line masks instead of a scan over every piece in the game.
+
+A line is any run of win_length squares in a row, a column or a diagonal.
+With win_length equal to the board size these are the usual rows, columns
+and two diagonals; smaller values give gomoku-style k-in-a-row games.
+"""
+
+from app.cache import LRUCache
+from app.constants import RENDER_CACHE_SIZE
+
+DIRECTIONS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+_line_masks = {}
+_cell_lines = {}
+_separators = {}
+_rendered_rows = {}
+render_cache = LRUCache(RENDER_CACHE_SIZE)
+
+
+def cell_bit(x, y, board_size):
+    """Returns the bitmask of a single square."""
+    return 1 << (x * board_size + y)
+
+
+def full_mask(board_size):
+    """Returns the bitmask with every square of the board set."""
+    return (1 << (board_size * board_size)) - 1
+
+
+def line_masks(board_size, win_length=None):
+    """Returns the bitmasks of every line that wins the game.
+
+    The masks are computed once per board size and win length and cached
+    afterwards.
+
+    Args:
+        board_size: An integer representing the width of the board
+        win_length: An integer representing how many pieces in a row are
+            needed to win, which defaults to the board size
+
+    Returns:
+        A list of integer bitmasks, one for each winning line.
+    """
+
+    if win_length == None:
+        win_length = board_size
+    key = (board_size, win_length)
+    masks = _line_masks.get(key)
+    if masks != None:
+        return masks
+
+    masks = []
+    for (dx, dy) in DIRECTIONS:
+        for x in range(board_size):
+            for y in range(board_size):
+                end_x = x + dx * (win_length - 1)
+                end_y = y + dy * (win_length - 1)
+                if not (0 <= end_x < board_size and 0 <= end_y < board_size):
+                    continue
+                mask = 0
+                for i in range(win_length):
+                    mask |= cell_bit(x + dx * i, y + dy * i, board_size)
+                masks.append(mask)
+
+    _line_masks[key] = masks
+    return masks
+
+
+def cell_lines(board_size, win_length=None):
+    """Returns, for every square, the indices of the lines passing through it.
+
+    Args:
+        board_size: An integer representing the width of the board
+        win_length: An integer representing how many pieces in a row are
+            needed to win, which defaults to the board size
+
+    Returns:
+        A list indexed by x * board_size + y whose entries are lists of
+        indices into line_masks(board_size, win_length).
+    """
+
+    if win_length == None:
+        win_length = board_size
+    key = (board_size, win_length)
+    lines = _cell_lines.get(key)
+    if lines != None:
+        return lines
+
+    lines = [[] for i in range(board_size * board_size)]
+    for (index, mask) in enumerate(line_masks(board_size, win_length)):
+        for cell in range(board_size * board_size):
+            if mask & (1 << cell):
+                lines[cell].append(index)
+
+    _cell_lines[key] = lines
+    return lines
+
+
+def victory(mask, board_size, win_length=None):
+    """Returns whether or not a player has attained victory.
+
+    Args:
+        mask: An integer bitmask of the squares owned by the player
+        board_size: An integer representing the width of the board
+        win_length: An integer representing how many pieces in a row are
+            needed to win, which defaults to the board size
+
+    Returns:
+        A boolean representing whether or not the player's pieces are in a
+        winning configuration.
+    """
+
+    for line in line_masks(board_size, win_length):
+        if mask & line == line:
+            return True
+    return False
+
+
+def winning_move(mask, x, y, board_size, win_length=None):
+    """Returns whether the piece just placed on (x, y) completes a line.
+
+    Only the lines through the new piece are checked, so the cost of a move
+    depends on the win length rather than on the size of the board.
+
+    Args:
+        mask: An integer bitmask of the squares owned by the player, including
+            the new piece
+        x: An integer representing the x coordinate of the new piece
+        y: An integer representing the y coordinate of the new piece
+        board_size: An integer representing the width of the board
+        win_length: An integer representing how many pieces in a row are
+            needed to win, which defaults to the board size
+
+    Returns:
+        A boolean representing whether or not the move wins the game.
+    """
+
+    masks = line_masks(board_size, win_length)
+    for index in cell_lines(board_size, win_length)[x * board_size + y]:
+        line = masks[index]
+        if mask & line == line:
+            return True
+    return False
+
+
+def mark_dead_lines(dead_lines, x_mask, o_mask, x, y, board_size,
+                    win_length=None):
+    """Updates the set of lines that can no longer be won after a move.
+
+    A line is dead once both players hold a piece on it. Only the lines
+    through the new piece can change, so only those are examined.
+
+    Args:
+        dead_lines: An integer whose bit i is set when line i is dead
+        x_mask: An integer bitmask of the squares owned by the first player
+        o_mask: An integer bitmask of the squares owned by the second player
+        x: An integer representing the x coordinate of the new piece
+        y: An integer representing the y coordinate of the new piece
+        board_size: An integer representing the width of the board
+        win_length: An integer representing how many pieces in a row are
+            needed to win, which defaults to the board size
+
+    Returns:
+        The updated integer of dead lines.
+    """
+
+    masks = line_masks(board_size, win_length)
+    for index in cell_lines(board_size, win_length)[x * board_size + y]:
+        line = masks[index]
+        if x_mask & line and o_mask & line:
+            dead_lines |= 1 << index
+    return dead_lines
+
+
+def all_lines_dead(dead_lines, board_size, win_length=None):
+    """Returns whether no line can be won anymore, meaning a certain draw."""
+    return dead_lines == (1 << len(line_masks(board_size, win_length))) - 1
+
+
+def board_full(x_mask, o_mask, board_size):
+    """Returns whether every square on the board has been taken."""
+    return x_mask | o_mask == full_mask(board_size)
+
+
+def render_board(board_size, x_mask, o_mask):
+    """Returns the Slack string representation of a board.
+
+    Rendered boards are cached by their bitmasks, so showing an unchanged game
+    again costs a single dictionary lookup. Boards that are not cached yet are
+    assembled from prebuilt row and separator fragments.
+
+    Args:
+        board_size: An integer representing the width of the board
+        x_mask: An integer bitmask of the squares owned by the first player
+        o_mask: An integer bitmask of the squares owned by the second player
+
+    Returns:
+        A string representing the game board.
+    """
+
+    key = (board_size, x_mask, o_mask)
+    board_string = render_cache.get(key)
+    if board_string != None:
+        return board_string
+
+    separator = _separators.get(board_size)
+    if separator == None:
+        separator = "\n" + "+".join(["---"] * board_size) + "\n"
+        _separators[board_size] = separator
+
+    row_mask = (1 << board_size) - 1
+    rows = []
+    for i in range(board_size):
+        shift = i * board_size
+        rows.append(_render_row(board_size, (x_mask >> shift) & row_mask,
+                                (o_mask >> shift) & row_mask))
+
+    board_string = "```" + separator.join(rows) + "```"
+    render_cache.set(key, board_string)
+    return board_string
+
+
+def _render_row(board_size, x_row, o_row):
+    """Returns the string of a single row, given the bits of that row."""
+    key = (board_size, x_row, o_row)
+    row = _rendered_rows.get(key)
+    if row == None:
+        squares = []
+        for j in range(board_size):
+            if x_row & (1 << j):
+                squares.append(" X ")
+            elif o_row & (1 << j):
+                squares.append(" O ")
+            else:
+                squares.append("   ")
+        row = "|".join(squares)
+        if len(_rendered_rows) < RENDER_CACHE_SIZE:
+            _rendered_rows[key] = row
+    return row
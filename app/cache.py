@@ -0,0 +1,98 @@
+"""This module implements the small in-process caches used by the app."""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe mapping that evicts its least recently used entries.
+
+    Attributes:
+        maxsize: An integer representing the most entries the cache holds
+        hits: An integer counting lookups that found an entry
+        misses: An integer counting lookups that did not find an entry
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the value cached for a key, or default if there is none."""
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Caches a value, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Removes a key from the cache if it is present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache's size and hit/miss counters."""
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class TTLCache(LRUCache):
+    """An LRU cache whose entries also expire a fixed time after being set.
+
+    Attributes:
+        ttl: A number representing how many seconds an entry stays valid
+    """
+
+    def __init__(self, maxsize, ttl, timer=time.time):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self._timer = timer
+
+    def get(self, key, default=None):
+        """Returns the value cached for a key, or default if there is none."""
+        with self._lock:
+            try:
+                (value, expires_at) = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at <= self._timer():
+                self.misses += 1
+                return default
+            self._entries[key] = (value, expires_at)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Caches a value, evicting the least recently used entry if full."""
+        super(TTLCache, self).set(key, (value, self._timer() + self.ttl))
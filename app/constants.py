@@ -2,6 +2,68 @@
 
 BOARD_SIZE = 3
 
+# How many pieces in a row win the game. Set this below BOARD_SIZE for
+# gomoku-style games on large boards.
+WIN_LENGTH = BOARD_SIZE
+
+# How many rendered boards to keep around for repeated status requests.
+RENDER_CACHE_SIZE = 1024
+
+# Bounds for the cache of team, channel and player primary keys.
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 300
+
+# How many responses are kept for Slack's repeated deliveries of a command.
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+# How many games' versions the write-behind buffer remembers after writing
+# them, for moves on games that were loaded before the write.
+WRITE_BEHIND_VERSIONS = 10000
+
+# How many token buckets of rate limits a process keeps in memory, and how
+# many slots the file shared by the processes of a host has.
+RATE_LIMIT_BUCKETS = 100000
+RATE_LIMIT_SLOTS = 65536
+
+# How many milliseconds a connection of the sqlite store waits for the
+# database file's lock before failing.
+SQLITE_BUSY_TIMEOUT = 5000
+
+# How many teams' shards a process remembers, and for how many seconds. A
+# team being moved is refused by every process within SHARD_CACHE_TTL
+# seconds, so moves wait that long before copying.
+SHARD_CACHE_SIZE = 10000
+SHARD_CACHE_TTL = 5
+
+# How many rows of each table a move between shards copies at a time.
+MOVE_BATCH_SIZE = 500
+
+# How many times a command is attempted when it conflicts with a concurrent
+# command on the same rows.
+MAX_COMMAND_ATTEMPTS = 3
+
+# A snapshot of a game's board is stored every SNAPSHOT_INTERVAL moves, so
+# rebuilding a game replays at most SNAPSHOT_INTERVAL - 1 events.
+SNAPSHOT_INTERVAL = 4
+
+# The built-in opponent, challenged with `/ttt challenge bot`. Boards of up to
+# PERFECT_PLAY_CELLS squares are solved completely; on larger boards the bot
+# searches for BOT_MOVE_BUDGET seconds per move with a table of at most
+# BOT_TABLE_SIZE positions.
+BOT_NAME = "bot"
+BOT_USER_ID = "USLACKTTTBOT"
+PERFECT_PLAY_CELLS = 9
+BOT_MOVE_BUDGET = 0.5
+BOT_TABLE_SIZE = 100000
+
+# How many finished games a page of history holds by default, and at most.
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+
+# How many players `/ttt leaderboard` lists.
+LEADERBOARD_SIZE = 10
+LEADERBOARD_COMMANDS = ("leaderboard", "leaderboard team")
+
 MOVES = {
     "topleft": (0, 0),
     "top": (0, 1),
@@ -17,11 +79,22 @@ MOVES = {
 UNAUTHORIZED_ERROR = "You are not authorized to use this application."
 INVALID_COMMAND_ERROR = ("Oh no! We can't recognize your command! Try typing "
                          "`/ttt help` for more help.")
-CANNOT_CHALLENGE_ERROR = ("Someone else is playing right now. Wait a bit and "
-                          "try again!")
+ALREADY_PLAYING_ERROR = ("You're already playing a game in this channel. "
+                         "Finish it first!")
+OPPONENT_BUSY_ERROR = ("{0} is playing another game right now. Try again "
+                       "when it's over!")
 NO_CHALLENGE_ERROR = "No one challenged you."
 NO_ACTIVE_GAME_ERROR = "No one is currently playing right now."
+NO_RECORD_ERROR = "You haven't finished a game yet."
+NO_LEADERBOARD_ERROR = "No one has finished a game here yet."
 NOT_IN_A_GAME_ERROR = ("You're not playing a game right now. Challenge "
                        "someone to start a new game!")
 INCORRECT_TURN_ERROR = "Wait for your turn!"
 SQUARE_TAKEN_ERROR = "That square is already taken. Try an open one!"
+RATE_LIMITED_ERROR = ("You're sending commands too quickly. Wait a moment "
+                      "and try again!")
+TEAM_MOVING_ERROR = ("Your team's games are being moved. Try again in a "
+                     "minute!")
+BUSY_ERROR = ("Too many games are being played right now. Try again in a "
+              "moment!")
+COMMAND_FAILED_ERROR = "Something went wrong with your command. Try again!"
@@ -0,0 +1,241 @@
+"""This module resolves the database objects a Slack command operates on."""
+
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import db
+from app.cache import TTLCache
+from app.constants import (IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL,
+                           BOT_USER_ID)
+from app.models import Team, Channel, Player, Game
+
+# Maps Slack id strings to the primary keys of their rows. Keys are
+# ('channel', team_id, channel_id) and ('player', team_id, channel_id,
+# user_id). Only rows that exist are cached, so a cached key never hides a
+# row that was created after it was looked up.
+identity_cache = TTLCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+
+
+class GameContext(object):
+    """The team, channel, game and players that a single command acts upon.
+
+    Attributes:
+        team_id: A string representing a Slack team's id
+        channel_id: A string representing a Slack channel's id
+        user_id: A string representing the calling Slack user's id
+        team: The Team object, or None if the team is not in the database
+        channel: The Channel object, or None if it is not in the database
+        game: The calling user's active Game in the channel, or None
+        player: The calling user's Player object, or None
+        game_players: A tuple of both players of the game. Holding on to
+            them keeps them in the session's weakly referencing identity map,
+            so game.player1 and game.player2 do not have to be queried again.
+    """
+
+    def __init__(self, team_id, channel_id, user_id, team=None, channel=None,
+                 game=None, player=None, game_players=()):
+        self.team_id = team_id
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self._team = team
+        self.channel = channel
+        self.game = game
+        self.player = player
+        self.game_players = game_players
+
+    @property
+    def team(self):
+        """Returns the Team object, loading it through the channel if needed."""
+        if self._team == None and self.channel != None:
+            self._team = self.channel.team
+        return self._team
+
+    @team.setter
+    def team(self, team):
+        self._team = team
+
+    @property
+    def active_game(self):
+        """Returns the user's game if it is still being played."""
+        if self.game == None or self.game.finished:
+            return None
+        return self.game
+
+    def is_playing(self):
+        """Returns whether the calling user is a player in the active game."""
+        game = self.active_game
+        return (game != None and self.player != None and
+                (game.player1 == self.player or game.player2 == self.player))
+
+
+def load_context(team_id, channel_id, user_id=None):
+    """Loads everything a command needs in a single joined query.
+
+    The team, channel, caller's player, the caller's active game and both of
+    that game's players are fetched together, so the relationships the
+    handlers touch afterwards are already in the session's identity map and
+    do not issue further queries. The game is found through the
+    active_game_id of the caller's player row, which is one indexed lookup
+    however many games are being played in the channel. When the primary
+    keys of the channel and player are cached, the query starts from the
+    channel's primary key and skips the lookups by Slack id altogether.
+
+    Args:
+        team_id: A string representing a Slack team's id
+        channel_id: A string representing a Slack channel's id
+        user_id: A string representing the calling Slack user's id, or None
+            if the command does not act on behalf of a player
+
+    Returns:
+        A GameContext object. Objects that do not exist yet are None.
+    """
+
+    channel_key = ('channel', team_id, channel_id)
+    player_key = ('player', team_id, channel_id, user_id)
+    channel_pk = identity_cache.get(channel_key)
+    player_pk = identity_cache.get(player_key) if user_id != None else None
+    if channel_pk != None and (user_id == None or player_pk != None):
+        context = _load_cached_context(team_id, channel_id, user_id,
+                                       channel_pk, player_pk)
+        if context != None:
+            return context
+        identity_cache.invalidate(channel_key)
+        identity_cache.invalidate(player_key)
+
+    context = _load_full_context(team_id, channel_id, user_id)
+    if context.channel != None:
+        identity_cache.set(channel_key, context.channel.id)
+    if context.player != None:
+        identity_cache.set(player_key, context.player.id)
+    return context
+
+
+def forget_context(team_id, channel_id, user_id=None):
+    """Drops the cached primary keys of a channel and, optionally, a player.
+
+    Handlers call this after creating or removing rows, so the next command
+    resolves them from the database again.
+    """
+
+    identity_cache.invalidate(('channel', team_id, channel_id))
+    if user_id != None:
+        identity_cache.invalidate(('player', team_id, channel_id, user_id))
+
+
+def _game_query(*entities):
+    """Returns a query joining a player's active game and that game's players.
+
+    The query selects the given entities followed by the Player, the Game
+    and both of its players; the caller supplies the Player to join from.
+    """
+
+    player1 = aliased(Player)
+    player2 = aliased(Player)
+    entities = list(entities) + [Player, Game, player1, player2]
+    query = db.session.query(*entities)
+
+    def join_game(query):
+        return (query
+                .outerjoin(Game, Game.id == Player.active_game_id)
+                .outerjoin(player1, Game.player1_id == player1.id)
+                .outerjoin(player2, Game.player2_id == player2.id))
+
+    return (query, join_game)
+
+
+def _load_full_context(team_id, channel_id, user_id):
+    """Resolves a context by the Slack ids of its team, channel and user."""
+
+    (query, join_game) = _game_query(Team, Channel)
+    query = join_game(
+        query
+        .outerjoin(Channel, and_(Channel.team_id == Team.id,
+                                 Channel.channel_id == channel_id))
+        .outerjoin(Player, and_(Player.channel_id == Channel.id,
+                                Player.user_id == user_id)))
+
+    row = query.filter(Team.team_id == team_id).first()
+    if row == None:
+        return GameContext(team_id, channel_id, user_id)
+
+    return GameContext(team_id, channel_id, user_id, team=row[0],
+                       channel=row[1], player=row[2], game=row[3],
+                       game_players=(row[4], row[5]))
+
+
+def _load_cached_context(team_id, channel_id, user_id, channel_pk, player_pk):
+    """Resolves a context by the cached primary keys of its channel and user.
+
+    Returns:
+        A GameContext object, or None if a cached row no longer exists or,
+        as after its team moved to another shard, now holds another channel
+        or user.
+    """
+
+    (query, join_game) = _game_query(Channel)
+    query = join_game(
+        query.outerjoin(Player, and_(Player.channel_id == Channel.id,
+                                     Player.id == player_pk)))
+
+    row = query.filter(Channel.id == channel_pk).first()
+    if row == None or row[0].channel_id != channel_id:
+        return None
+
+    player = row[1]
+    if user_id != None and (player == None or player.user_id != user_id):
+        return None
+    return GameContext(team_id, channel_id, user_id, channel=row[0],
+                       player=player, game=row[2],
+                       game_players=(row[3], row[4]))
+
+
+def claim_players(game, *players):
+    """Makes a game the active game of its players.
+
+    Each player's active game is only replaced if it is still the one the
+    command read, which is either none or a game that has finished since.
+    Otherwise a concurrent command has started a game for the player, and a
+    StaleDataError makes the command run again on a reloaded context. The
+    bot plays any number of games at once and is never claimed.
+
+    Args:
+        game: The Game object, which must have been flushed
+        players: The Player objects to claim, which must have been flushed
+    """
+
+    table = Player.__table__
+    for player in players:
+        if player.user_id == BOT_USER_ID:
+            continue
+        seen = player.active_game_id
+        updated = db.session.execute(
+            table.update()
+            .where(and_(table.c.id == player.id,
+                        table.c.active_game_id == seen))
+            .values(active_game_id=game.id)).rowcount
+        if updated != 1:
+            raise StaleDataError("player %s started another game" %
+                                 player.id)
+        set_committed_value(player, 'active_game_id', game.id)
+
+
+def release_players(game_ids):
+    """Clears the active game of the players of finished games.
+
+    Only players whose active game is still one of these games are changed.
+    The changes are made in the session, not committed.
+
+    Args:
+        game_ids: A list of integers representing the ids of the games
+    """
+
+    table = Player.__table__
+    db.session.execute(table.update()
+                       .where(table.c.active_game_id.in_(game_ids))
+                       .values(active_game_id=None))
+    for player in db.session.identity_map.values():
+        if (isinstance(player, Player) and
+                player.__dict__.get('active_game_id') in game_ids):
+            set_committed_value(player, 'active_game_id', None)
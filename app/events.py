@@ -0,0 +1,229 @@
+"""This module keeps an append-only log of every game's moves.
+
+Each move is stored as a MoveEvent numbered by its position in the game, and
+every SNAPSHOT_INTERVAL moves the game's board is stored as a GameSnapshot.
+Any earlier state of a game is rebuilt from the last snapshot before it plus
+the few events after that snapshot, without scanning the game's pieces.
+
+The log can be streamed to a file of JSON lines for offline analysis:
+
+    python -m app.events moves.jsonl --after 0
+"""
+
+from datetime import datetime
+import argparse
+import json
+import sys
+
+from sqlalchemy import and_
+from sqlalchemy.orm import joinedload
+
+from app import db
+from app.board import cell_bit, mark_dead_lines, winning_move, all_lines_dead
+from app.constants import SNAPSHOT_INTERVAL
+from app.models import Game, GameSnapshot, MoveEvent, Player
+
+EXPORT_BATCH_SIZE = 1000
+
+
+class GameState(object):
+    """The state of a game right after one of its moves.
+
+    Attributes:
+        sequence: An integer representing how many moves have been made
+        x_mask: An integer representing the squares of player1
+        o_mask: An integer representing the squares of player2
+        dead_lines: An integer representing the lines that cannot be won
+        current_player_name: A string representing the player to move next,
+            or the player who made the last move of a finished game
+        finished: A boolean representing whether the game has ended
+    """
+
+    def __init__(self, sequence, x_mask, o_mask, dead_lines,
+                 current_player_name, finished):
+        self.sequence = sequence
+        self.x_mask = x_mask
+        self.o_mask = o_mask
+        self.dead_lines = dead_lines
+        self.current_player_name = current_player_name
+        self.finished = finished
+
+
+def snapshot_due(sequence):
+    """Returns whether the state after a move is stored as a snapshot."""
+    return sequence % SNAPSHOT_INTERVAL == 0
+
+
+def log_move(game, player, x, y):
+    """Appends a move to the game's log.
+
+    Call this once the game reflects the move, including whose turn it is
+    and whether the game has ended, so that a snapshot taken here is
+    complete. The new rows are added to the session, not committed.
+
+    Args:
+        game: The Game object the move was made in
+        player: The Player object who made the move
+        x: An integer representing the x coordinate of the new piece
+        y: An integer representing the y coordinate of the new piece
+    """
+
+    game.move_count += 1
+    db.session.add(MoveEvent(game.move_count, x, y, player, game,
+                             datetime.utcnow()))
+    if snapshot_due(game.move_count):
+        db.session.add(GameSnapshot(game))
+
+
+def load_state(game_id, sequence=None):
+    """Rebuilds a game's state from its latest snapshot and the events after.
+
+    Args:
+        game_id: An integer representing a Game's id
+        sequence: An integer representing the move to rebuild the state
+            after, or None for the latest move
+
+    Returns:
+        A GameState object, or None if the game does not exist.
+    """
+
+    snapshot_filter = GameSnapshot.game_id == Game.id
+    if sequence != None:
+        snapshot_filter = and_(snapshot_filter,
+                               GameSnapshot.sequence <= sequence)
+    row = (db.session.query(Game, GameSnapshot)
+           .outerjoin(GameSnapshot, snapshot_filter)
+           .options(joinedload(Game.player1), joinedload(Game.player2))
+           .filter(Game.id == game_id)
+           .order_by(GameSnapshot.sequence.desc())
+           .first())
+    if row == None:
+        return None
+    (game, snapshot) = row
+
+    if snapshot != None:
+        state = GameState(snapshot.sequence, snapshot.x_mask, snapshot.o_mask,
+                          snapshot.dead_lines, snapshot.current_player_name,
+                          snapshot.finished)
+    else:
+        state = None
+    events = game.events.filter(
+        MoveEvent.sequence > (state.sequence if state != None else 0))
+    if sequence != None:
+        events = events.filter(MoveEvent.sequence <= sequence)
+    for event in events.order_by(MoveEvent.sequence):
+        state = apply_event(game, state, event)
+    return state
+
+
+def replay(game_id):
+    """Yields a game's state after each of its logged moves, in order."""
+    game = Game.query.get(game_id)
+    state = None
+    for event in game.events.order_by(MoveEvent.sequence):
+        state = apply_event(game, state, event)
+        yield state
+
+
+def apply_event(game, state, event):
+    """Returns the state of a game after one more move.
+
+    Args:
+        game: The Game object the event belongs to
+        state: The GameState object before the move, or None before the
+            first move
+        event: The MoveEvent object to apply
+
+    Returns:
+        A new GameState object.
+    """
+
+    if state == None:
+        state = GameState(0, 0, 0, 0, None, False)
+    board_size = game.board_size
+    bit = cell_bit(event.x_coord, event.y_coord, board_size)
+    x_mask = state.x_mask
+    o_mask = state.o_mask
+    if event.player_id == game.player1_id:
+        (mover, opponent) = (game.player1, game.player2)
+        x_mask |= bit
+        mask = x_mask
+    else:
+        (mover, opponent) = (game.player2, game.player1)
+        o_mask |= bit
+        mask = o_mask
+    dead_lines = mark_dead_lines(state.dead_lines, x_mask, o_mask,
+                                 event.x_coord, event.y_coord, board_size,
+                                 game.win_length)
+    finished = (winning_move(mask, event.x_coord, event.y_coord, board_size,
+                             game.win_length) or
+                all_lines_dead(dead_lines, board_size, game.win_length))
+    return GameState(event.sequence, x_mask, o_mask, dead_lines,
+                     mover.user_name if finished else opponent.user_name,
+                     finished)
+
+
+def export_events(out, after=0, batch_size=EXPORT_BATCH_SIZE):
+    """Streams the move log to a file as one JSON object per line.
+
+    Events are read in batches ordered by id, each batch starting after the
+    last id of the previous one, so memory use does not grow with the log and
+    an export can be resumed where an earlier one stopped.
+
+    Args:
+        out: A file object to write to
+        after: An integer representing the id of the last event already
+            exported
+        batch_size: An integer representing how many events to read at once
+
+    Returns:
+        An integer representing the id of the last event written.
+    """
+
+    while True:
+        rows = (db.session.query(MoveEvent.id, MoveEvent.game_id,
+                                 MoveEvent.sequence, Player.user_id,
+                                 Player.user_name, MoveEvent.x_coord,
+                                 MoveEvent.y_coord, MoveEvent.created_at)
+                .outerjoin(Player, Player.id == MoveEvent.player_id)
+                .filter(MoveEvent.id > after)
+                .order_by(MoveEvent.id)
+                .limit(batch_size)
+                .all())
+        for (event_id, game_id, sequence, user_id, user_name, x, y,
+             created_at) in rows:
+            out.write(json.dumps({
+                "id": event_id,
+                "game_id": game_id,
+                "sequence": sequence,
+                "user_id": user_id,
+                "user_name": user_name,
+                "x": x,
+                "y": y,
+                "created_at": (created_at.isoformat() if created_at != None
+                               else None)
+            }) + "\n")
+        if rows:
+            after = rows[-1][0]
+        if len(rows) < batch_size:
+            return after
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export the move log as JSON lines.")
+    parser.add_argument("output", help="file to write, or - for stdout")
+    parser.add_argument("--after", type=int, default=0,
+                        help="only export events with a greater id")
+    args = parser.parse_args(argv)
+
+    if args.output == "-":
+        last = export_events(sys.stdout, args.after)
+    else:
+        with open(args.output, "a") as out:
+            last = export_events(out, args.after)
+    sys.stderr.write("last exported event id: %d\n" % last)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""This module implements consistent hashing of keys onto a set of nodes."""
+
+import bisect
+import hashlib
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+class HashRing(object):
+    """Maps keys onto nodes so that few keys move when nodes change.
+
+    Every node is placed on the ring at several points; a key belongs to the
+    first node point after the key's own hash. Adding or removing a
+    node therefore only moves the keys next to that node's points.
+
+    Attributes:
+        replicas: An integer representing the number of points per node
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._hashes = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        """Places a node on the ring."""
+        for i in range(self.replicas):
+            point = _hash("%s#%d" % (node, i))
+            index = bisect.bisect(self._hashes, point)
+            self._hashes.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        """Takes a node off the ring."""
+        points = [(point, other) for (point, other) in
+                  zip(self._hashes, self._nodes) if other != node]
+        self._hashes = [point for (point, other) in points]
+        self._nodes = [other for (point, other) in points]
+
+    def get(self, key):
+        """Returns the node a key belongs to, or None if the ring is empty."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def _hash(key):
+    if isinstance(key, text_type):
+        key = key.encode('utf-8')
+    elif not isinstance(key, bytes):
+        key = repr(key).encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
@@ -0,0 +1,181 @@
+"""This module removes the rows that commands no longer need.
+
+A sweep does three things. It expires challenges that nobody accepted
+within CHALLENGE_TTL seconds. It deletes expired challenges that are older
+than CHALLENGE_RETENTION seconds. It also moves finished games into the
+archive, deleting their rows from the live game tables. With SHARDS set,
+the steps run on each shard in turn.
+
+Every step walks its table in primary key order, a batch of
+HOUSEKEEPING_BATCH rows at a time. Each batch is its own short transaction,
+and the next batch starts after the last key of the previous one. Locks are
+therefore only held on one batch at a time, and an interrupted sweep can
+simply be run again.
+
+Sweeps run from `python manage.py housekeeping`, or every
+HOUSEKEEPING_INTERVAL seconds on a background thread.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import threading
+
+from app import app, db
+from app.archive import archive_games
+from app.metrics import registry
+from app.models import Challenge, Game
+from app.shards import DEFAULT_SHARD, bind_shard, shard_names
+
+logger = logging.getLogger(__name__)
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def challenge_cutoff(now=None):
+    """Returns the time before which an unaccepted challenge has expired."""
+    now = now if now != None else datetime.utcnow()
+    return now - timedelta(seconds=app.config['CHALLENGE_TTL'])
+
+
+def expire_challenges(now=None, batch_size=None):
+    """Marks the challenges older than CHALLENGE_TTL as expired.
+
+    Returns:
+        The number of challenges expired.
+    """
+
+    cutoff = challenge_cutoff(now)
+    query = (db.session.query(Challenge.id)
+             .filter(Challenge.expired == False,
+                     Challenge.created_at < cutoff))
+    table = Challenge.__table__
+
+    def expire(ids):
+        db.session.execute(
+            table.update()
+            .where(table.c.id.in_(ids))
+            .values(expired=True, version=table.c.version + 1))
+
+    return _in_batches(query, Challenge.id, expire, batch_size)
+
+
+def delete_challenges(now=None, batch_size=None):
+    """Deletes the expired challenges older than CHALLENGE_RETENTION.
+
+    Returns:
+        The number of challenges deleted.
+    """
+
+    now = now if now != None else datetime.utcnow()
+    cutoff = now - timedelta(seconds=app.config['CHALLENGE_RETENTION'])
+    query = (db.session.query(Challenge.id)
+             .filter(Challenge.expired == True,
+                     Challenge.created_at < cutoff))
+    table = Challenge.__table__
+
+    def delete(ids):
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+
+    return _in_batches(query, Challenge.id, delete, batch_size)
+
+
+def archive_finished_games(batch_size=None):
+    """Moves finished games out of the live tables and into the archive.
+
+    Returns:
+        The number of games archived.
+    """
+
+    query = db.session.query(Game.id).filter(Game.finished == True)
+    return _in_batches(query, Game.id, archive_games, batch_size)
+
+
+def sweep(now=None, batch_size=None):
+    """Runs every housekeeping step once on every shard.
+
+    Returns:
+        A dictionary of how many rows each step handled.
+    """
+
+    result = {"challenges_expired": 0, "challenges_deleted": 0,
+              "games_archived": 0}
+    try:
+        for shard in shard_names():
+            bind_shard(shard)
+            result["challenges_expired"] += expire_challenges(now, batch_size)
+            result["challenges_deleted"] += delete_challenges(now, batch_size)
+            result["games_archived"] += archive_finished_games(batch_size)
+    finally:
+        bind_shard(DEFAULT_SHARD)
+    for (name, count) in result.items():
+        registry.increment("housekeeping." + name, count)
+    return result
+
+
+def _in_batches(query, key, function, batch_size=None):
+    """Calls a function on the keys a query selects, a batch at a time.
+
+    Each batch is committed before the next one is read, and each read
+    starts after the last key of the previous batch.
+
+    Returns:
+        The number of keys handled.
+    """
+
+    batch_size = batch_size or app.config['HOUSEKEEPING_BATCH']
+    last = None
+    total = 0
+    while True:
+        batch = query
+        if last != None:
+            batch = batch.filter(key > last)
+        ids = [row[0] for row in batch.order_by(key).limit(batch_size)]
+        if not ids:
+            return total
+        function(ids)
+        db.session.commit()
+        total += len(ids)
+        last = ids[-1]
+        if len(ids) < batch_size:
+            return total
+
+
+def _sweep_forever(stopped, interval):
+    while not stopped.wait(interval):
+        try:
+            with app.app_context():
+                try:
+                    sweep()
+                finally:
+                    db.session.remove()
+        except Exception:
+            logger.exception("Housekeeping sweep failed")
+
+
+def start_sweeper():
+    """Starts sweeping every HOUSEKEEPING_INTERVAL seconds, once per process.
+
+    Returns:
+        A threading.Event that stops the sweeper when set, or None if the
+        interval is 0.
+    """
+
+    global _sweeper
+    interval = app.config.get('HOUSEKEEPING_INTERVAL')
+    if not interval:
+        return None
+    with _sweeper_lock:
+        if _sweeper == None:
+            _sweeper = threading.Event()
+            thread = threading.Thread(target=_sweep_forever,
+                                      args=(_sweeper, interval),
+                                      name="ttt-housekeeping")
+            thread.daemon = True
+            thread.start()
+    return _sweeper
+
+
+@app.before_first_request
+def _start_sweeper():
+    start_sweeper()
@@ -0,0 +1,170 @@
+"""This module answers repeated deliveries of a Slack command only once.
+
+Slack delivers a command again when our response is slow, and a second run
+of a move would fail with SQUARE_TAKEN_ERROR or INCORRECT_TURN_ERROR just
+when the app is busiest. Each command is therefore fingerprinted by its
+team, channel, user, text and trigger_id. The first delivery runs the
+command. A delivery that arrives while the first is still running waits for
+it and gets the same response. A delivery that arrives within
+IDEMPOTENCY_TTL seconds after the first finished is answered from a bounded
+cache of responses, without touching the database.
+
+Commands without a trigger_id, or an X-Slack-Request-Timestamp header to
+stand in for it, cannot be told apart from a user typing the same command
+twice and always run.
+"""
+
+import hashlib
+import threading
+
+from flask import Response
+
+from app import app
+from app.cache import TTLCache
+from app.constants import IDEMPOTENCY_CACHE_SIZE
+from app.metrics import registry
+
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+
+
+class _Call(object):
+    """A command that is being run, and the response it ended with."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class Deduplicator(object):
+    """Runs each command once, however often it is delivered.
+
+    Attributes:
+        responses: A TTLCache of the responses of finished commands, keyed by
+            fingerprint
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.responses = TTLCache(maxsize, ttl)
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def run(self, key, function, remember=None):
+        """Returns the response of a command, running it only if needed.
+
+        Args:
+            key: A string fingerprinting the command
+            function: A function taking no arguments that runs the command
+                and returns its response
+            remember: A function taking a response and returning whether
+                later deliveries may be answered with it, or None to remember
+                every response
+
+        Returns:
+            The response of the first run of the command.
+        """
+
+        with self._lock:
+            response = self.responses.get(key)
+            if response != None:
+                registry.increment("idempotency.replayed")
+                return response
+            call = self._calls.get(key)
+            leader = call == None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            registry.increment("idempotency.coalesced")
+            call.done.wait()
+            if call.error != None:
+                raise call.error
+            return call.response
+
+        try:
+            call.response = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            # A failed command is not remembered, so a retry runs it again.
+            with self._lock:
+                if call.error == None and (remember == None or
+                                           remember(call.response)):
+                    self.responses.set(key, call.response)
+                del self._calls[key]
+            call.done.set()
+        return call.response
+
+    def clear(self):
+        """Forgets every finished command."""
+        self.responses.clear()
+
+
+def command_fingerprint(form, headers):
+    """Returns the fingerprint of a delivered command, or None.
+
+    Args:
+        form: The request's form, holding the slash command's fields
+        headers: The request's headers
+
+    Returns:
+        A string, or None if the command carries nothing that distinguishes
+        a repeated delivery from a repeated command.
+    """
+
+    trigger = (form.get('trigger_id') or
+               headers.get('X-Slack-Request-Timestamp'))
+    if not trigger:
+        return None
+    fields = [form.get(name, '') for name in
+              ('team_id', 'channel_id', 'user_id', 'text')] + [trigger]
+    return hashlib.sha1(u"\x1f".join(fields).encode('utf-8')).hexdigest()
+
+
+def run_once(key, handler, retry_on=()):
+    """Runs a request handler once per fingerprint and returns its response.
+
+    The handler's return value is turned into a response and kept as its
+    body, status and headers, so every delivery gets a fresh Response object.
+
+    Args:
+        key: A string fingerprinting the command, or None to always run it
+        handler: A function taking no arguments that returns a response
+        retry_on: A collection of response bodies that are not remembered,
+            so a later delivery runs the command again
+    """
+
+    deduplicator = get_deduplicator()
+    if key == None or deduplicator == None:
+        return handler()
+
+    def respond():
+        response = app.make_response(handler())
+        return (response.get_data(), response.status_code,
+                response.headers.to_wsgi_list())
+
+    (body, status, headers) = deduplicator.run(
+        key, respond, lambda response: response[0] not in retry_on)
+    return Response(body, status, headers)
+
+
+def get_deduplicator():
+    """Returns the process's deduplicator, or None if IDEMPOTENCY_TTL is 0."""
+    global _deduplicator
+    ttl = app.config.get('IDEMPOTENCY_TTL')
+    if not ttl:
+        return None
+    if _deduplicator == None:
+        with _deduplicator_lock:
+            if _deduplicator == None:
+                _deduplicator = Deduplicator(IDEMPOTENCY_CACHE_SIZE, ttl)
+    return _deduplicator
+
+
+registry.set_gauge("idempotency.in_flight",
+                   lambda: len(_deduplicator) if _deduplicator != None else 0)
@@ -0,0 +1,253 @@
+"""This module measures where the time of each Slack command goes.
+
+When METRICS_ENABLED is set, every request records how many SQL statements
+it issued, the time spent in the database, the time spent rendering boards
+and the total handler time. The measurements are aggregated into histograms
+per command type, served as JSON on /metrics, and, with METRICS_DEBUG_HEADER,
+also returned on each response in an X-TTT-Metrics header.
+
+Recording is a few additions per SQL statement and a lock per histogram per
+request, so it is cheap enough to leave on in production.
+"""
+
+from contextlib import contextmanager
+from flask import request, jsonify, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import threading
+import time
+
+from app import app
+from app.board import render_cache
+from app.constants import LEADERBOARD_COMMANDS, MOVES
+from app.context import identity_cache
+
+MS_BUCKETS = [0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+COUNT_BUCKETS = [0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50]
+
+_current = threading.local()
+
+
+class Histogram(object):
+    """A thread-safe histogram with fixed bucket upper bounds.
+
+    Attributes:
+        bounds: A sorted list of bucket upper bounds. Values above the last
+            bound fall into a final overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Records a single value."""
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+
+    def quantile(self, fraction):
+        """Returns the upper bound of the bucket holding a quantile."""
+        rank = fraction * self.count
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index < len(self.bounds):
+                    return self.bounds[index]
+                return None
+        return None
+
+    def snapshot(self):
+        """Returns the histogram as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "count": self.count,
+                "sum": self.total,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.quantile(0.50),
+                "p95": self.quantile(0.95),
+                "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(bound) for bound in self.bounds] +
+                                    ["+Inf"], self.counts))
+            }
+
+
+class Registry(object):
+    """Holds the histograms, counters and gauges of the process."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, bounds=MS_BUCKETS):
+        """Returns the histogram of a name, creating it on first use."""
+        histogram = self.histograms.get(name)
+        if histogram == None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram(bounds))
+        return histogram
+
+    def increment(self, name, amount=1):
+        """Adds to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, function):
+        """Registers a function whose value is reported under a name."""
+        self.gauges[name] = function
+
+    def clear(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def snapshot(self):
+        """Returns every metric as a JSON-serializable dict."""
+        return {
+            "histograms": dict((name, histogram.snapshot()) for
+                               (name, histogram) in self.histograms.items()),
+            "counters": dict(self.counters),
+            "gauges": dict((name, function()) for
+                           (name, function) in self.gauges.items())
+        }
+
+
+registry = Registry()
+registry.set_gauge("identity_cache", identity_cache.stats)
+registry.set_gauge("render_cache", render_cache.stats)
+
+
+class RequestMetrics(object):
+    """The measurements of the request being handled by a thread."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+        self.query_start = None
+
+
+def command_type(text):
+    """Returns the type of a slash command, used to group measurements."""
+    word = text.split(' ', 1)[0]
+    if word in ("challenge", "accept", "status"):
+        return word
+    if word in ("help", "moves"):
+        return "help"
+    if text == "stats" or text in LEADERBOARD_COMMANDS:
+        return "stats"
+    if text in MOVES:
+        return "move"
+    return "invalid"
+
+
+def start_request():
+    """Starts measuring the current thread's request."""
+    _current.metrics = RequestMetrics()
+
+
+def finish_request(command):
+    """Stops measuring the current thread's request and records it.
+
+    Args:
+        command: A string representing the type of the command
+
+    Returns:
+        The RequestMetrics object of the request, or None if the request was
+        not being measured.
+    """
+
+    metrics = getattr(_current, "metrics", None)
+    if metrics == None:
+        return None
+    _current.metrics = None
+    handler_seconds = time.time() - metrics.start
+
+    registry.histogram(command + ".queries", COUNT_BUCKETS).observe(
+        metrics.queries)
+    registry.histogram(command + ".db_ms").observe(
+        1000 * metrics.db_seconds)
+    registry.histogram(command + ".render_ms").observe(
+        1000 * metrics.render_seconds)
+    registry.histogram(command + ".handler_ms").observe(
+        1000 * handler_seconds)
+    metrics.handler_seconds = handler_seconds
+    return metrics
+
+
+@contextmanager
+def timing_render():
+    """Adds the time spent in the block to the request's render time."""
+    metrics = getattr(_current, "metrics", None)
+    if metrics == None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        metrics.render_seconds += time.time() - start
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(*args):
+    metrics = getattr(_current, "metrics", None)
+    if metrics != None:
+        metrics.query_start = time.time()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(*args):
+    metrics = getattr(_current, "metrics", None)
+    if metrics != None and metrics.query_start != None:
+        metrics.queries += 1
+        metrics.db_seconds += time.time() - metrics.query_start
+        metrics.query_start = None
+
+
+@app.before_request
+def _before_request():
+    if app.config.get('METRICS_ENABLED') and request.method == 'POST':
+        start_request()
+
+
+@app.after_request
+def _after_request(response):
+    if getattr(_current, "metrics", None) == None:
+        return response
+    metrics = finish_request(command_type(request.form.get('text', '')))
+    if app.config.get('METRICS_DEBUG_HEADER'):
+        response.headers['X-TTT-Metrics'] = (
+            "queries={0}; db_ms={1:.2f}; render_ms={2:.2f}; handler_ms={3:.2f}"
+            .format(metrics.queries, 1000 * metrics.db_seconds,
+                    1000 * metrics.render_seconds,
+                    1000 * metrics.handler_seconds))
+    return response
+
+
+@app.teardown_request
+def _teardown_request(exception):
+    # A request that raised skips after_request, so its measurements are
+    # recorded here rather than left for the thread's next request.
+    if getattr(_current, "metrics", None) != None:
+        finish_request(command_type(request.form.get('text', '')))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Returns the aggregated metrics of this process as JSON."""
+    if (not app.config.get('METRICS_ENABLED') or
+            request.remote_addr not in app.config['METRICS_ALLOWED_ADDRS']):
+        abort(404)
+    return jsonify(registry.snapshot())
@@ -1,17 +1,78 @@
 """This module defines the database models."""
 
+from datetime import datetime
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
 from app import db
+from app.board import cell_bit, mark_dead_lines
 
 
-class Game(db.Model):
+class BitBoard(db.TypeDecorator):
+    """Stores an arbitrarily large board bitmask as a hexadecimal string."""
+
+    impl = db.String
+
+    def process_bind_param(self, value, dialect):
+        if value == None:
+            return None
+        return '%x' % value
+
+    def process_result_value(self, value, dialect):
+        if value == None:
+            return None
+        return int(value, 16)
+
+
+class GameBoard(object):
+    """The board of a game, kept as bitmasks of each player's squares.
+
+    Games of every store share these methods. The class using them has
+    board_size, win_length, x_mask, o_mask, dead_lines, player1 and player2
+    attributes.
+    """
+
+    def player_mask(self, player):
+        """Returns the bitmask of the squares owned by one of the players."""
+        return self.x_mask if player == self.player1 else self.o_mask
+
+    def is_taken(self, x, y):
+        """Returns whether a square already holds a piece."""
+        bit = cell_bit(x, y, self.board_size)
+        return (self.x_mask | self.o_mask) & bit != 0
+
+    def place_piece(self, x, y, player):
+        """Marks a square as owned by one of the players.
+
+        The bitmasks are the authoritative state of the board; pieces only
+        record the history of moves. The lines through the square that can no
+        longer be won are marked dead along the way.
+        """
+
+        bit = cell_bit(x, y, self.board_size)
+        if player == self.player1:
+            self.x_mask |= bit
+        else:
+            self.o_mask |= bit
+        self.dead_lines = mark_dead_lines(self.dead_lines, self.x_mask,
+                                          self.o_mask, x, y, self.board_size,
+                                          self.win_length)
+
+
+class Game(GameBoard, db.Model):
     __tablename__ = "game"
     id = db.Column(db.Integer, primary_key=True)
     board_size = db.Column(db.Integer)
+    win_length = db.Column(db.Integer)
     current_player_name = db.Column(db.String(25))
     finished = db.Column(db.Boolean, default=False)
+    x_mask = db.Column(BitBoard, default=0)
+    o_mask = db.Column(BitBoard, default=0)
+    dead_lines = db.Column(BitBoard, default=0)
+    move_count = db.Column(db.Integer, nullable=False, default=0)
+    turn_deadline = db.Column(db.Integer)
+    response_url = db.Column(db.String(255))
+    version = db.Column(db.Integer, nullable=False)
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'))
     player1_id = db.Column(db.Integer, db.ForeignKey('player.id'))
     player2_id = db.Column(db.Integer, db.ForeignKey('player.id'))
@@ -32,19 +93,34 @@ class Game(db.Model):
         backref=db.backref('games_as_player2', lazy="dynamic")
     )
 
-    def __init__(self, board_size, current_player, channel, player1, player2):
+    # Every UPDATE is made conditional on the version that was read, so a
+    # concurrent change makes the flush fail with a StaleDataError instead
+    # of silently overwriting it.
+    __mapper_args__ = {"version_id_col": version}
+
+    def __init__(self, board_size, current_player, channel, player1, player2,
+                 win_length=None):
         self.board_size = board_size
+        self.win_length = win_length if win_length != None else board_size
         self.current_player_name = current_player
         self.channel = channel
         self.player1 = player1
         self.player2 = player2
+        self.x_mask = 0
+        self.o_mask = 0
+        self.dead_lines = 0
+        self.move_count = 0
 
 
 class Piece(db.Model):
     __tablename__ = "piece"
+    __table_args__ = (
+        db.Index('uq_piece_game_id_x_coord_y_coord',
+                 'game_id', 'x_coord', 'y_coord', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    x_coord = db.Column(db.Integer, index=True)
-    y_coord = db.Column(db.Integer, index=True)
+    x_coord = db.Column(db.Integer)
+    y_coord = db.Column(db.Integer)
     player_id = db.Column(db.Integer, db.ForeignKey('player.id'))
     game_id = db.Column(db.Integer, db.ForeignKey('game.id'))
 
@@ -64,13 +140,154 @@ class Piece(db.Model):
         self.y_coord = y_coord
         self.player = player
         self.game = game
+        game.place_piece(x_coord, y_coord, player)
+
+
+class MoveEvent(db.Model):
+    """A move in a game's append-only log, numbered from 1 in move order."""
+
+    __tablename__ = "move_event"
+    __table_args__ = (
+        db.Index('uq_move_event_game_id_sequence',
+                 'game_id', 'sequence', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    sequence = db.Column(db.Integer, nullable=False)
+    x_coord = db.Column(db.Integer)
+    y_coord = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'))
+    game_id = db.Column(db.Integer, db.ForeignKey('game.id'))
+
+    player = db.relationship('Player', foreign_keys=player_id)
+    game = db.relationship(
+        'Game',
+        foreign_keys=game_id,
+        backref=db.backref('events', lazy="dynamic")
+    )
+
+    def __init__(self, sequence, x_coord, y_coord, player, game,
+                 created_at=None):
+        self.sequence = sequence
+        self.x_coord = x_coord
+        self.y_coord = y_coord
+        self.player = player
+        self.game = game
+        self.created_at = created_at
+
+
+class GameSnapshot(db.Model):
+    """The state of a game right after the move with the given sequence."""
+
+    __tablename__ = "game_snapshot"
+    __table_args__ = (
+        db.Index('uq_game_snapshot_game_id_sequence',
+                 'game_id', 'sequence', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    sequence = db.Column(db.Integer, nullable=False)
+    current_player_name = db.Column(db.String(25))
+    finished = db.Column(db.Boolean)
+    x_mask = db.Column(BitBoard)
+    o_mask = db.Column(BitBoard)
+    dead_lines = db.Column(BitBoard)
+    game_id = db.Column(db.Integer, db.ForeignKey('game.id'))
+
+    game = db.relationship(
+        'Game',
+        foreign_keys=game_id,
+        backref=db.backref('snapshots', lazy="dynamic")
+    )
+
+    def __init__(self, game):
+        self.game = game
+        self.sequence = game.move_count
+        self.current_player_name = game.current_player_name
+        self.finished = game.finished
+        self.x_mask = game.x_mask
+        self.o_mask = game.o_mask
+        self.dead_lines = game.dead_lines
+
+
+class ArchivedGame(db.Model):
+    """A finished game moved out of the live tables, in a single row.
+
+    The row holds everything a finished game is read for, including the
+    Slack ids of its team, channel and players, so history is read without
+    joining any of the live tables.
+    """
+
+    __tablename__ = "game_archive"
+    id = db.Column(db.Integer, primary_key=True)
+    game_id = db.Column(db.Integer)
+    team_id = db.Column(db.String(20))
+    channel_id = db.Column(db.String(20))
+    player1_user_id = db.Column(db.String(20))
+    player1_name = db.Column(db.String(25))
+    player2_user_id = db.Column(db.String(20))
+    player2_name = db.Column(db.String(25))
+    winner_name = db.Column(db.String(25))
+    result = db.Column(db.String(10))
+    board_size = db.Column(db.Integer)
+    win_length = db.Column(db.Integer)
+    x_mask = db.Column(BitBoard)
+    o_mask = db.Column(BitBoard)
+    move_count = db.Column(db.Integer)
+    moves = db.Column(db.Text)
+    first_move_at = db.Column(db.DateTime)
+    last_move_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime)
+
+
+class PlayerRecord(db.Model):
+    """A player's wins, losses and draws in a channel or in a whole team.
+
+    Team-wide records have an empty channel_id. Records are keyed by Slack
+    ids, so they outlive the games they were counted from.
+    """
+
+    __tablename__ = "player_record"
+    __table_args__ = (
+        db.Index('uq_player_record_team_id_channel_id_user_id',
+                 'team_id', 'channel_id', 'user_id', unique=True),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    team_id = db.Column(db.String(20), nullable=False)
+    channel_id = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.String(20), nullable=False)
+    user_name = db.Column(db.String(25))
+    wins = db.Column(db.Integer, nullable=False, default=0)
+    losses = db.Column(db.Integer, nullable=False, default=0)
+    draws = db.Column(db.Integer, nullable=False, default=0)
+
+
+class TeamShard(db.Model):
+    """The shard a team's rows are kept on.
+
+    Rows of this table only live in the default database. A team that is
+    being moved to another shard is marked as moving until it has arrived.
+    """
+
+    __tablename__ = "team_shard"
+    id = db.Column(db.Integer, primary_key=True)
+    team_id = db.Column(db.String(20), nullable=False, unique=True)
+    shard = db.Column(db.String(50), nullable=False)
+    moving = db.Column(db.Boolean, nullable=False, default=False)
 
 
 class Player(db.Model):
     __tablename__ = "player"
+    __table_args__ = (
+        db.Index('uq_player_channel_id_user_id',
+                 'channel_id', 'user_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.String(20), index=True)
+    user_id = db.Column(db.String(20))
     user_name = db.Column(db.String(25), index=True)
+    # The game the player is playing in the channel. It is not a foreign
+    # key, so that game and player rows do not depend on each other, and it
+    # is cleared in the transaction that finishes the game.
+    active_game_id = db.Column(db.Integer)
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'))
 
     channel = db.relationship(
@@ -90,6 +307,8 @@ class Challenge(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     opponent_name = db.Column(db.String(25))
     expired = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, index=True)
+    version = db.Column(db.Integer, nullable=False)
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'))
     challenger_id = db.Column(db.Integer, db.ForeignKey('player.id'))
 
@@ -104,16 +323,19 @@ class Challenge(db.Model):
         backref=db.backref('challenges', lazy="dynamic")
     )
 
+    __mapper_args__ = {"version_id_col": version}
+
     def __init__(self, opponent_name, channel, challenger):
         self.opponent_name = opponent_name
         self.channel = channel
         self.challenger = challenger
+        self.created_at = datetime.utcnow()
 
 
 class Team(db.Model):
     __tablename__ = "team"
     id = db.Column(db.Integer, primary_key=True)
-    team_id = db.Column(db.String(20), index=True)
+    team_id = db.Column(db.String(20), index=True, unique=True)
 
     def __init__(self, team_id):
         self.team_id = team_id
@@ -121,8 +343,12 @@ class Team(db.Model):
 
 class Channel(db.Model):
     __tablename__ = "channel"
+    __table_args__ = (
+        db.Index('uq_channel_team_id_channel_id',
+                 'team_id', 'channel_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    channel_id = db.Column(db.String(20), index=True)
+    channel_id = db.Column(db.String(20))
     team_id = db.Column(db.Integer, db.ForeignKey('team.id'))
 
     team = db.relationship(
@@ -134,3 +360,28 @@ class Channel(db.Model):
     def __init__(self, channel_id, team):
         self.channel_id = channel_id
         self.team = team
+
+
+# The games of a channel are listed by status, and a user accepts the most
+# recent challenge addressed to them, so both are indexed by channel in
+# descending id order.
+db.Index('ix_game_channel_id_id', Game.channel_id, Game.id.desc())
+db.Index('ix_challenge_channel_id_opponent_name_id', Challenge.channel_id,
+         Challenge.opponent_name, Challenge.id.desc())
+
+# Turn timers load the deadlines of the games in progress when they start.
+db.Index('ix_game_turn_deadline', Game.turn_deadline)
+
+# History is read per channel and per player, newest first.
+db.Index('ix_game_archive_team_id_channel_id_id', ArchivedGame.team_id,
+         ArchivedGame.channel_id, ArchivedGame.id.desc())
+db.Index('ix_game_archive_team_id_player1_user_id_id', ArchivedGame.team_id,
+         ArchivedGame.player1_user_id, ArchivedGame.id.desc())
+db.Index('ix_game_archive_team_id_player2_user_id_id', ArchivedGame.team_id,
+         ArchivedGame.player2_user_id, ArchivedGame.id.desc())
+
+# A leaderboard is the first rows of this index for a channel or team, so
+# reading it costs the same however many players and games there are.
+db.Index('ix_player_record_ranking', PlayerRecord.team_id,
+         PlayerRecord.channel_id, PlayerRecord.wins.desc(),
+         PlayerRecord.losses, PlayerRecord.id)
@@ -0,0 +1,95 @@
+"""This module reports every active game of a team at once.
+
+Dashboards and overview bots that want the state of all of a team's
+channels would otherwise have to ask for each channel's status in turn. The
+games are instead read in one query, which joins each channel to its games
+in progress and their players, and are streamed as JSON lines while the rows
+arrive, so memory use stays flat however many games a team has.
+"""
+
+import json
+import os
+
+from flask import Response, abort, request, stream_with_context
+from sqlalchemy.orm import aliased
+
+from app import app, db
+from app.board import render_board
+from app.models import Channel, Game, Player, Team
+from app.shards import bind_team
+from app.writebehind import get_write_behind
+
+OVERVIEW_BATCH_SIZE = 500
+
+
+def active_games(team_id):
+    """Yields the state of every game that is being played in a team.
+
+    Args:
+        team_id: A string representing a Slack team's id
+
+    Returns:
+        A generator of dictionaries, one per active game, holding the
+        channel's id, the rendered board, the players, whose turn it is and
+        how many moves have been made.
+    """
+
+    player1 = aliased(Player)
+    player2 = aliased(Player)
+    rows = (db.session.query(Channel.channel_id, Game.id, Game.board_size,
+                             Game.x_mask, Game.o_mask,
+                             Game.current_player_name, Game.finished,
+                             Game.move_count, player1.user_name,
+                             player2.user_name)
+            .join(Team, Channel.team_id == Team.id)
+            .join(Game, Game.channel_id == Channel.id)
+            .join(player1, Game.player1_id == player1.id)
+            .join(player2, Game.player2_id == player2.id)
+            .filter(Team.team_id == team_id, Game.finished == False)
+            .order_by(Channel.channel_id, Game.id)
+            .execution_options(stream_results=True)
+            .yield_per(OVERVIEW_BATCH_SIZE))
+
+    buffer = get_write_behind()
+    for (channel_id, game_id, board_size, x_mask, o_mask, current_player_name,
+         finished, move_count, player1_name, player2_name) in rows:
+        state = buffer.state(game_id) if buffer != None else None
+        if state != None:
+            x_mask = state["x_mask"]
+            o_mask = state["o_mask"]
+            current_player_name = state["current_player_name"]
+            finished = state["finished"]
+            move_count = state["move_count"]
+        # A game buffered by write-behind may have ended since it was
+        # last written.
+        if finished:
+            continue
+        yield {
+            "channel_id": channel_id,
+            "game_id": game_id,
+            "board": render_board(board_size, x_mask, o_mask),
+            "player1": player1_name,
+            "player2": player2_name,
+            "current_player": current_player_name,
+            "move_count": move_count
+        }
+
+
+@app.route('/teams/<team_id>/games', methods=['GET'])
+def active_games_endpoint(team_id):
+    """Streams the active games of a team as JSON lines.
+
+    The request has to carry the app's Slack token as its token parameter.
+    """
+
+    if request.args.get('token') != os.environ['SLACK_TOKEN']:
+        abort(403)
+    if not bind_team(team_id):
+        abort(503)
+
+    def generate():
+        for game in active_games(team_id):
+            yield json.dumps(game) + "\n"
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
@@ -0,0 +1,234 @@
+"""This module turns away commands from teams and users sending too many.
+
+With RATE_LIMITS_ENABLED, every command takes a token from two buckets, one
+of its user and one of its team, both for the command's type as grouped by
+metrics.command_type(). A bucket holds up to a burst of tokens and refills
+at a steady rate, both set per command type in RATE_LIMITS. A command that
+finds either bucket empty is answered with RATE_LIMITED_ERROR before the
+database is touched.
+
+Buckets are kept in memory by default, so each process enforces the limits
+on its own. With RATE_LIMIT_FILE set, they are kept in a file mapped into
+every process of the host instead, so the limits hold across all gunicorn
+workers. RATE_LIMIT_BACKEND can also be any object with the take(key, rate,
+burst) and give_back(key, burst) methods of these.
+"""
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from app import app
+from app.cache import LRUCache
+from app.constants import RATE_LIMIT_BUCKETS, RATE_LIMIT_SLOTS
+from app.metrics import registry
+
+# A slot of the shared file: the key's hash, the tokens left and when they
+# were counted.
+SLOT = struct.Struct("<Qdd")
+
+_backend_lock = threading.Lock()
+
+
+class TokenBuckets(object):
+    """Token buckets kept in the memory of one process.
+
+    The least recently used buckets are dropped once there are more than
+    maxsize of them. A dropped bucket starts full when it is used again, as
+    it would have refilled anyway unless its user kept sending commands.
+    """
+
+    def __init__(self, maxsize=RATE_LIMIT_BUCKETS, timer=time.time):
+        self._buckets = LRUCache(maxsize)
+        self._timer = timer
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, rate, burst):
+        """Takes a token from a bucket.
+
+        Args:
+            key: A string naming the bucket
+            rate: A number representing how many tokens are added per second
+            burst: An integer representing the most tokens the bucket holds
+
+        Returns:
+            A boolean representing whether there was a token to take.
+        """
+
+        now = self._timer()
+        with self._lock:
+            (tokens, counted_at) = self._buckets.get(key, (burst, now))
+            (allowed, tokens) = _take(tokens, now - counted_at, rate, burst)
+            self._buckets.set(key, (tokens, now))
+        return allowed
+
+    def give_back(self, key, burst):
+        """Returns a token taken from a bucket by a command that was refused.
+
+        Args:
+            key: A string naming the bucket
+            burst: An integer representing the most tokens the bucket holds
+        """
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket != None:
+                (tokens, counted_at) = bucket
+                self._buckets.set(key, (min(burst, tokens + 1), counted_at))
+
+
+class SharedTokenBuckets(object):
+    """Token buckets kept in a file shared by the processes of a host.
+
+    The file is a table of fixed-size slots mapped into memory. A bucket
+    lives in the slot its key hashes to and is updated under a lock on that
+    slot's bytes alone, so processes only wait for each other on the same
+    bucket. Two keys hashing to the same slot share it; the slot keeps the
+    hash of its key, and a bucket finding another key's hash there starts
+    full.
+
+    Attributes:
+        path: A string representing the path of the file
+    """
+
+    def __init__(self, path, slots=RATE_LIMIT_SLOTS, timer=time.time):
+        self.path = path
+        self._slots = slots
+        self._timer = timer
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * SLOT.size
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        # Record locks are held by the process, not the thread, so threads
+        # of one process take turns on this lock first.
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token from a bucket, like TokenBuckets.take."""
+        with self._slot(key) as (digest, offset):
+            now = self._timer()
+            (owner, tokens, counted_at) = SLOT.unpack_from(self._map, offset)
+            if owner != digest:
+                (tokens, counted_at) = (burst, now)
+            (allowed, tokens) = _take(tokens, now - counted_at, rate, burst)
+            SLOT.pack_into(self._map, offset, digest, tokens, now)
+        return allowed
+
+    def give_back(self, key, burst):
+        """Returns a token to a bucket, like TokenBuckets.give_back."""
+        with self._slot(key) as (digest, offset):
+            (owner, tokens, counted_at) = SLOT.unpack_from(self._map, offset)
+            if owner == digest:
+                SLOT.pack_into(self._map, offset, digest,
+                               min(burst, tokens + 1), counted_at)
+
+    @contextmanager
+    def _slot(self, key):
+        """Locks the slot of a key and yields its hash and offset."""
+        digest = int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+        offset = (digest % self._slots) * SLOT.size
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOT.size, offset)
+            try:
+                yield (digest, offset)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, SLOT.size, offset)
+
+    def close(self):
+        """Unmaps and closes the file."""
+        self._map.close()
+        os.close(self._fd)
+
+
+def _take(tokens, elapsed, rate, burst):
+    """Refills a bucket for the time elapsed and takes a token if it can.
+
+    Returns:
+        A tuple (allowed, tokens) of whether a token was taken and how many
+        are left.
+    """
+
+    tokens = min(burst, tokens + max(elapsed, 0) * rate)
+    if tokens >= 1:
+        return (True, tokens - 1)
+    return (False, tokens)
+
+
+def allow_command(team_id, user_id, command):
+    """Returns whether a command is within its team's and user's limits.
+
+    The user's bucket is tried first, so a single user sending too many
+    commands does not use up the tokens of their team. A command refused by
+    its team's bucket gives its user's token back, so it does not count
+    against the user either.
+
+    Args:
+        team_id: A string representing a Slack team's id
+        user_id: A string representing a Slack user's id
+        command: A string representing the type of the command
+
+    Returns:
+        A boolean, always True when rate limits are disabled or the command's
+        type has no limits.
+    """
+
+    if not app.config.get('RATE_LIMITS_ENABLED'):
+        return True
+    limits = app.config['RATE_LIMITS']
+    limits = limits.get(command, limits.get('default'))
+    if not limits:
+        return True
+
+    backend = get_rate_limit_backend()
+    taken = []
+    for (scope, key) in (("user", u"{0}:{1}".format(team_id, user_id)),
+                         ("team", team_id)):
+        limit = limits.get(scope)
+        if limit == None:
+            continue
+        (per_minute, burst) = limit
+        key = u"{0}:{1}:{2}".format(scope, command, key)
+        if not backend.take(key, per_minute / 60.0, burst):
+            for (key, burst) in taken:
+                backend.give_back(key, burst)
+            registry.increment("ratelimit.rejected")
+            registry.increment("ratelimit.rejected.{0}.{1}"
+                               .format(scope, command))
+            return False
+        taken.append((key, burst))
+    return True
+
+
+def get_rate_limit_backend():
+    """Returns the configured buckets, which default to TokenBuckets.
+
+    The buckets are SharedTokenBuckets in RATE_LIMIT_FILE when that is set.
+    """
+
+    backend = app.config.get('RATE_LIMIT_BACKEND')
+    if backend == None:
+        with _backend_lock:
+            backend = app.config.get('RATE_LIMIT_BACKEND')
+            if backend == None:
+                path = app.config.get('RATE_LIMIT_FILE')
+                backend = (SharedTokenBuckets(path) if path
+                           else TokenBuckets())
+                app.config['RATE_LIMIT_BACKEND'] = backend
+    return backend
+
+
+def _bucket_count():
+    backend = app.config.get('RATE_LIMIT_BACKEND')
+    return len(backend) if isinstance(backend, TokenBuckets) else None
+
+
+registry.set_gauge("ratelimit.buckets", _bucket_count)
@@ -0,0 +1,333 @@
+"""This module spreads teams over several databases.
+
+Besides the database at DATABASE_URL, which is the shard named 'default',
+SHARDS names any number of other databases. A team lives on exactly one
+shard, with its channels, players, challenges, games, records and archived
+games, so a command never needs more than one. The default database also
+keeps the team_shard directory of which shard each team lives on. A team
+seen for the first time is placed on the shard a HashRing picks for its id,
+unless its rows are already in the default database from before sharding,
+and it stays there until it is moved.
+
+Commands and the per-team endpoints bind the session of their thread to the
+team's shard before they touch the database. Each shard has its own engine
+and connection pool, created by Flask-SQLAlchemy from SQLALCHEMY_BINDS.
+Lookups in the directory are cached for SHARD_CACHE_TTL seconds.
+
+`python manage.py move_team` moves a team to another shard. The team is
+marked as moving, and its commands are refused, for as long as its rows are
+copied in batches. The directory is then pointed at the new shard and the
+old rows are deleted. Copied rows keep their order, as their ids are
+shifted past the highest ids of the new shard.
+
+Write-behind and turn timers keep games by id in each process, so they
+cannot be used along with SHARDS.
+"""
+
+import time
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from app.cache import TTLCache
+from app.constants import SHARD_CACHE_SIZE, SHARD_CACHE_TTL, MOVE_BATCH_SIZE
+from app.hashring import HashRing
+from app.models import TeamShard
+
+DEFAULT_SHARD = "default"
+
+# Maps a team's Slack id to a tuple (shard, moving).
+directory_cache = TTLCache(SHARD_CACHE_SIZE, SHARD_CACHE_TTL)
+
+_rings = {}
+
+
+def shard_names():
+    """Returns the names of every shard, the default one first."""
+    return [DEFAULT_SHARD] + sorted(app.config.get('SHARDS') or ())
+
+
+def shard_engine(shard):
+    """Returns the engine of a shard."""
+    if shard == DEFAULT_SHARD:
+        return db.engine
+    if shard not in (app.config.get('SHARDS') or ()):
+        raise ValueError("Unknown shard %r" % shard)
+    return db.get_engine(app, bind=shard)
+
+
+def bind_shard(shard):
+    """Makes the session of the current thread use a shard's database.
+
+    A session that was using another shard is removed first, so objects of
+    different shards never share an identity map. Call this before the
+    session is used by a command.
+    """
+
+    engine = shard_engine(shard)
+    if db.session.registry.has():
+        if db.session.bind is engine:
+            return
+        db.session.remove()
+    elif shard == DEFAULT_SHARD:
+        return
+    binds = dict((table, engine) for table in db.metadata.tables.values())
+    binds[TeamShard.__table__] = db.engine
+    db.session.registry.set(db.create_session({'bind': engine,
+                                               'binds': binds}))
+
+
+def bind_team(team_id):
+    """Binds the session of the current thread to a team's shard.
+
+    Does nothing when there are no shards besides the default one.
+
+    Returns:
+        A boolean, False if the team is being moved and must not be touched.
+    """
+
+    if not app.config.get('SHARDS'):
+        return True
+    if app.config.get('WRITE_BEHIND') or app.config.get('TURN_TIMEOUT'):
+        raise RuntimeError("Write-behind and turn timers cannot be used "
+                           "with SHARDS")
+    (shard, moving) = locate_team(team_id)
+    if moving:
+        return False
+    bind_shard(shard)
+    return True
+
+
+def locate_team(team_id):
+    """Returns the shard a team lives on, placing new teams.
+
+    Returns:
+        A tuple (shard, moving) of the shard's name and whether the team is
+        being moved away from it.
+    """
+
+    entry = directory_cache.get(team_id)
+    if entry == None:
+        entry = _read_directory(team_id)
+        if entry == None:
+            entry = _place_team(team_id)
+        directory_cache.set(team_id, entry)
+    return entry
+
+
+def _read_directory(team_id):
+    table = TeamShard.__table__
+    row = db.engine.execute(select([table.c.shard, table.c.moving])
+                            .where(table.c.team_id == team_id)).first()
+    return (row[0], row[1]) if row != None else None
+
+
+def _place_team(team_id):
+    """Adds a team to the directory and returns its entry."""
+    team = db.metadata.tables['team']
+    names = tuple(shard_names())
+    shard = DEFAULT_SHARD
+    # Teams that played before there were shards are in the default database.
+    if db.engine.execute(select([team.c.id])
+                         .where(team.c.team_id == team_id)).first() == None:
+        ring = _rings.get(names)
+        if ring == None:
+            ring = _rings[names] = HashRing(names)
+        shard = ring.get(team_id)
+    try:
+        db.engine.execute(TeamShard.__table__.insert(), team_id=team_id,
+                          shard=shard, moving=False)
+    except IntegrityError:
+        # Another process placed the team first.
+        return _read_directory(team_id)
+    return (shard, False)
+
+
+def _set_directory(team_id, shard, moving):
+    table = TeamShard.__table__
+    db.engine.execute(table.update()
+                      .where(table.c.team_id == team_id)
+                      .values(shard=shard, moving=moving))
+    directory_cache.invalidate(team_id)
+
+
+def _team_tables(team_id):
+    """Returns how to find a team's rows in each table, parents first.
+
+    Returns:
+        A list of tuples (table, where, references), where where selects the
+        team's rows and references maps columns to the tables whose ids they
+        hold.
+    """
+
+    tables = db.metadata.tables
+    (team, channel, player, game) = (tables['team'], tables['channel'],
+                                     tables['player'], tables['game'])
+    team_ids = select([team.c.id]).where(team.c.team_id == team_id)
+    channel_ids = select([channel.c.id]).where(channel.c.team_id.in_(team_ids))
+    game_ids = select([game.c.id]).where(game.c.channel_id.in_(channel_ids))
+    player_refs = {"player_id": "player", "game_id": "game"}
+    return [
+        (team, team.c.team_id == team_id, {}),
+        (channel, channel.c.team_id.in_(team_ids), {"team_id": "team"}),
+        (player, player.c.channel_id.in_(channel_ids),
+         {"channel_id": "channel", "active_game_id": "game"}),
+        (game, game.c.channel_id.in_(channel_ids),
+         {"channel_id": "channel", "player1_id": "player",
+          "player2_id": "player"}),
+        (tables['challenge'], tables['challenge'].c.channel_id.in_(channel_ids),
+         {"channel_id": "channel", "challenger_id": "player"}),
+        (tables['piece'], tables['piece'].c.game_id.in_(game_ids),
+         player_refs),
+        (tables['move_event'], tables['move_event'].c.game_id.in_(game_ids),
+         player_refs),
+        (tables['game_snapshot'],
+         tables['game_snapshot'].c.game_id.in_(game_ids), {"game_id": "game"}),
+        (tables['player_record'],
+         tables['player_record'].c.team_id == team_id, {}),
+        (tables['game_archive'],
+         tables['game_archive'].c.team_id == team_id, {})
+    ]
+
+
+def move_team(team_id, target, batch_size=MOVE_BATCH_SIZE,
+              wait=SHARD_CACHE_TTL):
+    """Moves a team's rows to another shard.
+
+    The team is marked as moving and, after waiting for every process to
+    notice, its rows are copied table by table, batch_size rows at a time.
+    If copying fails, the copied rows are deleted again and the team stays
+    where it was. Otherwise the directory is pointed at the target and the
+    rows are deleted from the old shard.
+
+    Args:
+        team_id: A string representing a Slack team's id
+        target: A string representing the name of the shard to move to
+        batch_size: An integer representing how many rows to copy at a time
+        wait: A number representing how many seconds to wait for processes
+            to stop using the team's rows
+
+    Returns:
+        A dictionary of how many rows of each table were moved.
+    """
+
+    target_engine = shard_engine(target)
+    (source, moving) = _read_directory(team_id) or _place_team(team_id)
+    moved = {}
+    if source == target:
+        return moved
+    source_engine = shard_engine(source)
+
+    _set_directory(team_id, source, True)
+    try:
+        time.sleep(wait)
+        # Rows left behind by an earlier move that failed are removed first.
+        _delete_team(target_engine, team_id, batch_size)
+        tables = _team_tables(team_id)
+        offsets = dict((table.name, _offset(source_engine, target_engine,
+                                            table, where))
+                       for (table, where, references) in tables)
+        for (table, where, references) in tables:
+            moved[table.name] = _copy_rows(source_engine, target_engine,
+                                           table, where, references, offsets,
+                                           batch_size)
+    except Exception:
+        _delete_team(target_engine, team_id, batch_size)
+        _set_directory(team_id, source, False)
+        raise
+
+    _set_directory(team_id, target, False)
+    _delete_team(source_engine, team_id, batch_size)
+    return moved
+
+
+def _offset(source, target, table, where):
+    """Returns how far to shift the ids of a team's rows of a table.
+
+    The shifted ids start right after the highest id on the target. On
+    PostgreSQL the range they take up is reserved in the table's sequence
+    first, so rows other teams add to the target during the move get ids
+    above it.
+    """
+
+    (lowest, highest) = source.execute(
+        select([func.min(table.c.id), func.max(table.c.id)])
+        .where(where)).first()
+    if lowest == None:
+        return 0
+    if target.dialect.name == 'postgresql':
+        return _reserve_ids(target, table, highest - lowest + 1) - lowest
+    start = target.execute(select([func.max(table.c.id)])).scalar()
+    return (start or 0) + 1 - lowest
+
+
+def _reserve_ids(engine, table, count):
+    """Advances a PostgreSQL table's sequence past count new ids.
+
+    Inserts into the table wait while the first id is chosen, so it is above
+    both the table's highest id and every id the sequence handed out.
+
+    Returns:
+        The first of the reserved ids.
+    """
+
+    with engine.begin() as connection:
+        connection.execute("LOCK TABLE {0} IN EXCLUSIVE MODE"
+                           .format(table.name))
+        last = connection.execute(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "GREATEST((SELECT max(id) + 1 FROM {0}), "
+            "nextval(pg_get_serial_sequence('{0}', 'id'))) + {1})"
+            .format(table.name, count - 1)).scalar()
+    return last - count + 1
+
+
+def _copy_rows(source, target, table, where, references, offsets,
+               batch_size):
+    """Copies a team's rows of a table, shifting their ids and references.
+
+    Rows are copied from the highest id down. SQLite numbers new rows after
+    the highest id, so once the first batch takes up the top of the shifted
+    range, rows added to the target meanwhile get ids above it. PostgreSQL
+    hands out ids from sequences, which _offset advanced past the range.
+
+    Returns:
+        The number of rows copied.
+    """
+
+    copied = 0
+    last = None
+    while True:
+        query = select([table]).where(where)
+        if last != None:
+            query = query.where(table.c.id < last)
+        rows = source.execute(query.order_by(table.c.id.desc())
+                              .limit(batch_size)).fetchall()
+        if not rows:
+            return copied
+        values = []
+        for row in rows:
+            value = dict(row)
+            value["id"] += offsets[table.name]
+            for (column, parent) in references.items():
+                if value[column] != None:
+                    value[column] += offsets[parent]
+            values.append(value)
+        with target.begin() as connection:
+            connection.execute(table.insert(), values)
+        copied += len(rows)
+        last = rows[-1]["id"]
+
+
+def _delete_team(engine, team_id, batch_size):
+    """Deletes a team's rows from a shard, children first, in batches."""
+    for (table, where, references) in reversed(_team_tables(team_id)):
+        while True:
+            ids = [row[0] for row in engine.execute(
+                select([table.c.id]).where(where).limit(batch_size))]
+            if not ids:
+                break
+            with engine.begin() as connection:
+                connection.execute(table.delete()
+                                   .where(table.c.id.in_(ids)))
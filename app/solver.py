@@ -0,0 +1,314 @@
+"""This module chooses the moves of the built-in bot opponent.
+
+Positions are searched with negamax and alpha-beta pruning from the point of
+view of the player to move, so a position is just the pair of bitmasks
+(mine, theirs). Positions that are rotations or reflections of each other
+have the same value, so the transposition table is keyed by a canonical form
+that folds the 8 symmetries of the square board together.
+
+Boards of up to PERFECT_PLAY_CELLS squares are solved completely once, and
+the bot then only looks up the values of the positions its moves lead to.
+The move chosen in each exact position is remembered as well, so a repeated
+position costs a single dictionary lookup.
+Larger boards are searched with iterative deepening until BOT_MOVE_BUDGET
+runs out, with a heuristic score at the depth limit and a bounded table.
+"""
+
+import time
+
+from app.board import (cell_bit, line_masks, winning_move, mark_dead_lines,
+                       all_lines_dead)
+from app.cache import LRUCache
+from app.constants import (BOARD_SIZE, WIN_LENGTH, PERFECT_PLAY_CELLS,
+                           BOT_MOVE_BUDGET, BOT_TABLE_SIZE)
+
+WIN_SCORE = 1 << 20
+
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+_solvers = {}
+
+
+class SearchTimeout(Exception):
+    """Raised inside a search when its time budget has run out."""
+
+
+class Symmetries(object):
+    """Maps bitmasks onto their images under the 8 symmetries of a board.
+
+    Each symmetry is applied a byte at a time through lookup tables, so
+    transforming a mask costs one table lookup per 8 squares.
+
+    Attributes:
+        board_size: An integer representing the width of the board
+    """
+
+    def __init__(self, board_size):
+        self.board_size = board_size
+        n = board_size
+        transforms = [
+            lambda x, y: (x, y),
+            lambda x, y: (y, n - 1 - x),
+            lambda x, y: (n - 1 - x, n - 1 - y),
+            lambda x, y: (n - 1 - y, x),
+            lambda x, y: (x, n - 1 - y),
+            lambda x, y: (n - 1 - x, y),
+            lambda x, y: (y, x),
+            lambda x, y: (n - 1 - y, n - 1 - x)
+        ]
+        cells = n * n
+        self._tables = []
+        for transform in transforms:
+            images = [cell_bit(*(transform(*divmod(cell, n)) + (n,)))
+                      for cell in range(cells)]
+            chunks = []
+            for start in range(0, cells, 8):
+                table = []
+                for byte in range(256):
+                    image = 0
+                    for bit in range(8):
+                        if byte >> bit & 1 and start + bit < cells:
+                            image |= images[start + bit]
+                    table.append(image)
+                chunks.append(table)
+            self._tables.append(chunks)
+
+    def apply(self, index, mask):
+        """Returns the image of a mask under one of the symmetries."""
+        image = 0
+        for table in self._tables[index]:
+            image |= table[mask & 0xff]
+            mask >>= 8
+        return image
+
+    def canonical(self, mine, theirs):
+        """Returns a key shared by every symmetric variant of a position."""
+        shift = self.board_size * self.board_size
+        return min((self.apply(index, mine) << shift) |
+                   self.apply(index, theirs) for index in range(8))
+
+
+class Solver(object):
+    """Finds the best move of a position on one kind of board.
+
+    Attributes:
+        board_size: An integer representing the width of the board
+        win_length: An integer representing how many pieces in a row win
+        perfect: A boolean representing whether the board has been solved
+            completely
+    """
+
+    def __init__(self, board_size, win_length=None):
+        self.board_size = board_size
+        self.win_length = (win_length if win_length != None
+                           else board_size)
+        self.cells = board_size * board_size
+        self.lines = line_masks(board_size, self.win_length)
+        self.symmetries = Symmetries(board_size)
+        center = (board_size - 1) / 2.0
+        self.order = sorted(range(self.cells), key=lambda cell: (
+            abs(cell // board_size - center) + abs(cell % board_size - center)))
+        self.perfect = self.cells <= PERFECT_PLAY_CELLS
+        if self.perfect:
+            self.table = {}
+            self.best_moves = {}
+            self._solve(0, 0, 0)
+        else:
+            self.table = LRUCache(BOT_TABLE_SIZE)
+
+    def best_move(self, mine, theirs, dead_lines, budget=BOT_MOVE_BUDGET):
+        """Returns the best square for the player to move.
+
+        Args:
+            mine: An integer bitmask of the squares of the player to move
+            theirs: An integer bitmask of the squares of the opponent
+            dead_lines: An integer of the lines that can no longer be won
+            budget: A number representing how many seconds a search of a
+                large board may take
+
+        Returns:
+            A tuple (x, y) of the chosen square, or None if the board is full.
+        """
+
+        moves = self._moves(mine | theirs)
+        if not moves:
+            return None
+        if self.perfect:
+            best = self.best_moves.get((mine, theirs))
+            if best == None:
+                best = divmod(max(moves, key=lambda cell: self._child_value(
+                    mine, theirs, dead_lines, cell, None)), self.board_size)
+                self.best_moves[(mine, theirs)] = best
+            return best
+
+        # Each completed depth reorders the moves for the next one, so the
+        # best move so far is searched first and pruning improves.
+        deadline = time.time() + budget
+        best = moves[0]
+        depth = 1
+        try:
+            while depth <= len(moves):
+                values = {}
+                alpha = -WIN_SCORE - 1
+                for cell in moves:
+                    value = self._child_value(mine, theirs, dead_lines, cell,
+                                              depth - 1, deadline, alpha)
+                    values[cell] = value
+                    alpha = max(alpha, value)
+                moves.sort(key=lambda cell: -values[cell])
+                best = moves[0]
+                if abs(values[best]) > WIN_SCORE // 2:
+                    break
+                depth += 1
+        except SearchTimeout:
+            pass
+        return divmod(best, self.board_size)
+
+    def _moves(self, occupied):
+        return [cell for cell in self.order if not occupied >> cell & 1]
+
+    def _child_value(self, mine, theirs, dead_lines, cell, depth,
+                     deadline=None, alpha=-WIN_SCORE - 1, beta=WIN_SCORE + 1):
+        """Returns the value of a move for the player making it.
+
+        With depth None the value is taken from the solved table, otherwise
+        the resulting position is searched to that depth. The window passed
+        on is widened by one because values decay by one per move.
+        """
+
+        (x, y) = divmod(cell, self.board_size)
+        mine |= 1 << cell
+        if winning_move(mine, x, y, self.board_size, self.win_length):
+            return WIN_SCORE
+        dead_lines = mark_dead_lines(dead_lines, mine, theirs, x, y,
+                                     self.board_size, self.win_length)
+        if all_lines_dead(dead_lines, self.board_size, self.win_length):
+            return 0
+        if depth == None:
+            value = self._solve(theirs, mine, dead_lines)
+        else:
+            value = self._search(theirs, mine, dead_lines, depth, deadline,
+                                 -beta - 1, -alpha + 1)
+        return _decay(-value)
+
+    def _solve(self, mine, theirs, dead_lines):
+        """Computes the exact value of every position reachable from one."""
+        key = self.symmetries.canonical(mine, theirs)
+        value = self.table.get(key)
+        if value != None:
+            return value
+        value = -WIN_SCORE - 1
+        for cell in self._moves(mine | theirs):
+            (x, y) = divmod(cell, self.board_size)
+            after = mine | 1 << cell
+            if winning_move(after, x, y, self.board_size, self.win_length):
+                child = WIN_SCORE
+            else:
+                dead = mark_dead_lines(dead_lines, after, theirs, x, y,
+                                       self.board_size, self.win_length)
+                if all_lines_dead(dead, self.board_size, self.win_length):
+                    child = 0
+                else:
+                    child = _decay(-self._solve(theirs, after, dead))
+            value = max(value, child)
+        self.table[key] = value
+        return value
+
+    def _search(self, mine, theirs, dead_lines, depth, deadline, alpha,
+                beta):
+        """Returns the depth-limited negamax value of a position."""
+        if deadline != None and time.time() > deadline:
+            raise SearchTimeout()
+        if depth == 0:
+            return self._evaluate(mine, theirs)
+
+        key = self.symmetries.canonical(mine, theirs)
+        entry = self.table.get(key)
+        if entry != None and entry[0] >= depth:
+            (entry_depth, value, flag) = entry
+            if flag == EXACT:
+                return value
+            if flag == LOWER:
+                alpha = max(alpha, value)
+            elif flag == UPPER:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+
+        original_alpha = alpha
+        best = -WIN_SCORE - 1
+        for cell in self._moves(mine | theirs):
+            value = self._child_value(mine, theirs, dead_lines, cell,
+                                      depth - 1, deadline, alpha, beta)
+            best = max(best, value)
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best <= original_alpha:
+            flag = UPPER
+        elif best >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.set(key, (depth, best, flag))
+        return best
+
+    def _evaluate(self, mine, theirs):
+        """Scores a position by the open lines each player has started."""
+        score = 0
+        for line in self.lines:
+            if line & theirs == 0:
+                count = bin(line & mine).count("1")
+                score += count * count
+            elif line & mine == 0:
+                count = bin(line & theirs).count("1")
+                score -= count * count
+        return score
+
+
+def _decay(value):
+    """Moves a value one step towards 0 for every move it lies ahead.
+
+    This makes quicker wins and slower losses score better.
+    """
+
+    if value > 0:
+        return value - 1
+    if value < 0:
+        return value + 1
+    return 0
+
+
+def get_solver(board_size, win_length=None):
+    """Returns the solver of a kind of board, creating it on first use."""
+    key = (board_size, win_length if win_length != None else board_size)
+    solver = _solvers.get(key)
+    if solver == None:
+        solver = _solvers.setdefault(key, Solver(*key))
+    return solver
+
+
+def choose_move(game, player):
+    """Returns the square the bot picks for a player of a game.
+
+    Args:
+        game: A Game object
+        player: The Player object the bot is playing as
+
+    Returns:
+        A tuple (x, y) of the chosen square.
+    """
+
+    mine = game.player_mask(player)
+    theirs = (game.x_mask | game.o_mask) & ~mine
+    solver = get_solver(game.board_size, game.win_length)
+    return solver.best_move(mine, theirs, game.dead_lines)
+
+
+# The standard board is solved when the app starts, so that the first bot
+# move does not pay for it.
+if BOARD_SIZE * BOARD_SIZE <= PERFECT_PLAY_CELLS:
+    get_solver(BOARD_SIZE, WIN_LENGTH)
@@ -0,0 +1,220 @@
+"""This module keeps every player's record of wins, losses and draws.
+
+Records are counted as games finish, in the transaction that finishes them,
+so no request ever aggregates past games. Each player has one record per
+channel and one for the whole team. Both are updated with a single UPDATE
+that adds to the counts. A record is only inserted by the player's first
+finished game. Leaderboards are read from the first rows of an index ordered
+by wins, so reading one costs the same however long a team has played.
+
+The bot keeps no record of its own, but games against it count for the
+people who play it.
+
+The records can be recomputed from the archive and the finished games still
+in the live tables with `python manage.py rebuild_stats`.
+"""
+
+from sqlalchemy import and_
+
+from app import db
+from app.archive import game_result, DRAW
+from app.constants import BOT_USER_ID, LEADERBOARD_SIZE
+from app.models import ArchivedGame, Channel, Game, PlayerRecord
+
+# The channel_id of a team-wide record.
+TEAM_SCOPE = ""
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def record_result(game):
+    """Counts a finished game in its players' records.
+
+    The records are changed in the session, not committed, so they are
+    committed along with the move or forfeit that finished the game.
+
+    Args:
+        game: A finished Game object
+    """
+
+    (result, winner_name) = game_result(game)
+    team_id = game.channel.team.team_id
+    channel_id = game.channel.channel_id
+    for player in (game.player1, game.player2):
+        if player.user_id == BOT_USER_ID:
+            continue
+        if result == DRAW:
+            counts = (0, 0, 1)
+        elif player.user_name == winner_name:
+            counts = (1, 0, 0)
+        else:
+            counts = (0, 1, 0)
+        _count(team_id, channel_id, player.user_id, player.user_name, *counts)
+
+
+def record_results(game_ids):
+    """Counts finished games that were written without going through the ORM.
+
+    The games are read back with their channels and players in one query.
+    """
+
+    games = (Game.query
+             .options(db.joinedload(Game.channel).joinedload(Channel.team),
+                      db.joinedload(Game.player1),
+                      db.joinedload(Game.player2))
+             .filter(Game.id.in_(game_ids), Game.finished == True)
+             .populate_existing())
+    for game in games:
+        record_result(game)
+
+
+def _count(team_id, channel_id, user_id, user_name, wins, losses, draws):
+    """Adds to a player's channel and team records, creating missing ones."""
+    table = PlayerRecord.__table__
+    scopes = (channel_id, TEAM_SCOPE)
+    where = and_(table.c.team_id == team_id, table.c.user_id == user_id,
+                 table.c.channel_id.in_(scopes))
+    updated = db.session.execute(
+        table.update()
+        .where(where)
+        .values(wins=table.c.wins + wins, losses=table.c.losses + losses,
+                draws=table.c.draws + draws, user_name=user_name)).rowcount
+    if updated == len(scopes):
+        return
+
+    # A record created by a concurrent game makes this insert fail on the
+    # unique index, and the command is retried.
+    existing = set(scope for (scope,) in
+                   db.session.execute(db.select([table.c.channel_id])
+                                      .where(where)))
+    db.session.execute(table.insert(), [
+        {"team_id": team_id, "channel_id": scope, "user_id": user_id,
+         "user_name": user_name, "wins": wins, "losses": losses,
+         "draws": draws}
+        for scope in scopes if scope not in existing
+    ])
+
+
+def player_stats(team_id, channel_id, user_id):
+    """Returns a player's records in a channel and in its team.
+
+    Returns:
+        A tuple (channel_record, team_record) of PlayerRecord objects, either
+        of which is None if the player has not finished a game there.
+    """
+
+    records = dict((record.channel_id, record) for record in
+                   PlayerRecord.query.filter(
+                       PlayerRecord.team_id == team_id,
+                       PlayerRecord.user_id == user_id,
+                       PlayerRecord.channel_id.in_((channel_id, TEAM_SCOPE))))
+    return (records.get(channel_id), records.get(TEAM_SCOPE))
+
+
+def leaderboard(team_id, channel_id=TEAM_SCOPE, size=LEADERBOARD_SIZE):
+    """Returns the best players of a channel, or of a team.
+
+    Players are ranked by wins, then by fewest losses.
+
+    Args:
+        team_id: A string representing a Slack team's id
+        channel_id: A string representing a Slack channel's id, or TEAM_SCOPE
+            for the whole team
+        size: An integer representing how many players to return
+
+    Returns:
+        A list of PlayerRecord objects, best first.
+    """
+
+    return (PlayerRecord.query
+            .filter(PlayerRecord.team_id == team_id,
+                    PlayerRecord.channel_id == channel_id)
+            .order_by(PlayerRecord.wins.desc(), PlayerRecord.losses,
+                      PlayerRecord.id)
+            .limit(size)
+            .all())
+
+
+def rebuild_records(batch_size=REBUILD_BATCH_SIZE):
+    """Recomputes every record from the games that have finished.
+
+    Archived games and the finished games not archived yet are read in
+    batches, each starting after the last id of the previous one. The counts
+    are summed in memory, which grows with the number of players rather than
+    games, and replace the old records in a single transaction.
+
+    Returns:
+        The number of games counted.
+    """
+
+    totals = {}
+
+    def add(team_id, channel_id, user_id, user_name, won, drawn):
+        if user_id == BOT_USER_ID:
+            return
+        for scope in (channel_id, TEAM_SCOPE):
+            total = totals.setdefault((team_id, scope, user_id),
+                                      [user_name, 0, 0, 0])
+            total[0] = user_name
+            total[3 if drawn else 1 if won else 2] += 1
+
+    games = 0
+    last = 0
+    while True:
+        rows = (db.session.query(ArchivedGame.id, ArchivedGame.team_id,
+                                 ArchivedGame.channel_id,
+                                 ArchivedGame.player1_user_id,
+                                 ArchivedGame.player1_name,
+                                 ArchivedGame.player2_user_id,
+                                 ArchivedGame.player2_name,
+                                 ArchivedGame.winner_name,
+                                 ArchivedGame.result)
+                .filter(ArchivedGame.id > last)
+                .order_by(ArchivedGame.id)
+                .limit(batch_size)
+                .all())
+        for (archive_id, team_id, channel_id, player1_user_id, player1_name,
+             player2_user_id, player2_name, winner_name, result) in rows:
+            drawn = result == DRAW
+            add(team_id, channel_id, player1_user_id, player1_name,
+                winner_name == player1_name, drawn)
+            add(team_id, channel_id, player2_user_id, player2_name,
+                winner_name == player2_name, drawn)
+        games += len(rows)
+        if len(rows) < batch_size:
+            break
+        last = rows[-1][0]
+
+    last = 0
+    while True:
+        batch = (Game.query
+                 .options(db.joinedload(Game.channel).joinedload(Channel.team),
+                          db.joinedload(Game.player1),
+                          db.joinedload(Game.player2))
+                 .filter(Game.finished == True, Game.id > last)
+                 .order_by(Game.id)
+                 .limit(batch_size)
+                 .all())
+        for game in batch:
+            (result, winner_name) = game_result(game)
+            for player in (game.player1, game.player2):
+                add(game.channel.team.team_id, game.channel.channel_id,
+                    player.user_id, player.user_name,
+                    player.user_name == winner_name, result == DRAW)
+        db.session.expunge_all()
+        games += len(batch)
+        if len(batch) < batch_size:
+            break
+        last = batch[-1].id
+
+    table = PlayerRecord.__table__
+    db.session.execute(table.delete())
+    rows = [{"team_id": team_id, "channel_id": channel_id,
+             "user_id": user_id, "user_name": user_name, "wins": wins,
+             "losses": losses, "draws": draws}
+            for ((team_id, channel_id, user_id),
+                 (user_name, wins, losses, draws)) in totals.items()]
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[start:start + batch_size])
+    db.session.commit()
+    return games
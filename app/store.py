@@ -0,0 +1,592 @@
+"""This module keeps the state of the games that commands act on.
+
+The handlers in api.py reach their teams, channels, players, challenges and
+games only through the store returned by get_store(), which is chosen with
+GAME_STORE:
+
+- 'database', the default, keeps everything in the database named by
+  DATABASE_URL through the models, PostgreSQL in production. It is the only
+  store with write-behind, turn timers, the move log, housekeeping and the
+  history and overview endpoints.
+- 'sqlite' is the database store for a single node with a SQLite file. Its
+  connections use write-ahead logging, so readers do not block the writer,
+  and wait for the file's lock instead of failing when it is held.
+- 'memory' keeps everything in the memory of the process. It issues no SQL
+  at all, which makes it a fast stand-in for tests and benchmarks, and loses
+  every game when the process exits.
+
+Every store hands out objects with the attributes of the models the handlers
+use, such as game.player1.user_name or channel.team.team_id, and games share
+the board methods of GameBoard. The rules of a move are the same for every
+store and live in advance().
+"""
+
+from abc import ABCMeta, abstractmethod
+from datetime import datetime
+import itertools
+import threading
+
+from sqlalchemy import event
+
+from app import app, db
+from app.archive import game_result, WIN, DRAW
+from app.board import winning_move, all_lines_dead
+from app.constants import (BOARD_SIZE, WIN_LENGTH, BOT_NAME, BOT_USER_ID,
+                           LEADERBOARD_SIZE, SQLITE_BUSY_TIMEOUT)
+from app.context import (GameContext, load_context, forget_context,
+                         claim_players, release_players)
+from app.events import log_move
+from app.housekeeping import challenge_cutoff, expire_challenges
+from app.models import (Team, Channel, Player, Game, Piece, Challenge,
+                        GameBoard)
+from app.stats import record_result, player_stats, leaderboard, TEAM_SCOPE
+from app.timers import start_turn
+from app.writebehind import get_write_behind
+
+_store_lock = threading.Lock()
+
+
+def advance(game, player, x, y):
+    """Ends a game or passes the turn after a player placed a piece.
+
+    A game is over when the move wins it or when every line holds pieces of
+    both players, even if there are open squares left.
+
+    Args:
+        game: The game the piece was placed in
+        player: The player who placed it
+        x: An integer representing the x coordinate of the piece
+        y: An integer representing the y coordinate of the piece
+
+    Returns:
+        WIN or DRAW if the move ended the game, otherwise None.
+    """
+
+    if winning_move(game.player_mask(player), x, y, game.board_size,
+                    game.win_length):
+        game.finished = True
+        return WIN
+    if all_lines_dead(game.dead_lines, game.board_size, game.win_length):
+        game.finished = True
+        return DRAW
+    opponent = game.player1 if player == game.player2 else game.player2
+    game.current_player_name = opponent.user_name
+    return None
+
+
+class GameStore(object):
+    """The operations the handlers use to read and change games.
+
+    Changes made by create_challenge and create_game are saved before they
+    return. Moves are saved by save(), so that the bot's answer is saved
+    along with the move it answers. Every operation is abstract, so a store
+    that leaves one out cannot be created.
+    """
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def load(self, team_id, channel_id, user_id=None):
+        """Returns the GameContext a command of a user acts upon.
+
+        A context without a user has no player and no game.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_challenge(self, context, user_name, opponent_name):
+        """Adds a challenge from the context's user to another user."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def find_challenge(self, context, user_name, challenger_name=None):
+        """Returns the latest challenge to a user that has not expired.
+
+        Args:
+            context: A GameContext object for the challenged user
+            user_name: A string representing the challenged user's name
+            challenger_name: A string representing the name of the user
+                whose challenge to find, or None for any user
+
+        Returns:
+            A challenge, or None if there is none.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_busy(self, player):
+        """Returns whether a player is in a game that has not finished."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_game(self, context, user_name, starter, challenge=None,
+                    response_url=None):
+        """Starts a game, accepting a challenge or against the bot.
+
+        The challenger plays Xs against the context's user. Without a
+        challenge, the context's user plays Xs against the bot, which joins
+        the channel the first time it is challenged there.
+
+        Args:
+            context: A GameContext object for the calling user
+            user_name: A string representing the calling user's name
+            starter: A string representing the name of the first player
+            challenge: The challenge being accepted, which expires, or None
+            response_url: A string representing the URL to post later
+                results of the game to, or None
+
+        Returns:
+            The new game.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def apply_move(self, game, player, x, y, response_url=None):
+        """Places a piece and advances the game.
+
+        The result of a game the move finishes is counted in its players'
+        records, and they are free to start other games.
+
+        Returns:
+            WIN or DRAW if the move ended the game, otherwise None.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self):
+        """Saves the moves applied since the last save."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def discard(self):
+        """Drops unsaved changes after a command conflicted with another."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def channel_games(self, channel):
+        """Returns the unfinished games of a channel, oldest first."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def player_stats(self, team_id, channel_id, user_id):
+        """Returns a player's records in a channel and in its team.
+
+        Returns:
+            A tuple (channel_record, team_record), either of which is None if
+            the player has not finished a game there.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def leaderboard(self, team_id, channel_id=TEAM_SCOPE,
+                    size=LEADERBOARD_SIZE):
+        """Returns the records of the best players, by wins then losses."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire_challenges(self, now=None):
+        """Expires the challenges older than CHALLENGE_TTL.
+
+        Returns:
+            The number of challenges expired.
+        """
+        raise NotImplementedError
+
+
+class DatabaseStore(GameStore):
+    """Keeps games in the database through the models."""
+
+    def load(self, team_id, channel_id, user_id=None):
+        """Loads a context, laying buffered moves over its game."""
+        context = load_context(team_id, channel_id, user_id)
+        buffer = get_write_behind()
+        if buffer != None:
+            buffer.overlay(context.game)
+        return context
+
+    def create_challenge(self, context, user_name, opponent_name):
+        (channel, player) = self._join(context, user_name)
+        db.session.add(Challenge(opponent_name, channel, player))
+        db.session.commit()
+        self._forget_new(context)
+
+    def find_challenge(self, context, user_name, challenger_name=None):
+        if context.channel == None:
+            return None
+        challenges = context.channel.challenges.filter(
+            Challenge.opponent_name == user_name,
+            Challenge.expired == False,
+            Challenge.created_at >= challenge_cutoff())
+        if challenger_name != None:
+            challenges = (challenges.join(Challenge.challenger)
+                          .filter(Player.user_name == challenger_name))
+        return challenges.order_by(Challenge.id.desc()).first()
+
+    def is_busy(self, player):
+        if player.active_game_id == None:
+            return False
+        game = Game.query.get(player.active_game_id)
+        if game == None:
+            return False
+        buffer = get_write_behind()
+        if buffer != None:
+            buffer.overlay(game)
+        return not game.finished
+
+    def create_game(self, context, user_name, starter, challenge=None,
+                    response_url=None):
+        (channel, player) = self._join(context, user_name)
+        if challenge != None:
+            challenge.expired = True
+            players = (challenge.challenger, player)
+        else:
+            bot = channel.players.filter_by(user_id=BOT_USER_ID).first()
+            if bot == None:
+                bot = Player(BOT_USER_ID, BOT_NAME, channel)
+                db.session.add(bot)
+            players = (player, bot)
+
+        game = Game(BOARD_SIZE, starter, channel, players[0], players[1],
+                    WIN_LENGTH)
+        db.session.add(game)
+        db.session.flush()
+        claim_players(game, *players)
+        if response_url:
+            game.response_url = response_url
+        start_turn(game)
+        db.session.commit()
+        self._forget_new(context)
+        return game
+
+    def apply_move(self, game, player, x, y, response_url=None):
+        """Places a piece, logging the move and buffering it if enabled.
+
+        With write-behind, the records and players of a finished game are
+        updated when the buffer is flushed.
+        """
+
+        db.session.add(Piece(x, y, player, game))
+        outcome = advance(game, player, x, y)
+        if response_url:
+            game.response_url = response_url
+        start_turn(game)
+        log_move(game, player, x, y)
+        buffer = get_write_behind()
+        if buffer != None:
+            buffer.record_move(game, player, x, y)
+        elif game.finished:
+            record_result(game)
+            release_players([game.id])
+        return outcome
+
+    def save(self):
+        """Commits the moves made, unless write-behind has buffered them."""
+        if get_write_behind() != None:
+            db.session.rollback()
+        else:
+            db.session.commit()
+
+    def discard(self):
+        db.session.rollback()
+
+    def channel_games(self, channel):
+        """Returns the unfinished games of a channel, with their players.
+
+        Games that write-behind has finished but not written yet are left
+        out.
+        """
+
+        games = (channel.games
+                 .options(db.joinedload(Game.player1),
+                          db.joinedload(Game.player2))
+                 .filter(Game.finished == False)
+                 .order_by(Game.id)
+                 .all())
+        buffer = get_write_behind()
+        if buffer != None:
+            for game in games:
+                buffer.overlay(game)
+        return [game for game in games if not game.finished]
+
+    def player_stats(self, team_id, channel_id, user_id):
+        return player_stats(team_id, channel_id, user_id)
+
+    def leaderboard(self, team_id, channel_id=TEAM_SCOPE,
+                    size=LEADERBOARD_SIZE):
+        return leaderboard(team_id, channel_id, size)
+
+    def expire_challenges(self, now=None):
+        return expire_challenges(now)
+
+    def _join(self, context, user_name):
+        """Adds the context's team, channel and player if they are missing.
+
+        Returns:
+            A tuple (channel, player) of the Channel and Player objects.
+        """
+
+        channel = context.channel
+        if channel == None:
+            team = context.team
+            if team == None:
+                team = Team(context.team_id)
+                db.session.add(team)
+            channel = Channel(context.channel_id, team)
+            db.session.add(channel)
+        player = context.player
+        if player == None:
+            player = Player(context.user_id, user_name, channel)
+            db.session.add(player)
+        return (channel, player)
+
+    def _forget_new(self, context):
+        # Rows added by _join are not in the identity cache yet.
+        if context.channel == None or context.player == None:
+            forget_context(context.team_id, context.channel_id,
+                           context.user_id)
+
+
+class SqliteStore(DatabaseStore):
+    """Keeps games in a SQLite file, for deployments on a single node."""
+
+    def __init__(self, engine=None):
+        engine = engine if engine != None else db.engine
+        if engine.dialect.name != 'sqlite':
+            raise ValueError("The sqlite store needs a SQLite DATABASE_URL")
+        if not event.contains(engine, "connect", _configure_sqlite):
+            event.listen(engine, "connect", _configure_sqlite)
+            # Connections opened before the listener would keep the default
+            # journal, so they are closed. A database in memory only lives
+            # as long as its connections and is left alone.
+            if engine.url.database not in (None, '', ':memory:'):
+                engine.dispose()
+
+
+def _configure_sqlite(connection, record):
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % SQLITE_BUSY_TIMEOUT)
+    cursor.close()
+
+
+class MemoryRow(object):
+    """A row of the memory store, with its fields as attributes."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class MemoryGame(MemoryRow, GameBoard):
+    """A game of the memory store."""
+
+
+class MemoryStore(GameStore):
+    """Keeps games in the memory of the process.
+
+    Every operation holds the store's lock. The objects it hands out are the
+    stored ones, so a handler's changes to them take effect at once, and
+    commands of a channel are serialized by the channel locks of workers.py.
+    Finished games are dropped as soon as their records are counted, and
+    expired challenges when the channel is next searched.
+    """
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._teams = {}
+        self._channels = {}
+        self._players = {}
+        self._games = {}
+        self._challenges = {}
+        self._records = {}
+        self._lock = threading.RLock()
+
+    def load(self, team_id, channel_id, user_id=None):
+        with self._lock:
+            channel = self._channels.get((team_id, channel_id))
+            player = None
+            game = None
+            if user_id != None:
+                player = self._players.get((team_id, channel_id, user_id))
+            if player != None and player.active_game_id != None:
+                game = self._games.get(player.active_game_id)
+            return GameContext(
+                team_id, channel_id, user_id,
+                team=self._teams.get(team_id), channel=channel, game=game,
+                player=player,
+                game_players=(game.player1, game.player2) if game else ())
+
+    def create_challenge(self, context, user_name, opponent_name):
+        with self._lock:
+            (channel, player) = self._join(context, user_name)
+            self._challenges.setdefault(channel.key, []).append(MemoryRow(
+                id=next(self._ids), opponent_name=opponent_name,
+                expired=False, created_at=datetime.utcnow(), channel=channel,
+                challenger=player))
+
+    def find_challenge(self, context, user_name, challenger_name=None):
+        if context.channel == None:
+            return None
+        cutoff = challenge_cutoff()
+        with self._lock:
+            challenges = [challenge for challenge in
+                          self._challenges.get(context.channel.key, ())
+                          if not challenge.expired and
+                          challenge.created_at >= cutoff]
+            self._challenges[context.channel.key] = challenges
+            for challenge in reversed(challenges):
+                if (challenge.opponent_name == user_name and
+                        (challenger_name == None or
+                         challenge.challenger.user_name == challenger_name)):
+                    return challenge
+            return None
+
+    def is_busy(self, player):
+        with self._lock:
+            game = self._games.get(player.active_game_id)
+            return game != None and not game.finished
+
+    def create_game(self, context, user_name, starter, challenge=None,
+                    response_url=None):
+        with self._lock:
+            (channel, player) = self._join(context, user_name)
+            if challenge != None:
+                challenge.expired = True
+                players = (challenge.challenger, player)
+            else:
+                key = (context.team_id, context.channel_id, BOT_USER_ID)
+                bot = self._players.get(key)
+                if bot == None:
+                    bot = self._players[key] = MemoryRow(
+                        id=next(self._ids), user_id=BOT_USER_ID,
+                        user_name=BOT_NAME, channel=channel,
+                        active_game_id=None)
+                players = (player, bot)
+
+            game = MemoryGame(
+                id=next(self._ids), board_size=BOARD_SIZE,
+                win_length=WIN_LENGTH, current_player_name=starter,
+                finished=False, x_mask=0, o_mask=0, dead_lines=0,
+                move_count=0, response_url=response_url, channel=channel,
+                player1=players[0], player2=players[1])
+            self._games[game.id] = game
+            for claimed in players:
+                if claimed.user_id != BOT_USER_ID:
+                    claimed.active_game_id = game.id
+            return game
+
+    def apply_move(self, game, player, x, y, response_url=None):
+        with self._lock:
+            game.place_piece(x, y, player)
+            outcome = advance(game, player, x, y)
+            game.move_count += 1
+            if response_url:
+                game.response_url = response_url
+            if game.finished:
+                self._finish(game)
+            return outcome
+
+    def save(self):
+        pass
+
+    def discard(self):
+        pass
+
+    def channel_games(self, channel):
+        with self._lock:
+            return sorted((game for game in self._games.values()
+                           if game.channel is channel and not game.finished),
+                          key=lambda game: game.id)
+
+    def player_stats(self, team_id, channel_id, user_id):
+        with self._lock:
+            return (self._records.get((team_id, channel_id, user_id)),
+                    self._records.get((team_id, TEAM_SCOPE, user_id)))
+
+    def leaderboard(self, team_id, channel_id=TEAM_SCOPE,
+                    size=LEADERBOARD_SIZE):
+        with self._lock:
+            records = [record for (key, record) in self._records.items()
+                       if key[0] == team_id and key[1] == channel_id]
+        records.sort(key=lambda record: (-record.wins, record.losses,
+                                         record.id))
+        return records[:size]
+
+    def expire_challenges(self, now=None):
+        cutoff = challenge_cutoff(now)
+        expired = 0
+        with self._lock:
+            for challenges in self._challenges.values():
+                for challenge in challenges:
+                    if not challenge.expired and challenge.created_at < cutoff:
+                        challenge.expired = True
+                        expired += 1
+        return expired
+
+    def _join(self, context, user_name):
+        team_id = context.team_id
+        team = self._teams.get(team_id)
+        if team == None:
+            team = self._teams[team_id] = MemoryRow(id=next(self._ids),
+                                                    team_id=team_id)
+        key = (team_id, context.channel_id)
+        channel = self._channels.get(key)
+        if channel == None:
+            channel = self._channels[key] = MemoryRow(
+                id=next(self._ids), key=key, channel_id=context.channel_id,
+                team=team)
+        key = (team_id, context.channel_id, context.user_id)
+        player = self._players.get(key)
+        if player == None:
+            player = self._players[key] = MemoryRow(
+                id=next(self._ids), user_id=context.user_id,
+                user_name=user_name, channel=channel, active_game_id=None)
+        return (channel, player)
+
+    def _finish(self, game):
+        """Counts a finished game in its players' records and drops it."""
+        (result, winner_name) = game_result(game)
+        team_id = game.channel.team.team_id
+        for player in (game.player1, game.player2):
+            if player.active_game_id == game.id:
+                player.active_game_id = None
+            if player.user_id == BOT_USER_ID:
+                continue
+            for scope in (game.channel.channel_id, TEAM_SCOPE):
+                key = (team_id, scope, player.user_id)
+                record = self._records.get(key)
+                if record == None:
+                    record = self._records[key] = MemoryRow(
+                        id=next(self._ids), channel_id=scope,
+                        user_id=player.user_id, wins=0, losses=0, draws=0)
+                record.user_name = player.user_name
+                if result == DRAW:
+                    record.draws += 1
+                elif player.user_name == winner_name:
+                    record.wins += 1
+                else:
+                    record.losses += 1
+        del self._games[game.id]
+
+
+STORES = {
+    'database': DatabaseStore,
+    'sqlite': SqliteStore,
+    'memory': MemoryStore
+}
+
+
+def get_store():
+    """Returns the configured store, which defaults to DatabaseStore.
+
+    GAME_STORE names one of STORES or is a store object itself.
+    """
+
+    store = app.config.get('GAME_STORE') or 'database'
+    if isinstance(store, GameStore):
+        return store
+    with _store_lock:
+        store = app.config.get('GAME_STORE') or 'database'
+        if not isinstance(store, GameStore):
+            store = app.config['GAME_STORE'] = STORES[store]()
+    return store
@@ -0,0 +1,275 @@
+"""This module forfeits players who take too long to make their move.
+
+With TURN_TIMEOUT set, every move gives the next player TURN_TIMEOUT seconds
+for theirs. The deadline is stored on the game, and each process keeps the
+deadlines of the active games in a min-heap served by a single thread. The
+thread sleeps until the earliest deadline is due, so no table is polled.
+Arming a new deadline is a heap push. A replaced deadline stays in the heap
+and is skipped when it comes up.
+
+When a deadline passes, the game is reloaded. If its stored deadline still
+has passed, the player to move loses by forfeit, and the result is posted to
+the channel through the response_url of the game's latest command. The stored
+deadline is authoritative: every process keeps a heap, and a process whose
+entry is outdated simply re-arms it with the stored deadline.
+"""
+
+import heapq
+import logging
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import app, db
+from app.board import render_board
+from app.constants import MAX_COMMAND_ATTEMPTS
+from app.context import release_players
+from app.metrics import registry
+from app.models import Game
+from app.stats import record_result
+from app.workers import get_delivery
+from app.writebehind import get_write_behind
+
+logger = logging.getLogger(__name__)
+
+TIMER_LOAD_BATCH_SIZE = 1000
+
+_timers = None
+_timers_lock = threading.Lock()
+
+
+class TurnTimers(object):
+    """Calls a function for each game whose turn deadline has passed.
+
+    Attributes:
+        on_expired: A function taking the id of a game whose deadline passed
+    """
+
+    def __init__(self, on_expired, timer=time.time):
+        self.on_expired = on_expired
+        self._timer = timer
+        self._heap = []
+        self._deadlines = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def load(self, deadlines):
+        """Arms many deadlines at once from an iterable of (game_id, deadline).
+
+        The heap is built in linear time rather than by one push per game.
+        """
+
+        with self._condition:
+            for (game_id, deadline) in deadlines:
+                self._deadlines[game_id] = deadline
+            self._heap = [(deadline, game_id) for (game_id, deadline)
+                          in self._deadlines.items()]
+            heapq.heapify(self._heap)
+            self._condition.notify()
+
+    def arm(self, game_id, deadline):
+        """Sets the deadline of a game, replacing any earlier one."""
+        with self._condition:
+            self._deadlines[game_id] = deadline
+            heapq.heappush(self._heap, (deadline, game_id))
+            if self._heap[0] == (deadline, game_id):
+                self._condition.notify()
+
+    def cancel(self, game_id):
+        """Removes the deadline of a game, if it has one."""
+        with self._condition:
+            self._deadlines.pop(game_id, None)
+
+    def pop_expired(self):
+        """Removes and returns the ids of the games whose deadline passed."""
+        now = self._timer()
+        expired = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                (deadline, game_id) = heapq.heappop(self._heap)
+                if self._deadlines.get(game_id) == deadline:
+                    del self._deadlines[game_id]
+                    expired.append(game_id)
+            self._compact()
+        return expired
+
+    def next_deadline(self):
+        """Returns the earliest deadline still armed, or None."""
+        with self._condition:
+            while (self._heap and self._deadlines.get(self._heap[0][1]) !=
+                   self._heap[0][0]):
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def start(self):
+        """Starts the thread that waits for deadlines."""
+        self._thread = threading.Thread(target=self._run,
+                                        name="ttt-turn-timers")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread, leaving the remaining deadlines unhandled."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread != None:
+            self._thread.join()
+
+    def _compact(self):
+        # Replaced deadlines stay in the heap until they come up. Once they
+        # outnumber the live ones, the heap is rebuilt from the live ones.
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(deadline, game_id) for (game_id, deadline)
+                          in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                deadline = self.next_deadline()
+                if deadline == None:
+                    self._condition.wait()
+                    continue
+                delay = deadline - self._timer()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+            for game_id in self.pop_expired():
+                try:
+                    self.on_expired(game_id)
+                except Exception:
+                    logger.exception("Forfeiting game %s failed", game_id)
+
+
+def start_turn(game):
+    """Gives the player to move TURN_TIMEOUT seconds for their move.
+
+    A finished game has its deadline removed instead. Does nothing when turn
+    timers are disabled.
+
+    Args:
+        game: The Game object whose turn just began or that just ended
+    """
+
+    timeout = app.config.get('TURN_TIMEOUT')
+    if not timeout:
+        return
+    timers = get_turn_timers()
+    if game.finished:
+        game.turn_deadline = None
+        if game.id != None:
+            timers.cancel(game.id)
+        return
+    game.turn_deadline = int(time.time()) + timeout
+    if game.id == None:
+        db.session.flush()
+    timers.arm(game.id, game.turn_deadline)
+
+
+def forfeit_expired(game_id):
+    """Ends a game whose player to move let the turn deadline pass.
+
+    Args:
+        game_id: An integer representing the id of the game
+
+    Returns:
+        A boolean representing whether the game was forfeited.
+    """
+
+    buffer = get_write_behind()
+    if buffer != None:
+        buffer.flush()
+    for attempt in range(MAX_COMMAND_ATTEMPTS):
+        game = Game.query.get(game_id)
+        if game == None or game.finished or game.turn_deadline == None:
+            return False
+        if game.turn_deadline > time.time():
+            get_turn_timers().arm(game.id, game.turn_deadline)
+            return False
+
+        loser_name = game.current_player_name
+        winner = (game.player2 if game.player1.user_name == loser_name
+                  else game.player1)
+        game.finished = True
+        game.current_player_name = winner.user_name
+        game.turn_deadline = None
+        record_result(game)
+        release_players([game.id])
+        board = render_board(game.board_size, game.x_mask, game.o_mask)
+        response_url = game.response_url
+        try:
+            db.session.commit()
+        except (StaleDataError, IntegrityError):
+            db.session.rollback()
+            continue
+        break
+    else:
+        return False
+
+    registry.increment("timers.forfeits")
+    if response_url:
+        get_delivery().post(response_url, {
+            "response_type": "in_channel",
+            "text": ("{0} {1} ran out of time, {2} wins by forfeit!"
+                     .format(board, loser_name, winner.user_name))
+        })
+    return True
+
+
+def _forfeit_in_context(game_id):
+    with app.app_context():
+        try:
+            forfeit_expired(game_id)
+        finally:
+            db.session.remove()
+
+
+def get_turn_timers():
+    """Returns the process's turn timers, starting them on first use.
+
+    The deadlines of the games in progress are loaded from the database in
+    batches, through the index on the deadline column.
+    """
+
+    global _timers
+    if _timers == None:
+        with _timers_lock:
+            if _timers == None:
+                timers = TurnTimers(_forfeit_in_context)
+                timers.load(
+                    db.session.query(Game.id, Game.turn_deadline)
+                    .filter(Game.turn_deadline != None,
+                            Game.finished == False)
+                    .execution_options(stream_results=True)
+                    .yield_per(TIMER_LOAD_BATCH_SIZE))
+                timers.start()
+                _timers = timers
+    return _timers
+
+
+def shutdown_turn_timers():
+    """Stops the turn timers, if they were started."""
+    global _timers
+    with _timers_lock:
+        if _timers != None:
+            _timers.stop()
+            _timers = None
+
+
+@app.before_first_request
+def _start_turn_timers():
+    if app.config.get('TURN_TIMEOUT'):
+        get_turn_timers()
+
+
+registry.set_gauge("timers.armed",
+                   lambda: len(_timers) if _timers != None else 0)
@@ -0,0 +1,338 @@
+"""This module answers Slack commands in the background.
+
+With ASYNC_RESPONSES enabled, request_handler only validates a command and
+acknowledges it; the command itself runs on a bounded pool of worker threads
+which post the result to the command's response_url. Slack's 3-second limit
+then only covers parsing the request, not the database work.
+
+Commands of one channel all compete for the same Game and Challenge rows,
+while different channels never interact. Jobs are therefore routed by
+channel onto lanes of a ChannelDispatcher: each lane runs its commands one
+after the other, and lanes run in parallel. Commands answered synchronously
+do not go through the lanes, so every command, queued or not, also holds
+its channel's channel_lock() while it runs. A channel's commands therefore
+never race each other, whichever way they are answered.
+"""
+
+import json
+import logging
+import socket
+import threading
+
+try:
+    import httplib
+    import Queue as queue
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    import queue
+    from urllib.parse import urlparse
+
+from flask import Response, copy_current_request_context
+
+from app import app
+from app.constants import COMMAND_FAILED_ERROR
+from app.hashring import HashRing
+from app.metrics import registry, start_request, finish_request, command_type
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_LOCKS = 256
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_channel_locks = [threading.Lock() for i in range(CHANNEL_LOCKS)]
+_channel_lock_ring = HashRing(range(CHANNEL_LOCKS), replicas=4)
+
+
+class HttpDelivery(object):
+    """Posts JSON payloads to response URLs over kept-alive connections.
+
+    Idle connections are pooled per host, so consecutive responses to the
+    same Slack endpoint reuse a connection instead of setting up a new TLS
+    session each time.
+    """
+
+    def __init__(self, timeout=5, max_idle_per_host=4):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def post(self, url, payload):
+        """Posts a payload to a URL and returns the HTTP status code."""
+        parts = urlparse(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        body = json.dumps(payload)
+        headers = {"Content-Type": "application/json"}
+
+        # A pooled connection may have been closed by the server while it
+        # sat idle, so a failure on one is retried once on a new connection.
+        for attempt in range(2):
+            (connection, reused) = self._acquire(key)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            self._release(key, connection)
+            return response.status
+
+    def close(self):
+        """Closes every idle connection."""
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return (idle.pop(), True)
+        (scheme, netloc) = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        return (connection, False)
+
+    def _release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+class WorkerPool(object):
+    """A fixed number of threads working off a bounded queue of jobs.
+
+    Attributes:
+        size: An integer representing the number of worker threads
+        queue_size: An integer representing how many jobs may wait
+    """
+
+    def __init__(self, size, queue_size):
+        self.size = size
+        self.queue_size = queue_size
+        self._queue = queue.Queue(queue_size)
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._work,
+                                      name="ttt-worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job):
+        """Queues a job without blocking.
+
+        Returns:
+            A boolean representing whether the job was accepted. It is False
+            when the queue is full.
+        """
+
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            return False
+        return True
+
+    def depth(self):
+        """Returns the number of jobs waiting to be run."""
+        return self._queue.qsize()
+
+    def join(self):
+        """Blocks until every queued job has been run."""
+        self._queue.join()
+
+    def shutdown(self):
+        """Stops the threads once the jobs queued so far have been run."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job == None:
+                    return
+                job()
+            except Exception:
+                logger.exception("Background command failed")
+            finally:
+                self._queue.task_done()
+
+
+class ChannelDispatcher(object):
+    """Runs jobs one at a time per channel and in parallel across channels.
+
+    Channels are mapped onto a fixed number of single-threaded lanes through
+    a consistent hash ring, so all jobs of a channel run on the same lane in
+    the order they were submitted.
+
+    Attributes:
+        lanes: A list of single-threaded WorkerPool objects
+    """
+
+    def __init__(self, lanes, queue_size):
+        self.lanes = [WorkerPool(1, queue_size) for i in range(lanes)]
+        self._ring = HashRing(range(lanes))
+
+    def lane(self, team_id, channel_id):
+        """Returns the lane that runs a channel's jobs."""
+        return self.lanes[self._ring.get(channel_key(team_id, channel_id))]
+
+    def submit(self, team_id, channel_id, job):
+        """Queues a job on its channel's lane without blocking.
+
+        Returns:
+            A boolean representing whether the job was accepted. It is False
+            when the channel's lane is full.
+        """
+
+        return self.lane(team_id, channel_id).submit(job)
+
+    def depth(self):
+        """Returns the number of jobs waiting on every lane."""
+        return sum(lane.depth() for lane in self.lanes)
+
+    def join(self):
+        """Blocks until every queued job has been run."""
+        for lane in self.lanes:
+            lane.join()
+
+    def shutdown(self):
+        """Stops the lanes once the jobs queued so far have been run."""
+        for lane in self.lanes:
+            lane.shutdown()
+
+
+def channel_key(team_id, channel_id):
+    """Returns the string channels are hashed by."""
+    return u"%s:%s" % (team_id, channel_id)
+
+
+def channel_lock(team_id, channel_id):
+    """Returns the lock serializing a channel's commands.
+
+    Channels share a fixed set of locks, so unrelated channels occasionally
+    wait on each other, but the number of locks stays bounded.
+    """
+
+    return _channel_locks[_channel_lock_ring.get(
+        channel_key(team_id, channel_id))]
+
+
+def get_dispatcher():
+    """Returns the process's dispatcher, starting it on first use.
+
+    The dispatcher is started lazily so that each gunicorn worker process
+    gets its own threads after forking.
+    """
+
+    global _dispatcher
+    if _dispatcher == None:
+        with _dispatcher_lock:
+            if _dispatcher == None:
+                _dispatcher = ChannelDispatcher(
+                    app.config['ASYNC_WORKERS'],
+                    app.config['ASYNC_QUEUE_SIZE'])
+    return _dispatcher
+
+
+def shutdown_dispatcher():
+    """Stops the dispatcher, if one was started."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher != None:
+            _dispatcher.shutdown()
+            _dispatcher = None
+
+
+def get_delivery():
+    """Returns the configured delivery, which defaults to HttpDelivery."""
+    delivery = app.config.get('RESPONSE_DELIVERY')
+    if delivery == None:
+        delivery = app.config['RESPONSE_DELIVERY'] = HttpDelivery()
+    return delivery
+
+
+def response_payload(response):
+    """Converts a handler's response into a Slack message payload.
+
+    Handlers return either a JSON response or a plain error string, which
+    Slack shows only to the user who typed the command.
+    """
+
+    if isinstance(response, Response):
+        return json.loads(response.get_data(as_text=True))
+    return {"response_type": "ephemeral", "text": response}
+
+
+def submit_command(response_url, function, team_id, channel_id, command,
+                   *args):
+    """Queues a command to be run and answered through its response_url.
+
+    Args:
+        response_url: A string representing the URL Slack gave the command
+        function: A function running the command and returning its response
+        team_id: A string representing a Slack team's id
+        channel_id: A string representing a Slack channel's id
+        command: A string representing the text of the command
+        args: The arguments of function
+
+    The command runs in a copy of the current request's context, holding
+    the channel's lock like synchronous commands do. If it fails, the user
+    is told so through the response_url.
+
+    Returns:
+        A boolean representing whether the command was queued. It is False
+        when the channel's lane is saturated.
+    """
+
+    @copy_current_request_context
+    def job():
+        try:
+            if app.config.get('METRICS_ENABLED'):
+                start_request()
+            try:
+                with channel_lock(team_id, channel_id):
+                    response = function(*args)
+            finally:
+                finish_request(command_type(command))
+            payload = response_payload(response)
+        except Exception:
+            registry.increment("async.command_errors")
+            get_delivery().post(response_url, {"response_type": "ephemeral",
+                                               "text": COMMAND_FAILED_ERROR})
+            raise
+        try:
+            get_delivery().post(response_url, payload)
+            registry.increment("async.delivered")
+        except Exception:
+            registry.increment("async.delivery_errors")
+            raise
+
+    if get_dispatcher().submit(team_id, channel_id, job):
+        registry.increment("async.submitted")
+        return True
+    registry.increment("async.rejected")
+    return False
+
+
+registry.set_gauge("async.queue_depth",
+                   lambda: _dispatcher.depth() if _dispatcher != None else 0)
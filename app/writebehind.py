@@ -0,0 +1,387 @@
+"""This module persists moves to the database in the background.
+
+With WRITE_BEHIND enabled, a move is applied to an in-memory copy of its
+game's state, appended to a local journal and answered right away. A
+background thread then writes the buffered moves to the database in batches:
+one multi-row INSERT of pieces and one UPDATE per changed game, in a single
+transaction, every WRITE_BEHIND_INTERVAL seconds or as soon as
+WRITE_BEHIND_BATCH moves are waiting. Each UPDATE is conditional on the
+version of the game the moves were made on, like every other write of a
+game, so a game that was changed meanwhile, such as by a forfeit, is not
+overwritten. Its buffered moves are dropped instead.
+
+Until a game's moves are flushed, the in-memory state is authoritative and
+is laid over the Game rows the handlers load. The journal is fsynced before
+a move is answered, and journals left behind by a process that died are
+flushed by the next process to start, so acknowledged moves survive a
+crash.
+
+Other processes cannot see a process's unflushed moves, so write-behind
+needs the app to run as a single process. The dispatcher only routes
+channels between the threads of one process, not between gunicorn workers,
+so the buffer refuses to start when WEB_CONCURRENCY asks for more than one
+worker.
+"""
+
+from datetime import datetime
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import app, db
+from app.cache import LRUCache
+from app.constants import WRITE_BEHIND_VERSIONS
+from app.metrics import registry
+from app.events import snapshot_due
+from app.models import Game, GameSnapshot, MoveEvent, Piece
+from app.context import release_players
+from app.stats import record_results
+
+logger = logging.getLogger(__name__)
+
+STATE_FIELDS = ("x_mask", "o_mask", "dead_lines", "current_player_name",
+                "finished", "move_count", "turn_deadline", "response_url")
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+class WriteBehindBuffer(object):
+    """Buffers moves in memory and in a journal until they are flushed.
+
+    Attributes:
+        journal_path: A string representing this process's journal file
+        batch_size: An integer representing how many moves trigger a flush
+    """
+
+    def __init__(self, journal_path, batch_size):
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self._states = {}
+        self._versions = LRUCache(WRITE_BEHIND_VERSIONS)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._full = threading.Event()
+        self._journal = open(journal_path, "a")
+        self.closed = False
+
+    def overlay(self, game):
+        """Lays the buffered state of a game over its loaded Game object.
+
+        The values are set as if they had been loaded, so the session does
+        not consider the game changed.
+        """
+
+        if game == None:
+            return
+        state = self.state(game.id)
+        if state != None:
+            for field in STATE_FIELDS:
+                set_committed_value(game, field, state[field])
+
+    def state(self, game_id):
+        """Returns the buffered state of a game, or None if it has none."""
+        with self._lock:
+            return self._states.get(game_id)
+
+    def record_move(self, game, player, x, y):
+        """Buffers a move that has already been applied to a Game object.
+
+        The move is written to the journal and fsynced before this returns.
+        It waits for a flush that is being written, so that it is made on the
+        version of the game the flush leaves behind.
+
+        Args:
+            game: The Game object, including the new piece and its log entry
+            player: The Player object who made the move
+            x: An integer representing the x coordinate of the new piece
+            y: An integer representing the y coordinate of the new piece
+        """
+
+        entry = {
+            "game_id": game.id,
+            "player_id": player.id,
+            "x": x,
+            "y": y,
+            "created_at": time.time(),
+            "state": dict((field, getattr(game, field))
+                          for field in STATE_FIELDS)
+        }
+        with self._flush_lock:
+            with self._lock:
+                # A game loaded before a flush wrote it has an older version
+                # than the one the flush left in the database.
+                entry["version"] = max(game.version,
+                                       self._versions.get(game.id, 0))
+                self._journal.write(json.dumps(entry) + "\n")
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                self._states[game.id] = entry["state"]
+                self._pending.append(entry)
+                if len(self._pending) >= self.batch_size:
+                    self._full.set()
+
+    def pending(self):
+        """Returns the number of moves waiting to be flushed."""
+        return len(self._pending)
+
+    def wait(self, timeout):
+        """Waits until a batch is full or the timeout has passed."""
+        self._full.wait(timeout)
+        self._full.clear()
+
+    def flush(self):
+        """Writes every buffered move to the database in one transaction.
+
+        The journal is rotated before writing, so moves recorded during the
+        flush go to a new journal. The old journal is only removed once the
+        transaction has committed.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                if self.closed or not self._pending:
+                    return 0
+                entries = self._pending
+                self._pending = []
+                flushing_path = self.journal_path + ".flushing"
+                self._journal.close()
+                os.rename(self.journal_path, flushing_path)
+                self._journal = open(self.journal_path, "a")
+
+            try:
+                versions = write_entries(entries)
+            except Exception:
+                db.session.rollback()
+                with self._lock:
+                    self._pending = entries + self._pending
+                    self._journal.close()
+                    _write_journal(self.journal_path, self._pending)
+                    self._journal = open(self.journal_path, "a")
+                os.remove(flushing_path)
+                raise
+            os.remove(flushing_path)
+
+            # A game's buffered state can only be dropped if no move of the
+            # game arrived during the flush.
+            with self._lock:
+                for (game_id, version) in versions.items():
+                    self._versions.set(game_id, version)
+                waiting = set(entry["game_id"] for entry in self._pending)
+                for entry in entries:
+                    if entry["game_id"] not in waiting:
+                        self._states.pop(entry["game_id"], None)
+            return len(entries)
+
+    def close(self):
+        """Stops the flushing thread and closes the journal.
+
+        Moves that were not flushed yet stay in the journal, to be recovered
+        by the next process to start.
+        """
+
+        with self._lock:
+            self.closed = True
+            self._journal.close()
+        self._full.set()
+
+
+def write_entries(entries):
+    """Writes journal entries to the database in a single transaction.
+
+    Each game is set to the state of its last entry by an UPDATE that only
+    matches the version of the game its entries were made on, and only if
+    the game is not finished yet. A game that was changed since, by another
+    writer or by an earlier flush of the same entries when a journal is
+    recovered, is left alone and its entries are dropped. Pieces that are
+    already in the database are skipped along with their log entries. Games
+    that the entries finish are counted in their players' records, and their
+    players are released to start other games.
+
+    Returns:
+        A dictionary of the new version of each game that was written.
+    """
+
+    versions = {}
+    states = {}
+    for entry in entries:
+        versions.setdefault(entry["game_id"], entry.get("version"))
+        states[entry["game_id"]] = entry["state"]
+
+    game = Game.__table__
+    written = {}
+    for (game_id, state) in states.items():
+        update = game.update().where(game.c.id == game_id) \
+            .where(game.c.finished == False)
+        # Journals written before entries had versions are not checked.
+        if versions[game_id] != None:
+            update = update.where(game.c.version == versions[game_id])
+        values = dict((field, state[field]) for field in STATE_FIELDS)
+        values["version"] = game.c.version + 1
+        if db.session.execute(update.values(values)).rowcount == 1:
+            written[game_id] = (versions[game_id] + 1
+                                if versions[game_id] != None else None)
+
+    dropped = [entry for entry in entries if entry["game_id"] not in written]
+    if dropped:
+        registry.increment("write_behind.conflicts", len(dropped))
+        logger.warning("Dropped %d buffered moves of games changed since: %s",
+                       len(dropped),
+                       sorted(set(entry["game_id"] for entry in dropped)))
+    entries = [entry for entry in entries if entry["game_id"] in written]
+    if not entries:
+        db.session.commit()
+        return {}
+
+    existing = set(tuple(key) for key in
+                   db.session.query(Piece.game_id, Piece.x_coord,
+                                    Piece.y_coord)
+                   .filter(Piece.game_id.in_(written)))
+    pieces = [entry for entry in entries if
+              (entry["game_id"], entry["x"], entry["y"]) not in existing]
+    if pieces:
+        db.session.execute(Piece.__table__.insert().values([
+            {"game_id": entry["game_id"], "player_id": entry["player_id"],
+             "x_coord": entry["x"], "y_coord": entry["y"]}
+            for entry in pieces
+        ]))
+        db.session.execute(MoveEvent.__table__.insert().values([
+            {"game_id": entry["game_id"], "player_id": entry["player_id"],
+             "sequence": entry["state"]["move_count"],
+             "x_coord": entry["x"], "y_coord": entry["y"],
+             "created_at": datetime.utcfromtimestamp(entry["created_at"])}
+            for entry in pieces
+        ]))
+        snapshots = [entry for entry in pieces
+                     if snapshot_due(entry["state"]["move_count"])]
+        if snapshots:
+            db.session.execute(GameSnapshot.__table__.insert(), [
+                dict([("game_id", entry["game_id"]),
+                      ("sequence", entry["state"]["move_count"])] +
+                     [(field, entry["state"][field]) for field in
+                      ("x_mask", "o_mask", "dead_lines",
+                       "current_player_name", "finished")])
+                for entry in snapshots
+            ])
+
+    finished = [game_id for game_id in written if states[game_id]["finished"]]
+    if finished:
+        record_results(finished)
+        release_players(finished)
+    db.session.commit()
+    return dict((game_id, version) for (game_id, version) in written.items()
+                if version != None)
+
+
+def _write_journal(path, entries):
+    """Replaces a journal with the given entries."""
+    with open(path + ".tmp", "w") as journal:
+        for entry in entries:
+            journal.write(json.dumps(entry) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.rename(path + ".tmp", path)
+
+
+def recover(journal_prefix):
+    """Flushes the journals of processes that are no longer running.
+
+    Args:
+        journal_prefix: A string representing the path every process's
+            journal starts with
+
+    Returns:
+        The number of moves recovered.
+    """
+
+    recovered = 0
+    for path in sorted(glob.glob(journal_prefix + ".*")):
+        pid = path[len(journal_prefix) + 1:].split(".", 1)[0]
+        if not pid.isdigit() or _process_alive(int(pid)):
+            continue
+        with open(path) as journal:
+            entries = [json.loads(line) for line in journal if line.strip()]
+        if entries:
+            write_entries(entries)
+            recovered += len(entries)
+        os.remove(path)
+    return recovered
+
+
+def _process_alive(pid):
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _flush_forever(buffer, interval):
+    while True:
+        buffer.wait(interval)
+        if buffer.closed:
+            return
+        try:
+            with app.app_context():
+                buffer.flush()
+        except Exception:
+            logger.exception("Write-behind flush failed")
+
+
+def get_write_behind():
+    """Returns the process's write-behind buffer, or None if it is disabled.
+
+    The buffer is created on first use, after recovering any journals left
+    behind by processes that died, and is flushed by a daemon thread and
+    once more when the process exits. A RuntimeError is raised when
+    WEB_CONCURRENCY asks for several worker processes.
+    """
+
+    global _buffer
+    if not app.config.get('WRITE_BEHIND'):
+        return None
+    if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+        raise RuntimeError("Write-behind needs a single worker process, "
+                           "but WEB_CONCURRENCY is more than 1")
+    if _buffer == None:
+        with _buffer_lock:
+            if _buffer == None:
+                prefix = app.config['WRITE_BEHIND_JOURNAL']
+                recover(prefix)
+                buffer = WriteBehindBuffer("%s.%d" % (prefix, os.getpid()),
+                                           app.config['WRITE_BEHIND_BATCH'])
+                thread = threading.Thread(
+                    target=_flush_forever,
+                    args=(buffer, app.config['WRITE_BEHIND_INTERVAL']),
+                    name="ttt-write-behind")
+                thread.daemon = True
+                thread.start()
+                atexit.register(shutdown_write_behind)
+                _buffer = buffer
+    return _buffer
+
+
+def shutdown_write_behind():
+    """Flushes and closes the process's write-behind buffer, if it has one."""
+    global _buffer
+    with _buffer_lock:
+        if _buffer != None:
+            with app.app_context():
+                _buffer.flush()
+            _buffer.close()
+            if not _buffer.pending():
+                os.remove(_buffer.journal_path)
+            _buffer = None
+
+
+registry.set_gauge("write_behind.pending",
+                   lambda: _buffer.pending() if _buffer != None else 0)
@@ -0,0 +1,417 @@
+"""This module load-tests the Slack request handler.
+
+It plays realistic slash-command traffic (challenges, accepts, moves, status
+checks and invalid commands) across many teams and channels at once, either
+in-process through Flask's test client or over HTTP against a local gunicorn
+instance, and reports latency percentiles, throughput and, in-process, the
+number of SQL statements each command type issues.
+
+Examples:
+    python benchmark.py --teams 5 --channels 20 --games 3 --threads 8
+    python benchmark.py --driver gunicorn --workers 4 --output results.json
+    python benchmark.py --record traffic.jsonl
+    python benchmark.py --replay traffic.jsonl
+
+The database defaults to a fresh SQLite file; pass --database-url to run
+against PostgreSQL instead. Results are printed as a summary and, with
+--output, written as JSON so runs of different versions can be compared.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from urllib import urlencode
+    from urllib2 import urlopen, URLError
+except ImportError:
+    from urllib.parse import urlencode
+    from urllib.request import urlopen
+    from urllib.error import URLError
+
+COMMAND_TYPES = ["challenge", "accept", "move", "status", "stats", "invalid",
+                 "help"]
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of a sorted list of numbers."""
+    if not values:
+        return None
+    index = max(0, int(round(fraction * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class Recorder(object):
+    """Collects the measurements of every command sent during a run."""
+
+    def __init__(self):
+        self.samples = dict((kind, []) for kind in COMMAND_TYPES)
+        self.queries = dict((kind, []) for kind in COMMAND_TYPES)
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds, queries, ok):
+        with self._lock:
+            self.samples[kind].append(seconds)
+            if queries != None:
+                self.queries[kind].append(queries)
+            if not ok:
+                self.errors += 1
+
+    def summary(self, duration):
+        """Returns the results of the run as a JSON-serializable dict."""
+        total = sum(len(samples) for samples in self.samples.values())
+        latency = {}
+        queries = {}
+        for kind in COMMAND_TYPES:
+            samples = sorted(self.samples[kind])
+            if not samples:
+                continue
+            latency[kind] = {
+                "count": len(samples),
+                "mean": 1000.0 * sum(samples) / len(samples),
+                "p50": 1000.0 * percentile(samples, 0.50),
+                "p95": 1000.0 * percentile(samples, 0.95),
+                "p99": 1000.0 * percentile(samples, 0.99)
+            }
+            if self.queries[kind]:
+                counts = self.queries[kind]
+                queries[kind] = {
+                    "mean": float(sum(counts)) / len(counts),
+                    "max": max(counts)
+                }
+        return {
+            "commands": total,
+            "errors": self.errors,
+            "duration_seconds": duration,
+            "requests_per_second": total / duration if duration else None,
+            "latency_ms": latency,
+            "queries_per_command": queries
+        }
+
+
+class QueryCounter(object):
+    """Counts the SQL statements each thread executes in this process."""
+
+    def __init__(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        self._local = threading.local()
+        event.listen(Engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def reset(self):
+        self._local.count = 0
+
+    def value(self):
+        return getattr(self._local, "count", 0)
+
+
+class TestClientDriver(object):
+    """Sends commands to the app in-process through Flask's test client."""
+
+    name = "test_client"
+
+    def __init__(self):
+        from app import app
+
+        self.app = app
+        self.counter = QueryCounter()
+        self._local = threading.local()
+
+    def send(self, form):
+        client = getattr(self._local, "client", None)
+        if client == None:
+            client = self._local.client = self.app.test_client()
+        self.counter.reset()
+        response = client.post('/', data=form)
+        return (response.status_code, response.get_data(as_text=True),
+                self.counter.value())
+
+    def close(self):
+        pass
+
+
+class HttpDriver(object):
+    """Sends commands over HTTP, optionally to a gunicorn it starts itself."""
+
+    name = "http"
+
+    def __init__(self, url, workers=None, port=None):
+        self.url = url
+        self.process = None
+        if workers != None:
+            self.name = "gunicorn"
+            bind = "127.0.0.1:%d" % port
+            self.url = "http://%s/" % bind
+            self.process = subprocess.Popen(
+                ["gunicorn", "app:app", "--bind", bind,
+                 "--workers", str(workers), "--log-level", "warning"],
+                env=os.environ.copy()
+            )
+            self._wait_until_ready()
+
+    def _wait_until_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                urlopen(self.url).read()
+                return
+            except (URLError, IOError):
+                time.sleep(0.2)
+        self.close()
+        raise RuntimeError("gunicorn did not start on %s" % self.url)
+
+    def send(self, form):
+        body = urlencode(form).encode("utf-8")
+        try:
+            response = urlopen(self.url, body)
+            return (response.getcode(), response.read().decode("utf-8"),
+                    None)
+        except URLError as error:
+            return (getattr(error, "code", 0), str(error), None)
+
+    def close(self):
+        if self.process != None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+
+class TrafficGenerator(object):
+    """Plays whole games in a channel, mixing in spectators and mistakes.
+
+    Games are played closed-loop: each command is sent after the previous
+    one was answered, and the generator follows the responses to know whose
+    turn it is, the way real players would.
+    """
+
+    def __init__(self, driver, recorder, token, seed, status_rate=0.2,
+                 invalid_rate=0.05, log=None):
+        self.driver = driver
+        self.recorder = recorder
+        self.token = token
+        self.random = random.Random(seed)
+        self.status_rate = status_rate
+        self.invalid_rate = invalid_rate
+        self.log = log
+
+    def send(self, team_id, channel_id, user, text):
+        from app.metrics import command_type
+
+        form = {
+            "token": self.token,
+            "team_id": team_id,
+            "channel_id": channel_id,
+            "user_id": user[0],
+            "user_name": user[1],
+            "text": text
+        }
+        if self.log != None:
+            self.log(form)
+        start = time.time()
+        (status, body, queries) = self.driver.send(form)
+        elapsed = time.time() - start
+        self.recorder.add(command_type(text), elapsed, queries, status == 200)
+        return body
+
+    def play_channel(self, team_id, channel_id, games):
+        from app.constants import MOVES
+
+        users = [("U%s%02d" % (channel_id, i), "%s_user%d" % (channel_id, i))
+                 for i in range(4)]
+        for game_number in range(games):
+            (first, second) = self.random.sample(users, 2)
+            spectator = [user for user in users
+                         if user not in (first, second)][0]
+            self.send(team_id, channel_id, first,
+                      "challenge @%s" % second[1])
+            body = self.send(team_id, channel_id, second, "accept")
+            if "has the first turn" not in body:
+                continue
+            turn = first if "%s has the first turn" % first[1] in body \
+                else second
+            squares = list(MOVES)
+            self.random.shuffle(squares)
+            for square in squares:
+                if self.random.random() < self.status_rate:
+                    self.send(team_id, channel_id, spectator, "status")
+                if self.random.random() < self.invalid_rate:
+                    self.send(team_id, channel_id, spectator, "gibberish")
+                body = self.send(team_id, channel_id, turn, square)
+                if "Game over" in body or "draw" in body:
+                    break
+                turn = second if turn == first else first
+
+    def replay(self, forms):
+        from app.metrics import command_type
+
+        for form in forms:
+            form = dict(form, token=self.token)
+            start = time.time()
+            (status, body, queries) = self.driver.send(form)
+            self.recorder.add(command_type(form["text"]), time.time() - start,
+                              queries, status == 200)
+
+
+def run_generated(driver, args, token):
+    """Plays games on every channel, spreading channels over threads."""
+    channels = [("T%03d" % team, "C%03d%04d" % (team, channel))
+                for team in range(args.teams)
+                for channel in range(args.channels)]
+    recorder = Recorder()
+    record_file = open(args.record, "w") if args.record else None
+    record_lock = threading.Lock()
+
+    def log(form):
+        with record_lock:
+            form = dict(form)
+            form.pop("token")
+            record_file.write(json.dumps(form, sort_keys=True) + "\n")
+
+    def worker(index):
+        generator = TrafficGenerator(driver, recorder, token,
+                                     args.seed + index,
+                                     log=log if record_file else None)
+        for (team_id, channel_id) in channels[index::args.threads]:
+            generator.play_channel(team_id, channel_id, args.games)
+
+    duration = _run_threads(worker, args.threads)
+    if record_file != None:
+        record_file.close()
+    return recorder.summary(duration)
+
+
+def run_replay(driver, args, token):
+    """Replays recorded commands, keeping each channel's commands in order."""
+    by_channel = {}
+    with open(args.replay) as replay_file:
+        for line in replay_file:
+            form = json.loads(line)
+            key = (form["team_id"], form["channel_id"])
+            by_channel.setdefault(key, []).append(form)
+    streams = [by_channel[key] for key in sorted(by_channel)]
+    recorder = Recorder()
+
+    def worker(index):
+        generator = TrafficGenerator(driver, recorder, token, args.seed)
+        for stream in streams[index::args.threads]:
+            generator.replay(stream)
+
+    duration = _run_threads(worker, args.threads)
+    return recorder.summary(duration)
+
+
+def _run_threads(worker, count):
+    """Runs worker(index) on count threads and returns the elapsed time."""
+    threads = [threading.Thread(target=worker, args=(index,))
+               for index in range(count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def print_summary(results):
+    print("%s: %d commands in %.2fs, %.1f req/s, %d errors" % (
+        results["driver"], results["commands"], results["duration_seconds"],
+        results["requests_per_second"] or 0, results["errors"]))
+    print("%-10s %7s %9s %9s %9s %9s" % ("command", "count", "p50 ms",
+                                         "p95 ms", "p99 ms", "queries"))
+    for kind in COMMAND_TYPES:
+        latency = results["latency_ms"].get(kind)
+        if latency == None:
+            continue
+        queries = results["queries_per_command"].get(kind)
+        print("%-10s %7d %9.2f %9.2f %9.2f %9s" % (
+            kind, latency["count"], latency["p50"], latency["p95"],
+            latency["p99"], "%.1f" % queries["mean"] if queries else "-"))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--driver", default="test_client",
+                        choices=["test_client", "gunicorn", "http"])
+    parser.add_argument("--url", help="server to target with --driver http")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="gunicorn worker processes")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--database-url",
+                        help="defaults to a fresh SQLite file")
+    parser.add_argument("--store", default="database",
+                        choices=["database", "sqlite", "memory"],
+                        help="where the app keeps its games")
+    parser.add_argument("--teams", type=int, default=3)
+    parser.add_argument("--channels", type=int, default=10,
+                        help="channels per team")
+    parser.add_argument("--games", type=int, default=2,
+                        help="games played per channel")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--record", help="write generated traffic here")
+    parser.add_argument("--replay", help="replay traffic from this file")
+    parser.add_argument("--label", help="stored with the results")
+    parser.add_argument("--output", help="write JSON results here")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.database_url == None:
+        handle, path = tempfile.mkstemp(prefix="ttt-benchmark-",
+                                        suffix=".db")
+        os.close(handle)
+        args.database_url = "sqlite:///" + path
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["GAME_STORE"] = args.store
+    token = os.environ.setdefault("SLACK_TOKEN", "benchmark")
+
+    from app import db
+    db.create_all()
+
+    if args.driver == "test_client":
+        driver = TestClientDriver()
+    elif args.driver == "gunicorn":
+        driver = HttpDriver(None, workers=args.workers, port=args.port)
+    else:
+        driver = HttpDriver(args.url)
+
+    try:
+        if args.replay:
+            results = run_replay(driver, args, token)
+        else:
+            results = run_generated(driver, args, token)
+    finally:
+        driver.close()
+
+    results["driver"] = driver.name
+    results["label"] = args.label
+    results["parameters"] = {
+        "teams": args.teams,
+        "channels": args.channels,
+        "games": args.games,
+        "threads": args.threads,
+        "workers": args.workers if args.driver == "gunicorn" else None,
+        "database": args.database_url.split(":", 1)[0],
+        "store": args.store,
+        "replay": args.replay
+    }
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -7,6 +7,84 @@ class BaseConfiguration(object):
     TESTING = False
     SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
 
+    # Spread teams over several databases. SHARDS maps each extra shard's
+    # name to its database URL and is read from a space separated list of
+    # name=url pairs. The database at DATABASE_URL is the 'default' shard and
+    # keeps the directory of which team is on which shard. Every shard gets
+    # its own engine and connection pool as a Flask-SQLAlchemy bind.
+    SHARDS = dict(pair.split('=', 1)
+                  for pair in os.environ.get('SHARDS', '').split())
+    SQLALCHEMY_BINDS = SHARDS
+
+    # Where games are kept: 'database' for DATABASE_URL, 'sqlite' for a
+    # SQLite file on a single node, or 'memory' for the process's memory, for
+    # tests and benchmarks. Any GameStore object works as well.
+    GAME_STORE = os.environ.get('GAME_STORE', 'database')
+
+    # Per-request query, database, render and handler timings, served on
+    # /metrics to the listed addresses and optionally added to responses.
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED') == 'true'
+    METRICS_DEBUG_HEADER = os.environ.get('METRICS_DEBUG_HEADER') == 'true'
+    METRICS_ALLOWED_ADDRS = ['127.0.0.1', '::1']
+
+    # Acknowledge commands right away and post their results to Slack's
+    # response_url from ASYNC_WORKERS threads. Each thread serves its own
+    # share of the channels from a queue of ASYNC_QUEUE_SIZE commands.
+    # RESPONSE_DELIVERY can be any object with a post(url, payload) method;
+    # it defaults to posting over HTTP.
+    ASYNC_RESPONSES = os.environ.get('ASYNC_RESPONSES') == 'true'
+    ASYNC_WORKERS = int(os.environ.get('ASYNC_WORKERS', 8))
+    ASYNC_QUEUE_SIZE = int(os.environ.get('ASYNC_QUEUE_SIZE', 100))
+    RESPONSE_DELIVERY = None
+
+    # Answer moves from memory and write them to the database in batches,
+    # every WRITE_BEHIND_INTERVAL seconds or once WRITE_BEHIND_BATCH moves are
+    # waiting. Until then moves are kept in a journal per process, named
+    # WRITE_BEHIND_JOURNAL followed by the process id. The app has to run as
+    # a single process, so WEB_CONCURRENCY must not be more than 1.
+    WRITE_BEHIND = os.environ.get('WRITE_BEHIND') == 'true'
+    WRITE_BEHIND_JOURNAL = os.environ.get('WRITE_BEHIND_JOURNAL',
+                                          '/tmp/ttt-moves.journal')
+    WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 1))
+    WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', 100))
+
+    # Give each player TURN_TIMEOUT seconds per move before they forfeit the
+    # game; 0 turns the timers off.
+    TURN_TIMEOUT = int(os.environ.get('TURN_TIMEOUT', 0))
+
+    # Challenges expire after CHALLENGE_TTL seconds and are deleted
+    # CHALLENGE_RETENTION seconds after they were made. Housekeeping runs
+    # with `python manage.py housekeeping`, or every HOUSEKEEPING_INTERVAL
+    # seconds when that is not 0, in batches of HOUSEKEEPING_BATCH rows.
+    CHALLENGE_TTL = int(os.environ.get('CHALLENGE_TTL', 3600))
+    CHALLENGE_RETENTION = int(os.environ.get('CHALLENGE_RETENTION',
+                                             7 * 24 * 3600))
+    HOUSEKEEPING_INTERVAL = int(os.environ.get('HOUSEKEEPING_INTERVAL', 0))
+    HOUSEKEEPING_BATCH = int(os.environ.get('HOUSEKEEPING_BATCH', 500))
+
+    # A command Slack delivers again within IDEMPOTENCY_TTL seconds, with
+    # the same trigger_id, gets the first delivery's response instead of
+    # running twice; 0 runs every delivery.
+    IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 300))
+
+    # Limit how many commands of each type a user and a whole team may send,
+    # as a (per_minute, burst) pair each; types left out fall back to
+    # 'default'. Limits are kept per process unless RATE_LIMIT_FILE names a
+    # file shared by the processes of the host. RATE_LIMIT_BACKEND can be any
+    # object with take(key, rate, burst) and give_back(key, burst) methods.
+    RATE_LIMITS_ENABLED = os.environ.get('RATE_LIMITS_ENABLED') == 'true'
+    RATE_LIMITS = {
+        'move': {'user': (60, 10), 'team': (1200, 100)},
+        'challenge': {'user': (20, 5), 'team': (300, 30)},
+        'accept': {'user': (20, 5), 'team': (300, 30)},
+        'status': {'user': (30, 5), 'team': (300, 30)},
+        'stats': {'user': (20, 5), 'team': (200, 20)},
+        'help': {'user': (20, 5), 'team': (200, 20)},
+        'default': {'user': (10, 3), 'team': (100, 10)}
+    }
+    RATE_LIMIT_FILE = os.environ.get('RATE_LIMIT_FILE')
+    RATE_LIMIT_BACKEND = None
+
 
 class TestConfiguration(BaseConfiguration):
     TESTING = True
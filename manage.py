@@ -0,0 +1,49 @@
+"""This module runs maintenance commands against the app's database.
+
+Type 'python manage.py' to see the available commands.
+"""
+
+from flask_script import Manager
+
+from app import app, shards
+from app.constants import MOVE_BATCH_SIZE
+from app.housekeeping import sweep
+from app.stats import rebuild_records, REBUILD_BATCH_SIZE
+
+manager = Manager(app)
+
+
+@manager.option('--batch', dest='batch_size', type=int, default=None,
+                help='rows handled per transaction')
+def housekeeping(batch_size):
+    """Expires stale challenges and deletes rows commands no longer need."""
+    result = sweep(batch_size=batch_size)
+    for name in sorted(result):
+        print("%s: %d" % (name, result[name]))
+
+
+@manager.option('--batch', dest='batch_size', type=int,
+                default=REBUILD_BATCH_SIZE, help='games read per query')
+def rebuild_stats(batch_size):
+    """Recomputes every player's record from the finished games."""
+    games = 0
+    for shard in shards.shard_names():
+        shards.bind_shard(shard)
+        games += rebuild_records(batch_size)
+    shards.bind_shard(shards.DEFAULT_SHARD)
+    print("games counted: %d" % games)
+
+
+@manager.option('shard', help='the name of the shard to move the team to')
+@manager.option('team_id', help='the Slack id of the team to move')
+@manager.option('--batch', dest='batch_size', type=int,
+                default=MOVE_BATCH_SIZE, help='rows copied per transaction')
+def move_team(team_id, shard, batch_size):
+    """Moves a team's rows to another shard."""
+    result = shards.move_team(team_id, shard, batch_size)
+    for name in sorted(result):
+        print("%s: %d" % (name, result[name]))
+
+
+if __name__ == '__main__':
+    manager.run()
@@ -0,0 +1,42 @@
+"""This module runs the Alembic migrations against the app's database."""
+
+from __future__ import with_statement
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import engine_from_config, pool
+
+from app import app, db
+
+config = context.config
+fileConfig(config.config_file_name)
+config.set_main_option('sqlalchemy.url',
+                       app.config['SQLALCHEMY_DATABASE_URI'])
+target_metadata = db.metadata
+
+
+def run_migrations_offline():
+    """Emits the migrations as SQL without connecting to the database."""
+    context.configure(url=config.get_main_option('sqlalchemy.url'),
+                      target_metadata=target_metadata,
+                      literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """Runs the migrations over a connection to the database."""
+    connectable = engine_from_config(config.get_section(config.config_ini_section),
+                                     prefix='sqlalchemy.',
+                                     poolclass=pool.NullPool)
+    with connectable.connect() as connection:
+        context.configure(connection=connection,
+                          target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
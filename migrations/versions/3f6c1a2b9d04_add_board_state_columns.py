@@ -0,0 +1,80 @@
+"""add board state columns
+
+Revision ID: 3f6c1a2b9d04
+Revises: None
+Create Date: 2026-10-18 10:12:41.503118
+
+The first revision assumes the original tables already exist, as created by
+db.create_all(). Games that are in progress are backfilled from their pieces.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f6c1a2b9d04'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.board import cell_bit, mark_dead_lines
+
+
+game = sa.table('game',
+                sa.column('id', sa.Integer),
+                sa.column('board_size', sa.Integer),
+                sa.column('win_length', sa.Integer),
+                sa.column('player1_id', sa.Integer),
+                sa.column('x_mask', sa.String),
+                sa.column('o_mask', sa.String),
+                sa.column('dead_lines', sa.String))
+
+piece = sa.table('piece',
+                 sa.column('game_id', sa.Integer),
+                 sa.column('player_id', sa.Integer),
+                 sa.column('x_coord', sa.Integer),
+                 sa.column('y_coord', sa.Integer))
+
+
+def upgrade():
+    op.add_column('game', sa.Column('win_length', sa.Integer()))
+    op.add_column('game', sa.Column('x_mask', sa.String()))
+    op.add_column('game', sa.Column('o_mask', sa.String()))
+    op.add_column('game', sa.Column('dead_lines', sa.String()))
+
+    connection = op.get_bind()
+    games = connection.execute(
+        sa.select([game.c.id, game.c.board_size, game.c.player1_id])
+    ).fetchall()
+    for (game_id, board_size, player1_id) in games:
+        x_mask = 0
+        o_mask = 0
+        dead_lines = 0
+        pieces = connection.execute(
+            sa.select([piece.c.player_id, piece.c.x_coord, piece.c.y_coord])
+            .where(piece.c.game_id == game_id)
+            .order_by(piece.c.x_coord, piece.c.y_coord)
+        ).fetchall()
+        for (player_id, x, y) in pieces:
+            if player_id == player1_id:
+                x_mask |= cell_bit(x, y, board_size)
+            else:
+                o_mask |= cell_bit(x, y, board_size)
+            dead_lines = mark_dead_lines(dead_lines, x_mask, o_mask, x, y,
+                                         board_size)
+        connection.execute(
+            game.update()
+            .where(game.c.id == game_id)
+            .values(win_length=board_size,
+                    x_mask='%x' % x_mask,
+                    o_mask='%x' % o_mask,
+                    dead_lines='%x' % dead_lines)
+        )
+
+
+def downgrade():
+    op.drop_column('game', 'dead_lines')
+    op.drop_column('game', 'o_mask')
+    op.drop_column('game', 'x_mask')
+    op.drop_column('game', 'win_length')
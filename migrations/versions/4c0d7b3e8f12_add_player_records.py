@@ -0,0 +1,47 @@
+"""add player records
+
+Revision ID: 4c0d7b3e8f12
+Revises: 9b1f4e7a2c65
+Create Date: 2026-10-18 19:47:22.518406
+
+The records start out empty. Run `python manage.py rebuild_stats` once after
+upgrading to count the games finished before them.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c0d7b3e8f12'
+down_revision = '9b1f4e7a2c65'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'player_record',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('team_id', sa.String(length=20), nullable=False),
+        sa.Column('channel_id', sa.String(length=20), nullable=False),
+        sa.Column('user_id', sa.String(length=20), nullable=False),
+        sa.Column('user_name', sa.String(length=25), nullable=True),
+        sa.Column('wins', sa.Integer(), nullable=False),
+        sa.Column('losses', sa.Integer(), nullable=False),
+        sa.Column('draws', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('uq_player_record_team_id_channel_id_user_id',
+                    'player_record', ['team_id', 'channel_id', 'user_id'],
+                    unique=True)
+    op.create_index('ix_player_record_ranking', 'player_record',
+                    ['team_id', 'channel_id', sa.text('wins DESC'), 'losses',
+                     'id'])
+
+
+def downgrade():
+    op.drop_index('ix_player_record_ranking', 'player_record')
+    op.drop_index('uq_player_record_team_id_channel_id_user_id',
+                  'player_record')
+    op.drop_table('player_record')
@@ -0,0 +1,93 @@
+"""add move log
+
+Revision ID: 5d8a2f61c7e0
+Revises: c51e9b07d2a3
+Create Date: 2026-10-18 15:42:17.219604
+
+Moves made before this revision were not recorded in order, so each game
+that already has pieces gets a snapshot of its current state instead, and
+its log starts after that snapshot.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d8a2f61c7e0'
+down_revision = 'c51e9b07d2a3'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+game = sa.table('game',
+                sa.column('id', sa.Integer),
+                sa.column('move_count', sa.Integer),
+                sa.column('current_player_name', sa.String),
+                sa.column('finished', sa.Boolean),
+                sa.column('x_mask', sa.String),
+                sa.column('o_mask', sa.String),
+                sa.column('dead_lines', sa.String))
+
+piece = sa.table('piece',
+                 sa.column('game_id', sa.Integer))
+
+
+def upgrade():
+    op.add_column('game', sa.Column('move_count', sa.Integer(),
+                                    nullable=False, server_default='0'))
+    op.create_table(
+        'move_event',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('sequence', sa.Integer(), nullable=False),
+        sa.Column('x_coord', sa.Integer()),
+        sa.Column('y_coord', sa.Integer()),
+        sa.Column('created_at', sa.DateTime()),
+        sa.Column('player_id', sa.Integer(), sa.ForeignKey('player.id')),
+        sa.Column('game_id', sa.Integer(), sa.ForeignKey('game.id')))
+    op.create_index('uq_move_event_game_id_sequence', 'move_event',
+                    ['game_id', 'sequence'], unique=True)
+    snapshot = op.create_table(
+        'game_snapshot',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('sequence', sa.Integer(), nullable=False),
+        sa.Column('current_player_name', sa.String(25)),
+        sa.Column('finished', sa.Boolean()),
+        sa.Column('x_mask', sa.String()),
+        sa.Column('o_mask', sa.String()),
+        sa.Column('dead_lines', sa.String()),
+        sa.Column('game_id', sa.Integer(), sa.ForeignKey('game.id')))
+    op.create_index('uq_game_snapshot_game_id_sequence', 'game_snapshot',
+                    ['game_id', 'sequence'], unique=True)
+
+    connection = op.get_bind()
+    counts = connection.execute(
+        sa.select([piece.c.game_id, sa.func.count()])
+        .group_by(piece.c.game_id)
+    ).fetchall()
+    for (game_id, count) in counts:
+        connection.execute(game.update().where(game.c.id == game_id)
+                           .values(move_count=count))
+    games = connection.execute(
+        sa.select([game.c.id, game.c.move_count, game.c.current_player_name,
+                   game.c.finished, game.c.x_mask, game.c.o_mask,
+                   game.c.dead_lines])
+        .where(game.c.move_count > 0)
+    ).fetchall()
+    if games:
+        op.bulk_insert(snapshot, [
+            {"game_id": game_id, "sequence": move_count,
+             "current_player_name": current_player_name,
+             "finished": finished, "x_mask": x_mask, "o_mask": o_mask,
+             "dead_lines": dead_lines}
+            for (game_id, move_count, current_player_name, finished, x_mask,
+                 o_mask, dead_lines) in games
+        ])
+
+
+def downgrade():
+    op.drop_index('uq_game_snapshot_game_id_sequence', 'game_snapshot')
+    op.drop_table('game_snapshot')
+    op.drop_index('uq_move_event_game_id_sequence', 'move_event')
+    op.drop_table('move_event')
+    op.drop_column('game', 'move_count')
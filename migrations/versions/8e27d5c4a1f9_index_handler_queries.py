@@ -0,0 +1,62 @@
+"""index handler queries
+
+Revision ID: 8e27d5c4a1f9
+Revises: 3f6c1a2b9d04
+Create Date: 2026-10-18 11:40:07.221950
+
+Replaces the single-column indexes that no query uses with composite indexes
+matching the lookups in context.py and api.py. The unique indexes fail to
+build if the tables already hold duplicate rows, which have to be removed by
+hand first.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e27d5c4a1f9'
+down_revision = '3f6c1a2b9d04'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.drop_index('ix_piece_x_coord', table_name='piece')
+    op.drop_index('ix_piece_y_coord', table_name='piece')
+    op.create_index('uq_piece_game_id_x_coord_y_coord', 'piece',
+                    ['game_id', 'x_coord', 'y_coord'], unique=True)
+
+    op.drop_index('ix_player_user_id', table_name='player')
+    op.create_index('uq_player_channel_id_user_id', 'player',
+                    ['channel_id', 'user_id'], unique=True)
+
+    op.drop_index('ix_channel_channel_id', table_name='channel')
+    op.create_index('uq_channel_team_id_channel_id', 'channel',
+                    ['team_id', 'channel_id'], unique=True)
+
+    op.drop_index('ix_team_team_id', table_name='team')
+    op.create_index('ix_team_team_id', 'team', ['team_id'], unique=True)
+
+    op.create_index('ix_game_channel_id_id', 'game',
+                    ['channel_id', sa.text('id DESC')])
+    op.create_index('ix_challenge_channel_id_id', 'challenge',
+                    ['channel_id', sa.text('id DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_challenge_channel_id_id', table_name='challenge')
+    op.drop_index('ix_game_channel_id_id', table_name='game')
+
+    op.drop_index('ix_team_team_id', table_name='team')
+    op.create_index('ix_team_team_id', 'team', ['team_id'])
+
+    op.drop_index('uq_channel_team_id_channel_id', table_name='channel')
+    op.create_index('ix_channel_channel_id', 'channel', ['channel_id'])
+
+    op.drop_index('uq_player_channel_id_user_id', table_name='player')
+    op.create_index('ix_player_user_id', 'player', ['user_id'])
+
+    op.drop_index('uq_piece_game_id_x_coord_y_coord', table_name='piece')
+    op.create_index('ix_piece_x_coord', 'piece', ['x_coord'])
+    op.create_index('ix_piece_y_coord', 'piece', ['y_coord'])
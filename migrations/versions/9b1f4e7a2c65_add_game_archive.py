@@ -0,0 +1,62 @@
+"""add game archive
+
+Revision ID: 9b1f4e7a2c65
+Revises: e2b84c6f0d17
+Create Date: 2026-10-18 19:12:05.331842
+
+Finished games stay in the live tables until the next housekeeping sweep
+archives them.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b1f4e7a2c65'
+down_revision = 'e2b84c6f0d17'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'game_archive',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('game_id', sa.Integer(), nullable=True),
+        sa.Column('team_id', sa.String(length=20), nullable=True),
+        sa.Column('channel_id', sa.String(length=20), nullable=True),
+        sa.Column('player1_user_id', sa.String(length=20), nullable=True),
+        sa.Column('player1_name', sa.String(length=25), nullable=True),
+        sa.Column('player2_user_id', sa.String(length=20), nullable=True),
+        sa.Column('player2_name', sa.String(length=25), nullable=True),
+        sa.Column('winner_name', sa.String(length=25), nullable=True),
+        sa.Column('result', sa.String(length=10), nullable=True),
+        sa.Column('board_size', sa.Integer(), nullable=True),
+        sa.Column('win_length', sa.Integer(), nullable=True),
+        sa.Column('x_mask', sa.String(), nullable=True),
+        sa.Column('o_mask', sa.String(), nullable=True),
+        sa.Column('move_count', sa.Integer(), nullable=True),
+        sa.Column('moves', sa.Text(), nullable=True),
+        sa.Column('first_move_at', sa.DateTime(), nullable=True),
+        sa.Column('last_move_at', sa.DateTime(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_game_archive_team_id_channel_id_id', 'game_archive',
+                    ['team_id', 'channel_id', sa.text('id DESC')])
+    op.create_index('ix_game_archive_team_id_player1_user_id_id',
+                    'game_archive',
+                    ['team_id', 'player1_user_id', sa.text('id DESC')])
+    op.create_index('ix_game_archive_team_id_player2_user_id_id',
+                    'game_archive',
+                    ['team_id', 'player2_user_id', sa.text('id DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_game_archive_team_id_player2_user_id_id',
+                  'game_archive')
+    op.drop_index('ix_game_archive_team_id_player1_user_id_id',
+                  'game_archive')
+    op.drop_index('ix_game_archive_team_id_channel_id_id', 'game_archive')
+    op.drop_table('game_archive')
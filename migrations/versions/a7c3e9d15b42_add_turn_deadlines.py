@@ -0,0 +1,28 @@
+"""add turn deadlines
+
+Revision ID: a7c3e9d15b42
+Revises: 5d8a2f61c7e0
+Create Date: 2026-10-18 17:20:03.584411
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9d15b42'
+down_revision = '5d8a2f61c7e0'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('game', sa.Column('turn_deadline', sa.Integer()))
+    op.add_column('game', sa.Column('response_url', sa.String(255)))
+    op.create_index('ix_game_turn_deadline', 'game', ['turn_deadline'])
+
+
+def downgrade():
+    op.drop_index('ix_game_turn_deadline', 'game')
+    op.drop_column('game', 'response_url')
+    op.drop_column('game', 'turn_deadline')
@@ -0,0 +1,28 @@
+"""add version columns
+
+Revision ID: c51e9b07d2a3
+Revises: 8e27d5c4a1f9
+Create Date: 2026-10-18 13:05:52.874310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c51e9b07d2a3'
+down_revision = '8e27d5c4a1f9'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('game', sa.Column('version', sa.Integer(), nullable=False,
+                                    server_default='1'))
+    op.add_column('challenge', sa.Column('version', sa.Integer(),
+                                         nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('challenge', 'version')
+    op.drop_column('game', 'version')
@@ -0,0 +1,55 @@
+"""add player active game
+
+Revision ID: d7e3a90c4b18
+Revises: 4c0d7b3e8f12
+Create Date: 2026-10-18 20:26:40.174093
+
+Each player in an unfinished game is pointed at it, except the bot, which
+can play any number of games at once. Challenges are looked up by the
+opponent they are addressed to instead of only by channel.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7e3a90c4b18'
+down_revision = '4c0d7b3e8f12'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+BOT_USER_ID = 'USLACKTTTBOT'
+
+player = sa.table('player',
+                  sa.column('id', sa.Integer),
+                  sa.column('user_id', sa.String),
+                  sa.column('active_game_id', sa.Integer))
+game = sa.table('game',
+                sa.column('id', sa.Integer),
+                sa.column('finished', sa.Boolean),
+                sa.column('player1_id', sa.Integer),
+                sa.column('player2_id', sa.Integer))
+
+
+def upgrade():
+    op.add_column('player', sa.Column('active_game_id', sa.Integer()))
+    active_game_id = (sa.select([sa.func.max(game.c.id)])
+                      .where(sa.and_(game.c.finished == sa.false(),
+                                     sa.or_(game.c.player1_id == player.c.id,
+                                            game.c.player2_id == player.c.id)))
+                      .as_scalar())
+    op.execute(player.update()
+               .where(player.c.user_id != BOT_USER_ID)
+               .values(active_game_id=active_game_id))
+
+    op.drop_index('ix_challenge_channel_id_id', 'challenge')
+    op.create_index('ix_challenge_channel_id_opponent_name_id', 'challenge',
+                    ['channel_id', 'opponent_name', sa.text('id DESC')])
+
+
+def downgrade():
+    op.drop_index('ix_challenge_channel_id_opponent_name_id', 'challenge')
+    op.create_index('ix_challenge_channel_id_id', 'challenge',
+                    ['channel_id', sa.text('id DESC')])
+    op.drop_column('player', 'active_game_id')
@@ -0,0 +1,36 @@
+"""add challenge created_at
+
+Revision ID: e2b84c6f0d17
+Revises: a7c3e9d15b42
+Create Date: 2026-10-18 18:31:47.906215
+
+Existing challenges are dated to the time of the migration, so the open ones
+expire CHALLENGE_TTL seconds after it.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2b84c6f0d17'
+down_revision = 'a7c3e9d15b42'
+branch_labels = None
+depends_on = None
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+challenge = sa.table('challenge',
+                     sa.column('created_at', sa.DateTime))
+
+
+def upgrade():
+    op.add_column('challenge', sa.Column('created_at', sa.DateTime()))
+    op.execute(challenge.update().values(created_at=datetime.utcnow()))
+    op.create_index('ix_challenge_created_at', 'challenge', ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_challenge_created_at', 'challenge')
+    op.drop_column('challenge', 'created_at')
@@ -0,0 +1,36 @@
+"""add team shards
+
+Revision ID: f3a8c5d1e6b9
+Revises: d7e3a90c4b18
+Create Date: 2026-10-18 21:12:05.903217
+
+The directory of which shard each team is kept on. It is only used in the
+default database, but created in every shard's so that all shards share one
+revision history.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f3a8c5d1e6b9'
+down_revision = 'd7e3a90c4b18'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'team_shard',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('team_id', sa.String(length=20), nullable=False),
+        sa.Column('shard', sa.String(length=50), nullable=False),
+        sa.Column('moving', sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('team_id')
+    )
+
+
+def downgrade():
+    op.drop_table('team_shard')
@@ -1,14 +1,104 @@
 """This module contains all the tests for this application."""
 
 from flask_testing import TestCase
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 import unittest
 import json
+import os
+import StringIO
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from app import app, db, api
 from app.models import *
-from app.api import get_current_board
+from app.api import get_current_board, run_command
+from app.context import (load_context, identity_cache, claim_players,
+                         release_players)
+from app.board import (cell_bit, victory, winning_move, board_full,
+                       line_masks, mark_dead_lines, all_lines_dead,
+                       render_board)
+from app.cache import LRUCache, TTLCache
+from app.metrics import Histogram, registry
+from app.workers import (HttpDelivery, WorkerPool, ChannelDispatcher,
+                         get_dispatcher, shutdown_dispatcher, submit_command,
+                         channel_lock)
+from app.hashring import HashRing
+from app.events import load_state, replay, export_events
+from app.solver import Solver, Symmetries, get_solver
+from app.overview import active_games
+from app.archive import pack_moves, unpack_moves, history
+from app.stats import leaderboard, rebuild_records, TEAM_SCOPE
+from app.housekeeping import (expire_challenges, delete_challenges,
+                              archive_finished_games, sweep)
+from app.timers import (TurnTimers, forfeit_expired, get_turn_timers,
+                        shutdown_turn_timers)
+from app.idempotency import (Deduplicator, command_fingerprint,
+                             get_deduplicator)
+from app.ratelimit import TokenBuckets, SharedTokenBuckets
+from app.store import GameStore, MemoryStore, SqliteStore, get_store
+from app import shards
+from app.shards import (bind_shard, bind_team, locate_team, move_team,
+                        shard_engine, directory_cache, DEFAULT_SHARD)
+from app.writebehind import (get_write_behind, shutdown_write_behind,
+                             recover)
 from app.constants import *
 
+# Tests that look at the rows of the database directly only run with the
+# stores that keep them there, not with GAME_STORE=memory.
+needs_database = unittest.skipIf(
+    os.environ.get('GAME_STORE') == 'memory', "inspects the database")
+
+
+def current_game(user_id='U2W2V2KL6'):
+    """Returns the active game of a player of the test channel.
+
+    The game is found through the configured store, so this works with
+    every GAME_STORE.
+    """
+
+    return get_store().load('T2W2QQW5A', 'C2W35PTRV', user_id).active_game
+
+
+def play_game(client, moves, challenge=None, accept=None):
+    """Plays moves in a new game between michael and victoria.
+
+    The moves alternate between the players, starting with the one who has
+    the first turn. challenge and accept replace michael's challenge and
+    victoria's accept when given.
+
+    Returns:
+        A tuple (game, players, response) of the game, the move forms of the
+        player who started and of the other one, and the response to the
+        last move, or None if no moves were given.
+    """
+
+    client.post('/', data=challenge or ApiTests.michael_challenge)
+    client.post('/', data=accept or ApiTests.victoria_accept)
+    game = current_game()
+    players = [ApiTests.michael_move, ApiTests.victoria_move]
+    if game.current_player_name == 'victoria':
+        players.reverse()
+    response = None
+    for (i, move) in enumerate(moves):
+        response = client.post('/', data=dict(players[i % 2], text=move))
+    return (game, players, response)
+
+
+WINNING_MOVES = ['topleft', 'left', 'top', 'center', 'topright']
+DRAWN_MOVES = ['topleft', 'center', 'bottomright', 'top', 'bottom',
+               'bottomleft', 'topright', 'right', 'left']
+
 
 class BaseTestCase(TestCase):
     """A base test case for this application."""
@@ -19,6 +109,7 @@ class BaseTestCase(TestCase):
 
     def setUp(self):
         db.create_all()
+        identity_cache.clear()
 
     def tearDown(self):
         db.session.remove()
@@ -61,6 +152,20 @@ class ApiTests(BaseTestCase):
         text='status',
     )
 
+    bob_challenge = dict(
+        base_data,
+        user_id='U2W2BOB00',
+        user_name='bob',
+        text='challenge alice',
+    )
+
+    alice_accept = dict(
+        base_data,
+        user_id='U2W2ALICE',
+        user_name='alice',
+        text='accept',
+    )
+
     michael_move = dict(
         base_data,
         user_id='U2W2V2KL6',
@@ -84,6 +189,7 @@ class ApiTests(BaseTestCase):
         assert response.status_code == 200
         assert response.data == INVALID_COMMAND_ERROR
 
+    @needs_database
     def test_challenge_success(self):
         response = self.client.post('/', data=self.michael_challenge)
         assert Team.query.count() == 1
@@ -98,6 +204,7 @@ class ApiTests(BaseTestCase):
                              "tic-tac-toe!\nType `/ttt accept` to start the "
                              "game.")
 
+    @needs_database
     def test_accept_success(self):
         self.client.post('/', data=self.michael_challenge)
         response = self.client.post('/', data=self.victoria_accept)
@@ -121,13 +228,14 @@ class ApiTests(BaseTestCase):
         self.client.post('/', data=self.victoria_accept)
         response = self.client.post('/', data=self.michael_challenge)
         assert Challenge.query.count() != 2
-        assert response.data == CANNOT_CHALLENGE_ERROR
+        assert response.data == ALREADY_PLAYING_ERROR
 
     def test_accept_failure(self):
         response = self.client.post('/', data=self.victoria_accept)
         assert Game.query.count() != 1
         assert response.data == NO_CHALLENGE_ERROR
 
+    @needs_database
     def test_get_current_board(self):
         self.client.post('/', data=self.michael_challenge)
         self.client.post('/', data=self.victoria_accept)
@@ -148,6 +256,7 @@ class ApiTests(BaseTestCase):
                                    "---+---+---\n"
                                    " X |   |   ```")
 
+    @needs_database
     def test_status_success(self):
         self.client.post('/', data=self.michael_challenge)
         self.client.post('/', data=self.victoria_accept)
@@ -174,16 +283,15 @@ class ApiTests(BaseTestCase):
     def test_move_success(self):
         self.client.post('/', data=self.michael_challenge)
         self.client.post('/', data=self.victoria_accept)
-        game = Game.query.first()
+        game = current_game()
 
         if game.current_player_name == 'michael':
             response = self.client.post('/', data=self.michael_move)
         else:
             response = self.client.post('/', data=self.victoria_move)
 
-        assert game.pieces.count() == 1
-        assert game.pieces.first().x_coord == 1
-        assert game.pieces.first().y_coord == 0
+        assert game.move_count == 1
+        assert game.is_taken(1, 0)
 
     def test_move_failure(self):
         response = self.client.post('/', data=self.michael_move)
@@ -192,7 +300,7 @@ class ApiTests(BaseTestCase):
     def test_square_already_taken_failure(self):
         self.client.post('/', data=self.michael_challenge)
         self.client.post('/', data=self.victoria_accept)
-        game = Game.query.first()
+        game = current_game()
 
         if game.current_player_name == 'michael':
             self.client.post('/', data=self.michael_move)
@@ -201,22 +309,35 @@ class ApiTests(BaseTestCase):
             self.client.post('/', data=self.victoria_move)
             response = self.client.post('/', data=self.michael_move)
 
-        assert game.pieces.count() == 1
+        assert game.move_count == 1
         assert response.data == SQUARE_TAKEN_ERROR
 
-    def test_not_your_turn_failure(self):
+    @needs_database
+    def test_square_unique_constraint(self):
         self.client.post('/', data=self.michael_challenge)
         self.client.post('/', data=self.victoria_accept)
         game = Game.query.first()
+        michael = Player.query.filter_by(user_name='michael').first()
+        victoria = Player.query.filter_by(user_name='victoria').first()
+
+        db.session.add(Piece(1, 0, michael, game))
+        db.session.add(Piece(1, 0, victoria, game))
+        self.assertRaises(IntegrityError, db.session.commit)
+
+    def test_not_your_turn_failure(self):
+        self.client.post('/', data=self.michael_challenge)
+        self.client.post('/', data=self.victoria_accept)
+        game = current_game()
 
         if game.current_player_name == 'michael':
             response = self.client.post('/', data=self.victoria_move)
         else:
             response = self.client.post('/', data=self.michael_move)
 
-        assert game.pieces.count() == 0
+        assert game.move_count == 0
         assert response.data == INCORRECT_TURN_ERROR
 
+    @needs_database
     def test_victory(self):
         self.client.post('/', data=self.michael_challenge)
         self.client.post('/', data=self.victoria_accept)
@@ -242,6 +363,7 @@ class ApiTests(BaseTestCase):
         assert resp_text == ("{0} Game over! {1} has won the game :fire:"
                              .format(board, game.current_player_name))
 
+    @needs_database
     def test_draw(self):
         self.client.post('/', data=self.michael_challenge)
         self.client.post('/', data=self.victoria_accept)
@@ -270,6 +392,1702 @@ class ApiTests(BaseTestCase):
         assert resp_text == ("{0} The game ended in a draw!"
                              .format(board))
 
+    @needs_database
+    def test_early_draw(self):
+        self.client.post('/', data=self.michael_challenge)
+        self.client.post('/', data=self.victoria_accept)
+        game = Game.query.first()
+        michael = Player.query.filter_by(user_name='michael').first()
+        victoria = Player.query.filter_by(user_name='victoria').first()
+
+        if game.current_player_name == 'michael':
+            michael_squares = [(0, 0), (0, 2), (2, 1)]
+            victoria_squares = [(0, 1), (1, 1), (1, 2), (2, 0)]
+        else:
+            michael_squares = [(0, 0), (0, 1), (1, 2), (2, 0)]
+            victoria_squares = [(0, 2), (1, 1), (2, 1)]
+        for (x, y) in michael_squares:
+            db.session.add(Piece(x, y, michael, game))
+        for (x, y) in victoria_squares:
+            db.session.add(Piece(x, y, victoria, game))
+
+        if game.current_player_name == 'michael':
+            response = self.client.post('/', data=self.michael_move)
+        else:
+            response = self.client.post('/', data=self.victoria_move)
+
+        assert game.finished == True
+        assert game.pieces.count() == 8
+
+        board = get_current_board(game)
+        resp_text = json.loads(response.data)['text']
+        assert resp_text == ("{0} The game ended in a draw!"
+                             .format(board))
+
+    def test_concurrent_games(self):
+        self.client.post('/', data=self.michael_challenge)
+        self.client.post('/', data=self.victoria_accept)
+        self.client.post('/', data=self.bob_challenge)
+        response = self.client.post('/', data=self.alice_accept)
+        assert "alice has accepted the challenge" in \
+            json.loads(response.data)['text']
+        (first, second) = (current_game(), current_game('U2W2BOB00'))
+        assert first.player1.user_name == 'michael'
+        assert second.player1.user_name == 'bob'
+
+        for game in (first, second):
+            player = game.player1 if game.current_player_name == \
+                game.player1.user_name else game.player2
+            self.client.post('/', data=dict(self.base_data,
+                                            user_id=player.user_id,
+                                            user_name=player.user_name,
+                                            text='center'))
+        assert [game.move_count for game in (first, second)] == [1, 1]
+
+        response = self.client.post('/', data=dict(self.status,
+                                                   user_id='U4',
+                                                   user_name='carol'))
+        lines = json.loads(response.data)['text'].split("\n")
+        assert lines[1].startswith("michael vs victoria, it's ")
+        assert lines[2].startswith("bob vs alice, it's ")
+
+    @needs_database
+    def test_accept_specific_challenge(self):
+        self.client.post('/', data=self.michael_challenge)
+        self.client.post('/', data=dict(self.bob_challenge,
+                                        text='challenge victoria'))
+        self.client.post('/', data=dict(self.victoria_accept,
+                                        text='accept @michael'))
+        game = Game.query.one()
+        assert game.player1.user_name == 'michael'
+        assert [challenge.expired for challenge in
+                Challenge.query.order_by(Challenge.id)] == [True, False]
+
+    def test_accept_without_name(self):
+        self.client.post('/', data=self.michael_challenge)
+        response = self.client.post('/', data=dict(self.victoria_accept,
+                                                   text='accept '))
+        assert "victoria has accepted the challenge" in \
+            json.loads(response.data)['text']
+
+        self.client.post('/', data=self.bob_challenge)
+        response = self.client.post('/', data=dict(self.alice_accept,
+                                                   text='accept @'))
+        assert "alice has accepted the challenge" in \
+            json.loads(response.data)['text']
+
+    def test_challenger_busy(self):
+        self.client.post('/', data=self.michael_challenge)
+        self.client.post('/', data=dict(self.michael_challenge,
+                                        text='challenge alice'))
+        self.client.post('/', data=self.victoria_accept)
+        response = self.client.post('/', data=self.alice_accept)
+        assert response.data == OPPONENT_BUSY_ERROR.format('michael')
+        response = self.client.post('/', data=self.victoria_accept)
+        assert response.data == ALREADY_PLAYING_ERROR
+
+    @needs_database
+    def test_claim_conflict(self):
+        self.client.post('/', data=self.michael_challenge)
+        self.client.post('/', data=self.victoria_accept)
+        game = Game.query.one()
+        michael = game.player1
+        db.session.execute(Player.__table__.update()
+                           .where(Player.id == michael.id)
+                           .values(active_game_id=None))
+        self.assertRaises(StaleDataError, claim_players, game, michael)
+
+        release_players([game.id])
+        db.session.commit()
+        assert Player.query.filter(Player.active_game_id != None).count() == 0
+
+
+class BoardTests(unittest.TestCase):
+    """Test cases for the bitboard game state"""
+
+    def test_line_masks(self):
+        masks = line_masks(3)
+        assert len(masks) == 8
+        assert 0b000000111 in masks
+        assert 0b001001001 in masks
+        assert 0b100010001 in masks
+        assert 0b001010100 in masks
+
+    def test_victory(self):
+        assert victory(0b000111000, 3)
+        assert victory(0b100010001, 3)
+        assert not victory(0b000110001, 3)
+
+    def test_k_in_a_row_lines(self):
+        assert len(line_masks(5, 4)) == 2 * 5 * 2 + 2 * 2 * 2
+        assert len(line_masks(15, 5)) == 2 * 15 * 11 + 2 * 11 * 11
+
+    def test_winning_move(self):
+        assert winning_move(0b000111000, 1, 2, 3)
+        assert not winning_move(0b000111001, 0, 0, 3)
+
+    def test_winning_move_k_in_a_row(self):
+        mask = 0
+        for i in range(5):
+            mask |= 1 << ((3 + i) * 15 + (7 - i))
+        assert winning_move(mask, 5, 5, 15, 5)
+        assert not winning_move(mask, 5, 5, 15, 6)
+        assert not winning_move(mask & ~(1 << (7 * 15 + 3)), 5, 5, 15, 5)
+
+    def test_dead_lines(self):
+        x_mask = 0b000000001
+        o_mask = 0b000010000
+        dead = mark_dead_lines(0, x_mask, o_mask, 1, 1, 3)
+        assert dead != 0
+        assert not all_lines_dead(dead, 3)
+
+        moves = [(0, 1, 'o'), (0, 2, 'x'), (1, 2, 'o'), (1, 0, 'x'),
+                 (2, 0, 'o'), (2, 1, 'x')]
+        for (x, y, player) in moves:
+            bit = 1 << (x * 3 + y)
+            if player == 'x':
+                x_mask |= bit
+            else:
+                o_mask |= bit
+            dead = mark_dead_lines(dead, x_mask, o_mask, x, y, 3)
+        assert not board_full(x_mask, o_mask, 3)
+        assert all_lines_dead(dead, 3)
+
+    def test_board_full(self):
+        assert board_full(0b101010101, 0b010101010, 3)
+        assert not board_full(0b101010101, 0b010001010, 3)
+
+    def test_render_board(self):
+        board_string = render_board(3, 0b001000001, 0b000110000)
+        assert board_string == ("``` X |   |   \n"
+                                "---+---+---\n"
+                                "   | O | O \n"
+                                "---+---+---\n"
+                                " X |   |   ```")
+        assert render_board(3, 0b001000001, 0b000110000) is board_string
+
+
+class CacheTests(unittest.TestCase):
+    """Test cases for the in-process caches"""
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert cache.get('b') == None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.stats()['hits'] == 3
+        assert cache.stats()['misses'] == 1
+
+    def test_lru_cache_invalidate(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.invalidate('a')
+        assert cache.get('a') == None
+        assert len(cache) == 0
+
+    def test_ttl_cache(self):
+        now = [100.0]
+        cache = TTLCache(10, 5, timer=lambda: now[0])
+        cache.set('a', 1)
+        now[0] += 4
+        assert cache.get('a') == 1
+        now[0] += 1
+        assert cache.get('a') == None
+        assert cache.stats()['misses'] == 1
+
+
+class ContextTests(BaseTestCase):
+    """Test cases for resolving the objects a command operates on"""
+
+    def setUp(self):
+        super(ContextTests, self).setUp()
+        team = Team('T2W2QQW5A')
+        channel = Channel('C2W35PTRV', team)
+        self.michael = Player('U2W2V2KL6', 'michael', channel)
+        self.victoria = Player('U2W2USDLG', 'victoria', channel)
+        db.session.add(Game(BOARD_SIZE, 'michael', channel, self.michael,
+                            self.victoria))
+        self.game = Game(BOARD_SIZE, 'victoria', channel, self.michael,
+                         self.victoria)
+        db.session.add(self.game)
+        db.session.flush()
+        self.michael.active_game_id = self.game.id
+        self.victoria.active_game_id = self.game.id
+        db.session.commit()
+
+    def test_load_context(self):
+        context = load_context('T2W2QQW5A', 'C2W35PTRV', 'U2W2USDLG')
+        assert context.team.team_id == 'T2W2QQW5A'
+        assert context.channel.channel_id == 'C2W35PTRV'
+        assert context.game == self.game
+        assert context.player == self.victoria
+        assert context.is_playing()
+
+    def test_load_context_without_user(self):
+        context = load_context('T2W2QQW5A', 'C2W35PTRV')
+        assert context.channel.channel_id == 'C2W35PTRV'
+        assert context.game == None
+        assert context.player == None
+        assert not context.is_playing()
+
+    def test_load_context_unknown_channel(self):
+        context = load_context('T2W2QQW5A', 'C00000000', 'U2W2USDLG')
+        assert context.team.team_id == 'T2W2QQW5A'
+        assert context.channel == None
+        assert context.game == None
+        assert context.player == None
+
+    def test_load_context_uses_identity_cache(self):
+        load_context('T2W2QQW5A', 'C2W35PTRV', 'U2W2USDLG')
+        hits = identity_cache.hits
+        context = load_context('T2W2QQW5A', 'C2W35PTRV', 'U2W2USDLG')
+        assert identity_cache.hits == hits + 2
+        assert context.team.team_id == 'T2W2QQW5A'
+        assert context.game == self.game
+        assert context.player == self.victoria
+
+    def test_load_context_stale_identity_cache(self):
+        load_context('T2W2QQW5A', 'C2W35PTRV', 'U2W2USDLG')
+        identity_cache.set(('channel', 'T2W2QQW5A', 'C2W35PTRV'), 999)
+        context = load_context('T2W2QQW5A', 'C2W35PTRV', 'U2W2USDLG')
+        assert context.channel.channel_id == 'C2W35PTRV'
+        assert context.player == self.victoria
+
+    def test_stale_game_update(self):
+        db.session.execute(Game.__table__.update()
+                           .where(Game.id == self.game.id)
+                           .values(version=Game.version + 1))
+        self.game.current_player_name = 'michael'
+        self.assertRaises(StaleDataError, db.session.commit)
+
+    @needs_database
+    def test_run_command_retries_conflicts(self):
+        attempts = []
+
+        def handler(context):
+            attempts.append(context.game.current_player_name)
+            context.game.current_player_name = 'michael'
+            if len(attempts) == 1:
+                raise StaleDataError('concurrent update')
+            db.session.commit()
+            return 'done'
+
+        response = run_command(handler, 'T2W2QQW5A', 'C2W35PTRV',
+                               'U2W2USDLG')
+        assert response == 'done'
+        assert attempts == ['victoria', 'victoria']
+        assert self.game.version == 2
+
+    def test_run_command_gives_up(self):
+        def handler(context):
+            raise StaleDataError('concurrent update')
+
+        self.assertRaises(StaleDataError, run_command, handler,
+                          'T2W2QQW5A', 'C2W35PTRV', None)
+
+    def test_load_context_unknown_team(self):
+        context = load_context('T00000000', 'C2W35PTRV', 'U2W2USDLG')
+        assert context.team == None
+        assert context.active_game == None
+
+
+class MetricsTests(BaseTestCase):
+    """Test cases for the request instrumentation"""
+
+    def setUp(self):
+        super(MetricsTests, self).setUp()
+        app.config['METRICS_ENABLED'] = True
+        app.config['METRICS_DEBUG_HEADER'] = True
+        registry.clear()
+
+    def tearDown(self):
+        app.config['METRICS_ENABLED'] = False
+        app.config['METRICS_DEBUG_HEADER'] = False
+        super(MetricsTests, self).tearDown()
+
+    def test_histogram(self):
+        histogram = Histogram([1, 2, 5])
+        for value in [0.5, 1.5, 1.5, 3, 10]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        assert snapshot['count'] == 5
+        assert snapshot['p50'] == 2
+        assert snapshot['p99'] == None
+        assert snapshot['buckets'] == {'1': 1, '2': 2, '5': 1, '+Inf': 1}
+
+    def test_debug_header(self):
+        response = self.client.post('/', data=ApiTests.michael_challenge)
+        header = response.headers['X-TTT-Metrics']
+        assert header.startswith('queries=')
+        assert 'render_ms=' in header
+
+    def test_failed_request(self):
+        def fail(*args):
+            raise RuntimeError("database is down")
+
+        dispatch_command = api.dispatch_command
+        api.dispatch_command = fail
+        try:
+            self.assertRaises(RuntimeError, self.client.post, '/',
+                              data=ApiTests.status)
+        finally:
+            api.dispatch_command = dispatch_command
+        assert registry.histogram('status.handler_ms').count == 1
+
+        app.config['METRICS_ENABLED'] = False
+        self.client.post('/', data=ApiTests.michael_challenge)
+        assert registry.histogram('status.handler_ms').count == 1
+        assert registry.histogram('challenge.handler_ms').count == 0
+
+    def test_metrics_endpoint(self):
+        self.client.post('/', data=ApiTests.michael_challenge)
+        self.client.post('/', data=ApiTests.status)
+        self.client.post('/', data=ApiTests.status)
+        response = self.client.get(
+            '/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        metrics = json.loads(response.data)
+        assert metrics['histograms']['status.handler_ms']['count'] == 2
+        assert metrics['histograms']['challenge.queries']['count'] == 1
+        assert 'identity_cache' in metrics['gauges']
+
+    def test_metrics_endpoint_disabled(self):
+        app.config['METRICS_ENABLED'] = False
+        response = self.client.get(
+            '/metrics', environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        assert response.status_code == 404
+
+    def test_metrics_endpoint_remote(self):
+        response = self.client.get(
+            '/metrics', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        assert response.status_code == 404
+
+
+class HashRingTests(unittest.TestCase):
+    """Test cases for consistent hashing"""
+
+    def test_hash_ring(self):
+        ring = HashRing(['a', 'b', 'c'])
+        keys = ['key%d' % i for i in range(300)]
+        before = dict((key, ring.get(key)) for key in keys)
+        assert set(before.values()) == set(['a', 'b', 'c'])
+
+        ring.add('d')
+        after = dict((key, ring.get(key)) for key in keys)
+        moved = [key for key in keys if before[key] != after[key]]
+        assert all(after[key] == 'd' for key in moved)
+        assert len(moved) < 150
+
+        ring.remove('d')
+        assert dict((key, ring.get(key)) for key in keys) == before
+
+    def test_empty_hash_ring(self):
+        assert HashRing().get('key') == None
+
+
+class FakeDelivery(object):
+    """Collects the payloads posted to response URLs"""
+
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, payload):
+        self.posts.append((url, payload))
+        return 200
+
+
+class AsyncTests(BaseTestCase):
+    """Test cases for answering commands through response_url"""
+
+    def setUp(self):
+        super(AsyncTests, self).setUp()
+        self.delivery = FakeDelivery()
+        app.config['ASYNC_RESPONSES'] = True
+        app.config['RESPONSE_DELIVERY'] = self.delivery
+
+    def tearDown(self):
+        shutdown_dispatcher()
+        app.config['ASYNC_RESPONSES'] = False
+        app.config['RESPONSE_DELIVERY'] = None
+        super(AsyncTests, self).tearDown()
+
+    def post(self, data):
+        return self.client.post('/', data=dict(
+            data, response_url='https://hooks.slack.test/commands/1'))
+
+    def test_delayed_response(self):
+        response = self.post(ApiTests.michael_challenge)
+        assert response.status_code == 200
+        assert response.data == ''
+
+        get_dispatcher().join()
+        (url, payload) = self.delivery.posts[0]
+        assert url == 'https://hooks.slack.test/commands/1'
+        assert payload['response_type'] == 'in_channel'
+        assert payload['text'].startswith('michael has challenged victoria')
+
+    def test_delayed_error_response(self):
+        self.post(ApiTests.victoria_accept)
+        get_dispatcher().join()
+        (url, payload) = self.delivery.posts[0]
+        assert payload == {"response_type": "ephemeral",
+                           "text": NO_CHALLENGE_ERROR}
+
+    def test_failed_command(self):
+        def fail():
+            raise RuntimeError("database is down")
+
+        app.config['METRICS_ENABLED'] = True
+        registry.clear()
+        with app.test_request_context():
+            assert submit_command('https://hooks.slack.test/commands/1', fail,
+                                  'T2W2QQW5A', 'C2W35PTRV', 'status')
+        get_dispatcher().join()
+        assert self.delivery.posts == [
+            ('https://hooks.slack.test/commands/1',
+             {"response_type": "ephemeral", "text": COMMAND_FAILED_ERROR})]
+        assert registry.histogram('status.handler_ms').count == 1
+
+    def test_queued_command_takes_channel_lock(self):
+        ran = threading.Event()
+        with app.test_request_context():
+            with channel_lock('T2W2QQW5A', 'C2W35PTRV'):
+                assert submit_command('https://hooks.slack.test/commands/1',
+                                      lambda: ran.set() or 'done',
+                                      'T2W2QQW5A', 'C2W35PTRV', 'status')
+                assert not ran.wait(0.2)
+        get_dispatcher().join()
+        assert ran.is_set()
+        assert self.delivery.posts[0][1]['text'] == 'done'
+
+    def test_inline_commands(self):
+        response = self.post(ApiTests.invalid)
+        assert response.data == INVALID_COMMAND_ERROR
+        assert self.delivery.posts == []
+
+    def test_backpressure(self):
+        pool = WorkerPool(1, 1)
+        release = threading.Event()
+        assert pool.submit(release.wait)
+        while pool.depth() != 0:
+            pass
+        assert pool.submit(lambda: None)
+        assert not pool.submit(lambda: None)
+        release.set()
+        pool.shutdown()
+
+    def test_channel_dispatcher_order(self):
+        dispatcher = ChannelDispatcher(4, 100)
+        ran = []
+        for i in range(20):
+            channel_id = 'C%d' % (i % 3)
+            dispatcher.submit('T1', channel_id,
+                              lambda i=i, c=channel_id: ran.append((c, i)))
+        dispatcher.join()
+        dispatcher.shutdown()
+        for channel_id in ('C0', 'C1', 'C2'):
+            order = [i for (c, i) in ran if c == channel_id]
+            assert order == sorted(order)
+        assert len(ran) == 20
+        assert (dispatcher.lane('T1', 'C1') is
+                dispatcher.lane(u'T1', u'C1'))
+
+    def test_http_delivery(self):
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                received.append((self.path, json.loads(self.rfile.read(length))))
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        delivery = HttpDelivery()
+        url = 'http://127.0.0.1:%d/commands/1' % server.server_address[1]
+        assert delivery.post(url, {"text": "one"}) == 200
+        assert delivery.post(url, {"text": "two"}) == 200
+        assert len(delivery._idle.values()[0]) == 1
+        delivery.close()
+        server.shutdown()
+        server.server_close()
+        assert received == [('/commands/1', {"text": "one"}),
+                            ('/commands/1', {"text": "two"})]
+
+
+@needs_database
+class EventTests(BaseTestCase):
+    """Test cases for the move log"""
+
+    def test_log_and_snapshots(self):
+        (game, players, response) = play_game(
+            self.client, ['topleft', 'left', 'top', 'center'])
+        assert game.move_count == 4
+        assert [event.sequence for event in
+                game.events.order_by(MoveEvent.sequence)] == [1, 2, 3, 4]
+        snapshot = game.snapshots.one()
+        assert snapshot.sequence == 4
+        assert snapshot.x_mask == game.x_mask
+        assert snapshot.o_mask == game.o_mask
+
+    def test_load_state(self):
+        (game, players, response) = play_game(
+            self.client, ['topleft', 'left', 'top', 'center', 'topright'])
+        assert game.finished == True
+
+        state = load_state(game.id)
+        assert state.sequence == 5
+        assert state.finished == True
+        assert (state.x_mask, state.o_mask, state.dead_lines) == \
+            (game.x_mask, game.o_mask, game.dead_lines)
+        assert state.current_player_name == game.current_player_name
+
+        states = list(replay(game.id))
+        assert len(states) == 5
+        for sequence in range(1, 6):
+            state = load_state(game.id, sequence)
+            expected = states[sequence - 1]
+            assert state.sequence == sequence
+            assert state.__dict__ == expected.__dict__
+        assert states[0].current_player_name != states[1].current_player_name
+
+    def test_export_events(self):
+        (game, players, response) = play_game(
+            self.client, ['topleft', 'left', 'top'])
+        out = StringIO.StringIO()
+        last = export_events(out, batch_size=2)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert [line['sequence'] for line in lines] == [1, 2, 3]
+        assert lines[0]['game_id'] == game.id
+        assert (lines[1]['x'], lines[1]['y']) == (1, 0)
+        assert last == lines[-1]['id']
+
+        out = StringIO.StringIO()
+        assert export_events(out, after=last) == last
+        assert out.getvalue() == ''
+
+
+class BotTests(BaseTestCase):
+    """Test cases for playing against the bot"""
+
+    bot_challenge = dict(ApiTests.michael_challenge, text='challenge bot')
+
+    @needs_database
+    def test_challenge_bot(self):
+        response = self.client.post('/', data=self.bot_challenge)
+        game = Game.query.first()
+        assert game.player1.user_name == 'michael'
+        assert game.player2.user_id == BOT_USER_ID
+        assert game.current_player_name == 'michael'
+        assert Challenge.query.count() == 0
+
+        resp_text = json.loads(response.data)['text']
+        assert "michael has challenged the bot!" in resp_text
+        if game.pieces.count() == 1:
+            assert "bot has made a move" in resp_text
+        else:
+            assert game.pieces.count() == 0
+
+    def test_bot_never_loses(self):
+        bots = set()
+        for attempt in range(4):
+            self.client.post('/', data=self.bot_challenge)
+            game = current_game()
+            bots.add(game.player2.id)
+            while True:
+                if game.finished:
+                    break
+                square = [name for (name, (x, y)) in sorted(MOVES.items())
+                          if not game.is_taken(x, y)][0]
+                response = self.client.post('/', data=dict(
+                    ApiTests.michael_move, text=square))
+                db.session.expire_all()
+            resp_text = json.loads(response.data)['text']
+            assert "michael has won" not in resp_text
+        assert len(bots) == 1
+
+
+class SolverTests(unittest.TestCase):
+    """Test cases for the bot's search"""
+
+    def test_symmetries(self):
+        symmetries = Symmetries(3)
+        corner = cell_bit(0, 0, 3)
+        images = set(symmetries.apply(index, corner) for index in range(8))
+        assert images == set(cell_bit(x, y, 3)
+                             for (x, y) in [(0, 0), (0, 2), (2, 0), (2, 2)])
+        assert (symmetries.canonical(cell_bit(0, 0, 3), cell_bit(1, 1, 3)) ==
+                symmetries.canonical(cell_bit(2, 2, 3), cell_bit(1, 1, 3)))
+
+    def test_perfect_play(self):
+        solver = get_solver(3)
+        assert solver.perfect
+        assert solver.table[solver.symmetries.canonical(0, 0)] == 0
+        mine = cell_bit(0, 0, 3) | cell_bit(0, 1, 3)
+        theirs = cell_bit(1, 1, 3) | cell_bit(2, 2, 3)
+        assert solver.best_move(mine, theirs, 0) == (0, 2)
+        mine = cell_bit(1, 1, 3)
+        theirs = cell_bit(0, 0, 3) | cell_bit(0, 1, 3)
+        assert solver.best_move(mine, theirs, 0) == (0, 2)
+
+    def test_depth_limited_search(self):
+        solver = Solver(5, 4)
+        assert not solver.perfect
+        mine = sum(cell_bit(2, y, 5) for y in range(3))
+        theirs = cell_bit(0, 0, 5) | cell_bit(4, 4, 5) | cell_bit(0, 4, 5)
+        assert solver.best_move(mine, theirs, 0, 0.2) == (2, 3)
+
+        (x, y) = solver.best_move(0, 0, 0, 0.2)
+        assert 0 <= x < 5 and 0 <= y < 5
+        assert 0 < len(solver.table) <= BOT_TABLE_SIZE
+
+
+class OverviewTests(BaseTestCase):
+    """Test cases for reporting every active game of a team"""
+
+    def setUp(self):
+        super(OverviewTests, self).setUp()
+        team = Team('T2W2QQW5A')
+        for index in range(3):
+            channel = Channel('C%d' % index, team)
+            michael = Player('U2W2V2KL6', 'michael', channel)
+            victoria = Player('U2W2USDLG', 'victoria', channel)
+            game = Game(BOARD_SIZE, 'victoria', channel, michael, victoria)
+            db.session.add(game)
+            if index == 1:
+                game.finished = True
+            if index == 2:
+                db.session.add(Piece(1, 1, michael, game))
+                game.move_count = 1
+        db.session.add(Game(BOARD_SIZE, 'michael', Channel('C9', Team('T9')),
+                            None, None))
+        db.session.commit()
+
+    def test_active_games(self):
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(Engine, "before_cursor_execute", count)
+        try:
+            games = list(active_games('T2W2QQW5A'))
+        finally:
+            event.remove(Engine, "before_cursor_execute", count)
+
+        assert len(statements) == 1
+        assert [game['channel_id'] for game in games] == ['C0', 'C2']
+        assert games[1]['move_count'] == 1
+        assert games[1]['current_player'] == 'victoria'
+        assert games[1]['player1'] == 'michael'
+        assert games[1]['board'] == render_board(BOARD_SIZE,
+                                                 cell_bit(1, 1, BOARD_SIZE), 0)
+
+    def test_active_games_endpoint(self):
+        response = self.client.get('/teams/T2W2QQW5A/games?token=wrong')
+        assert response.status_code == 403
+
+        response = self.client.get('/teams/T2W2QQW5A/games?token=%s' %
+                                   os.environ['SLACK_TOKEN'])
+        assert response.mimetype == 'application/x-ndjson'
+        lines = response.data.splitlines()
+        assert [json.loads(line)['channel_id'] for line in lines] == \
+            ['C0', 'C2']
+
+
+@needs_database
+class TimerTests(BaseTestCase):
+    """Test cases for turn timers and forfeits"""
+
+    challenge = dict(ApiTests.michael_challenge,
+                     response_url='https://hooks/1')
+    accept = dict(ApiTests.victoria_accept, response_url='https://hooks/2')
+
+    def setUp(self):
+        super(TimerTests, self).setUp()
+        self.delivery = FakeDelivery()
+        app.config['TURN_TIMEOUT'] = 30
+        app.config['RESPONSE_DELIVERY'] = self.delivery
+
+    def tearDown(self):
+        shutdown_turn_timers()
+        app.config['TURN_TIMEOUT'] = 0
+        app.config['RESPONSE_DELIVERY'] = None
+        super(TimerTests, self).tearDown()
+
+    def test_heap(self):
+        now = [100]
+        timers = TurnTimers(None, timer=lambda: now[0])
+        timers.load([(1, 150), (2, 120)])
+        timers.arm(3, 110)
+        timers.arm(2, 200)
+        timers.cancel(1)
+        assert len(timers) == 2
+        assert timers.next_deadline() == 110
+
+        now[0] = 160
+        assert timers.pop_expired() == [3]
+        assert timers.next_deadline() == 200
+        now[0] = 200
+        assert timers.pop_expired() == [2]
+        assert timers.next_deadline() == None
+
+    def test_compaction(self):
+        timers = TurnTimers(None, timer=lambda: 0)
+        for deadline in range(1, 1000):
+            timers.arm(1, deadline)
+        timers.pop_expired()
+        assert len(timers._heap) < 100
+        assert timers.next_deadline() == 999
+
+    def test_thread(self):
+        expired = []
+        done = threading.Event()
+
+        def on_expired(game_id):
+            expired.append(game_id)
+            done.set()
+
+        timers = TurnTimers(on_expired)
+        timers.start()
+        timers.arm(7, time.time() + 0.05)
+        timers.arm(8, time.time() + 60)
+        assert done.wait(5)
+        timers.stop()
+        assert expired == [7]
+
+    def test_deadline_armed_on_move(self):
+        (game, players, response) = play_game(self.client, [],
+                                              self.challenge, self.accept)
+        assert game.turn_deadline >= time.time() + 29
+        assert game.response_url == 'https://hooks/2'
+        assert get_turn_timers().next_deadline() == game.turn_deadline
+
+        self.client.post('/', data=dict(players[0],
+                                        response_url='https://hooks/3'))
+        db.session.expire_all()
+        assert game.response_url == 'https://hooks/3'
+        assert get_turn_timers().next_deadline() == game.turn_deadline
+
+    def test_forfeit(self):
+        (game, players, response) = play_game(self.client, [],
+                                              self.challenge, self.accept)
+        loser = game.current_player_name
+        game.turn_deadline = int(time.time()) - 1
+        db.session.commit()
+
+        assert forfeit_expired(game.id)
+        db.session.expire_all()
+        assert game.finished == True
+        assert game.turn_deadline == None
+        assert game.current_player_name != loser
+        (url, payload) = self.delivery.posts[0]
+        assert url == 'https://hooks/2'
+        assert "{0} ran out of time".format(loser) in payload['text']
+        assert not forfeit_expired(game.id)
+        loser_record = PlayerRecord.query.filter_by(user_name=loser).first()
+        assert loser_record.losses == 1
+
+    def test_no_forfeit_after_move(self):
+        (game, players, response) = play_game(self.client, [],
+                                              self.challenge, self.accept)
+        deadline = game.turn_deadline
+        assert not forfeit_expired(game.id)
+        assert Game.query.get(game.id).finished == False
+        assert get_turn_timers().next_deadline() == deadline
+        assert self.delivery.posts == []
+
+
+@needs_database
+class HousekeepingTests(BaseTestCase):
+    """Test cases for expiring challenges and deleting unneeded rows"""
+
+    def setUp(self):
+        super(HousekeepingTests, self).setUp()
+        team = Team('T2W2QQW5A')
+        channel = Channel('C2W35PTRV', team)
+        self.michael = Player('U2W2V2KL6', 'michael', channel)
+        self.victoria = Player('U2W2USDLG', 'victoria', channel)
+        now = datetime.utcnow()
+        ages = [timedelta(days=30), timedelta(days=8), timedelta(hours=2),
+                timedelta(hours=2), timedelta(minutes=5)]
+        for (index, age) in enumerate(ages):
+            challenge = Challenge('victoria', channel, self.michael)
+            challenge.created_at = now - age
+            challenge.expired = index == 0
+            db.session.add(challenge)
+        self.games = []
+        for finished in (True, False, True):
+            game = Game(BOARD_SIZE, 'victoria', channel, self.michael,
+                        self.victoria)
+            db.session.add(Piece(0, 0, self.michael, game))
+            game.finished = finished
+            self.games.append(game)
+        db.session.commit()
+
+    def test_expire_challenges(self):
+        assert expire_challenges(batch_size=2) == 3
+        assert Challenge.query.filter_by(expired=False).count() == 1
+        assert expire_challenges() == 0
+
+    def test_delete_challenges(self):
+        expire_challenges()
+        assert delete_challenges(batch_size=1) == 2
+        assert Challenge.query.count() == 3
+
+    def test_archive_finished_games(self):
+        assert archive_finished_games(batch_size=1) == 2
+        assert Game.query.one().finished == False
+        assert Piece.query.count() == 1
+        games = ArchivedGame.query.order_by(ArchivedGame.id).all()
+        assert [game.game_id for game in games] == \
+            [self.games[0].id, self.games[2].id]
+        assert games[0].result == "forfeit"
+        assert games[0].winner_name == "victoria"
+        assert games[0].player1_user_id == 'U2W2V2KL6'
+        assert unpack_moves(games[0].moves, BOARD_SIZE) == [(0, 0)]
+        assert archive_finished_games() == 0
+
+    def test_sweep(self):
+        assert sweep() == {"challenges_expired": 3, "challenges_deleted": 2,
+                           "games_archived": 2}
+        assert registry.counters["housekeeping.games_archived"] >= 2
+
+    def test_accept_stale_challenge(self):
+        response = self.client.post('/', data=ApiTests.victoria_accept)
+        assert response.data != NO_CHALLENGE_ERROR
+        game = Game.query.order_by(Game.id.desc()).first()
+        game.finished = True
+        release_players([game.id])
+        db.session.commit()
+
+        challenge = Challenge('victoria', self.michael.channel, self.michael)
+        challenge.created_at = datetime.utcnow() - timedelta(hours=2)
+        db.session.add(challenge)
+        db.session.commit()
+        response = self.client.post('/', data=ApiTests.victoria_accept)
+        assert response.data == NO_CHALLENGE_ERROR
+
+
+@needs_database
+class ArchiveTests(BaseTestCase):
+    """Test cases for archiving finished games and reading their history"""
+
+    def test_pack_moves(self):
+        cells = [(0, 0), (2, 1), (1, 2)]
+        assert pack_moves(cells, 3) == "075"
+        assert unpack_moves(pack_moves(cells, 3), 3) == cells
+        assert len(pack_moves(cells, 5)) == 6
+        assert unpack_moves(pack_moves(cells, 5), 5) == cells
+        assert unpack_moves("", 3) == []
+
+    def test_archive_game(self):
+        (game, players, response) = play_game(self.client, WINNING_MOVES)
+        winner = players[0]['user_name']
+        assert sweep()["games_archived"] == 1
+        for model in (Game, Piece, MoveEvent, GameSnapshot):
+            assert model.query.count() == 0
+
+        games = history('T2W2QQW5A')
+        assert len(games) == 1
+        assert games[0]["result"] == "win"
+        assert games[0]["winner"] == winner
+        assert games[0]["move_count"] == 5
+        assert games[0]["moves"] == [(0, 0), (1, 0), (0, 1), (1, 1), (0, 2)]
+        assert games[0]["first_move_at"] <= games[0]["last_move_at"]
+
+        response = self.client.post('/', data=ApiTests.status)
+        assert response.data == NO_ACTIVE_GAME_ERROR
+        self.client.post('/', data=ApiTests.michael_challenge)
+        self.client.post('/', data=ApiTests.victoria_accept)
+        assert Game.query.count() == 1
+
+    def test_draw(self):
+        play_game(self.client, DRAWN_MOVES)
+        sweep()
+        (game,) = history('T2W2QQW5A')
+        assert game["result"] == "draw"
+        assert game["winner"] == None
+
+    def test_history_endpoint(self):
+        for index in range(5):
+            db.session.add(ArchivedGame(
+                team_id='T2W2QQW5A', channel_id='C%d' % (index % 2),
+                player1_user_id='U2W2V2KL6', player1_name='michael',
+                player2_user_id='U%d' % index, player2_name='p%d' % index,
+                board_size=BOARD_SIZE, moves=''))
+        db.session.add(ArchivedGame(team_id='T9', channel_id='C0',
+                                    board_size=BOARD_SIZE, moves=''))
+        db.session.commit()
+
+        assert [game["id"] for game in history('T2W2QQW5A', 'C0')] == \
+            [5, 3, 1]
+        assert [game["id"] for game in history('T2W2QQW5A', user_id='U1')] \
+            == [2]
+
+        response = self.client.get('/teams/T2W2QQW5A/history?token=wrong')
+        assert response.status_code == 403
+        url = '/teams/T2W2QQW5A/history?token=%s&limit=2' % \
+            os.environ['SLACK_TOKEN']
+        page = json.loads(self.client.get(url).data)
+        assert [game["id"] for game in page["games"]] == [5, 4]
+        page = json.loads(self.client.get(
+            url + '&before=%d' % page["next"]).data)
+        assert [game["id"] for game in page["games"]] == [3, 2]
+        page = json.loads(self.client.get(
+            url + '&before=%d' % page["next"]).data)
+        assert [game["id"] for game in page["games"]] == [1]
+        assert page["next"] == None
+
+
+class StatsTests(BaseTestCase):
+    """Test cases for player records and leaderboards"""
+
+    stats = dict(ApiTests.michael_move, text='stats')
+    leaderboard = dict(ApiTests.michael_move, text='leaderboard')
+
+    def records(self, channel_id=TEAM_SCOPE):
+        return dict((record.user_name, (record.wins, record.losses,
+                                        record.draws))
+                    for record in get_store().leaderboard(
+                        'T2W2QQW5A', channel_id))
+
+    def test_record_win_and_draw(self):
+        response = self.client.post('/', data=self.stats)
+        assert response.data == NO_RECORD_ERROR
+
+        (game, players, response) = play_game(self.client, WINNING_MOVES)
+        winner = players[0]['user_name']
+        loser = 'victoria' if winner == 'michael' else 'michael'
+        expected = {winner: (1, 0, 0), loser: (0, 1, 0)}
+        assert self.records('C2W35PTRV') == expected
+        assert self.records() == expected
+
+        play_game(self.client, DRAWN_MOVES)
+        assert self.records()[winner] == (1, 0, 1)
+        assert len(self.records('C2W35PTRV')) + len(self.records()) == 4
+
+        response = self.client.post('/', data=self.stats)
+        text = json.loads(response.data)['text']
+        assert text.startswith("michael has ")
+        assert text.count(" and 1 draw in this ") == 2
+
+    @needs_database
+    def test_leaderboard(self):
+        for (name, wins, losses) in [('a', 2, 5), ('b', 7, 1), ('c', 7, 0),
+                                     ('d', 0, 0)]:
+            db.session.add(PlayerRecord(team_id='T2W2QQW5A',
+                                        channel_id='C2W35PTRV', user_id=name,
+                                        user_name=name, wins=wins,
+                                        losses=losses, draws=0))
+        db.session.commit()
+        records = leaderboard('T2W2QQW5A', 'C2W35PTRV', 3)
+        assert [record.user_name for record in records] == ['c', 'b', 'a']
+
+        response = self.client.post('/', data=self.leaderboard)
+        lines = json.loads(response.data)['text'].split("\n")
+        assert lines[0] == "Leaderboard of this channel:"
+        assert lines[1] == "1. c with 7 wins, 0 losses and 0 draws"
+        assert len(lines) == 5
+        response = self.client.post('/', data=dict(self.leaderboard,
+                                                   text='leaderboard team'))
+        assert response.data == NO_LEADERBOARD_ERROR
+
+    def test_bot_has_no_record(self):
+        self.client.post('/', data=dict(ApiTests.michael_challenge,
+                                        text='challenge bot'))
+        game = current_game()
+        for move in MOVES:
+            self.client.post('/', data=dict(ApiTests.michael_move, text=move))
+        assert game.finished == True
+        assert self.records().keys() == ['michael']
+
+    @needs_database
+    def test_rebuild(self):
+        play_game(self.client, WINNING_MOVES)
+        sweep()
+        play_game(self.client, DRAWN_MOVES)
+        expected = self.records()
+        db.session.execute(PlayerRecord.__table__.delete())
+        db.session.commit()
+
+        assert rebuild_records(batch_size=1) == 2
+        assert self.records() == expected
+        assert self.records('C2W35PTRV') == expected
+
+
+class MemoryStoreTests(BaseTestCase):
+    """Test cases for playing games in the memory store"""
+
+    def setUp(self):
+        super(MemoryStoreTests, self).setUp()
+        self.store = app.config['GAME_STORE'] = MemoryStore()
+        self.statements = []
+        event.listen(Engine, "before_cursor_execute", self.count)
+
+    def tearDown(self):
+        event.remove(Engine, "before_cursor_execute", self.count)
+        assert self.statements == []
+        app.config['GAME_STORE'] = 'database'
+        super(MemoryStoreTests, self).tearDown()
+
+    def count(self, *args):
+        self.statements.append(args[2])
+
+    def game(self, user_id='U2W2V2KL6'):
+        return self.store.load('T2W2QQW5A', 'C2W35PTRV', user_id).game
+
+    def test_win(self):
+        (game, players, response) = play_game(self.client, WINNING_MOVES)
+        winner = players[0]['user_name']
+        resp_text = json.loads(response.data)['text']
+        assert "Game over! {0} has won".format(winner) in resp_text
+        assert self.game() == None
+        response = self.client.post('/', data=ApiTests.status)
+        assert response.data == NO_ACTIVE_GAME_ERROR
+
+        response = self.client.post('/', data=dict(ApiTests.michael_move,
+                                                    text='leaderboard'))
+        resp_text = json.loads(response.data)['text']
+        assert "1. {0} with 1 win, 0 losses".format(winner) in resp_text
+        response = self.client.post('/', data=dict(ApiTests.status,
+                                                    text='stats'))
+        resp_text = json.loads(response.data)['text']
+        assert "1 draw" not in resp_text
+        assert ("0 wins" if winner == 'michael' else "1 win") in resp_text
+
+    def test_draw(self):
+        play_game(self.client, DRAWN_MOVES)
+        assert self.game() == None
+        (channel_record, team_record) = self.store.player_stats(
+            'T2W2QQW5A', 'C2W35PTRV', 'U2W2V2KL6')
+        assert (team_record.wins, team_record.losses, team_record.draws) == \
+            (0, 0, 1)
+
+    def test_turns_and_squares(self):
+        self.client.post('/', data=ApiTests.michael_challenge)
+        self.client.post('/', data=ApiTests.victoria_accept)
+        game = self.game()
+        assert game.player1.user_name == 'michael'
+        assert game.player2.user_name == 'victoria'
+        (mover, waiter) = (ApiTests.michael_move, ApiTests.victoria_move)
+        if game.current_player_name == 'victoria':
+            (mover, waiter) = (waiter, mover)
+        assert self.client.post('/', data=waiter).data == INCORRECT_TURN_ERROR
+        self.client.post('/', data=mover)
+        assert self.client.post('/', data=waiter).data == SQUARE_TAKEN_ERROR
+        assert game.move_count == 1
+
+        response = self.client.post('/', data=ApiTests.michael_challenge)
+        assert response.data == ALREADY_PLAYING_ERROR
+        response = self.client.post('/', data=ApiTests.bob_challenge)
+        assert "bob has challenged alice" in response.data
+        response = self.client.post('/', data=ApiTests.alice_accept)
+        assert "alice has accepted" in json.loads(response.data)['text']
+        response = self.client.post('/', data=dict(ApiTests.bob_challenge,
+                                                    text='status'))
+        assert "It's" in json.loads(response.data)['text']
+        response = self.client.post('/', data=dict(ApiTests.status,
+                                                    user_id='U00000000'))
+        resp_text = json.loads(response.data)['text']
+        assert resp_text.count(" vs ") == 2
+
+    def test_accept(self):
+        response = self.client.post('/', data=ApiTests.victoria_accept)
+        assert response.data == NO_CHALLENGE_ERROR
+        self.client.post('/', data=ApiTests.michael_challenge)
+        response = self.client.post('/', data=dict(ApiTests.victoria_accept,
+                                                    text='accept bob'))
+        assert response.data == NO_CHALLENGE_ERROR
+        self.client.post('/', data=dict(ApiTests.bob_challenge,
+                                        text='challenge victoria'))
+        self.client.post('/', data=dict(ApiTests.bob_challenge,
+                                        text='challenge bot'))
+        response = self.client.post('/', data=dict(ApiTests.victoria_accept,
+                                                    text='accept bob'))
+        assert response.data == OPPONENT_BUSY_ERROR.format('bob')
+        self.client.post('/', data=dict(ApiTests.victoria_accept,
+                                        text='accept michael'))
+        assert self.game('U2W2USDLG').player1.user_name == 'michael'
+
+    def test_expire_challenges(self):
+        self.client.post('/', data=ApiTests.michael_challenge)
+        later = datetime.utcnow() + timedelta(
+            seconds=app.config['CHALLENGE_TTL'] + 1)
+        assert self.store.expire_challenges(later) == 1
+        assert self.store.expire_challenges(later) == 0
+        response = self.client.post('/', data=ApiTests.victoria_accept)
+        assert response.data == NO_CHALLENGE_ERROR
+
+    def test_bot_game(self):
+        self.client.post('/', data=BotTests.bot_challenge)
+        while True:
+            game = self.game()
+            if game == None:
+                break
+            square = [name for (name, (x, y)) in sorted(MOVES.items())
+                      if not game.is_taken(x, y)][0]
+            response = self.client.post('/', data=dict(
+                ApiTests.michael_move, text=square))
+        resp_text = json.loads(response.data)['text']
+        assert "michael has won" not in resp_text
+        assert self.store.leaderboard('T2W2QQW5A')[0].user_name == 'michael'
+
+    def test_incomplete_store(self):
+        class Incomplete(GameStore):
+            def load(self, team_id, channel_id, user_id=None):
+                return None
+
+        self.assertRaises(TypeError, Incomplete)
+
+
+class SqliteStoreTests(unittest.TestCase):
+    """Test cases for the SQLite store's connections"""
+
+    def test_write_ahead_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            engine = create_engine('sqlite:///' +
+                                   os.path.join(directory, 'ttt.db'))
+            SqliteStore(engine)
+            SqliteStore(engine)
+            connection = engine.connect()
+            assert connection.execute("PRAGMA journal_mode").scalar() == 'wal'
+            assert connection.execute("PRAGMA busy_timeout").scalar() == \
+                SQLITE_BUSY_TIMEOUT
+            connection.close()
+            engine.dispose()
+        finally:
+            shutil.rmtree(directory)
+
+
+class IdempotencyTests(BaseTestCase):
+    """Test cases for answering repeated deliveries of a command once"""
+
+    def setUp(self):
+        super(IdempotencyTests, self).setUp()
+        get_deduplicator().clear()
+
+    def test_repeated_move(self):
+        self.client.post('/', data=ApiTests.michael_challenge)
+        self.client.post('/', data=ApiTests.victoria_accept)
+        game = current_game()
+        move = (ApiTests.michael_move if game.current_player_name == 'michael'
+                else ApiTests.victoria_move)
+        move = dict(move, trigger_id='13345224609.738474920.8088930838d')
+        first = self.client.post('/', data=move)
+
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(Engine, "before_cursor_execute", count)
+        try:
+            second = self.client.post('/', data=move)
+        finally:
+            event.remove(Engine, "before_cursor_execute", count)
+
+        assert statements == []
+        assert second.data == first.data
+        assert second.mimetype == 'application/json'
+        assert "has made a move" in json.loads(second.data)['text']
+        assert game.move_count == 1
+        response = self.client.post('/', data=dict(move, trigger_id='2'))
+        assert response.data == INCORRECT_TURN_ERROR
+
+    def test_fingerprint(self):
+        form = dict(ApiTests.status, trigger_id='1')
+        assert command_fingerprint(ApiTests.status, {}) == None
+        assert command_fingerprint(form, {}) == \
+            command_fingerprint(form, {'X-Slack-Retry-Num': '1'})
+        assert command_fingerprint(form, {}) != \
+            command_fingerprint(dict(form, text='stats'), {})
+        assert command_fingerprint(ApiTests.status,
+                                   {'X-Slack-Request-Timestamp': '1'}) != None
+
+    def test_coalesce_in_flight(self):
+        deduplicator = Deduplicator(10, 60)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'done'
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(deduplicator.run('key', slow)))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(
+            target=lambda: results.append(deduplicator.run('key', slow)))
+        follower.start()
+        while registry.counters.get("idempotency.coalesced", 0) == 0:
+            time.sleep(0.01)
+        release.set()
+        leader.join()
+        follower.join()
+        assert results == ['done', 'done']
+        assert calls == [1]
+        assert deduplicator.run('key', slow) == 'done'
+        assert calls == [1]
+
+    def test_failures_are_not_remembered(self):
+        deduplicator = Deduplicator(10, 60)
+
+        def fail():
+            raise ValueError()
+
+        self.assertRaises(ValueError, deduplicator.run, 'key', fail)
+        assert deduplicator.run('key', lambda: BUSY_ERROR,
+                                lambda response: response != BUSY_ERROR) == \
+            BUSY_ERROR
+        assert deduplicator.run('key', lambda: 'done') == 'done'
+        assert len(deduplicator) == 0
+
+
+class RateLimitTests(BaseTestCase):
+    """Test cases for turning away commands over their rate limits"""
+
+    def setUp(self):
+        super(RateLimitTests, self).setUp()
+        self.now = [1000.0]
+        app.config['RATE_LIMITS_ENABLED'] = True
+        app.config['RATE_LIMITS'] = {
+            'status': {'user': (60, 2), 'team': (60, 3)},
+            'default': {'user': (60, 1)}
+        }
+        app.config['RATE_LIMIT_BACKEND'] = TokenBuckets(
+            timer=lambda: self.now[0])
+        registry.clear()
+
+    def tearDown(self):
+        app.config['RATE_LIMITS_ENABLED'] = False
+        app.config['RATE_LIMIT_BACKEND'] = None
+        super(RateLimitTests, self).tearDown()
+
+    def test_user_limit(self):
+        for i in range(2):
+            response = self.client.post('/', data=ApiTests.status)
+            assert response.data == NO_ACTIVE_GAME_ERROR
+
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(Engine, "before_cursor_execute", count)
+        try:
+            response = self.client.post('/', data=ApiTests.status)
+        finally:
+            event.remove(Engine, "before_cursor_execute", count)
+        assert response.data == RATE_LIMITED_ERROR
+        assert statements == []
+        assert registry.counters["ratelimit.rejected"] == 1
+        assert registry.counters["ratelimit.rejected.user.status"] == 1
+
+        # Other command types have buckets of their own.
+        response = self.client.post('/', data=dict(ApiTests.status,
+                                                    text='stats'))
+        assert response.data == NO_RECORD_ERROR
+
+        self.now[0] += 1
+        response = self.client.post('/', data=ApiTests.status)
+        assert response.data == NO_ACTIVE_GAME_ERROR
+
+    def test_team_limit(self):
+        for user_id in ('U1', 'U2', 'U3'):
+            response = self.client.post('/', data=dict(ApiTests.status,
+                                                       user_id=user_id))
+            assert response.data == NO_ACTIVE_GAME_ERROR
+        response = self.client.post('/', data=dict(ApiTests.status,
+                                                   user_id='U4'))
+        assert response.data == RATE_LIMITED_ERROR
+        assert registry.counters["ratelimit.rejected.team.status"] == 1
+        response = self.client.post('/', data=dict(ApiTests.status,
+                                                   team_id='T2'))
+        assert response.data == NO_ACTIVE_GAME_ERROR
+
+    def test_team_limit_keeps_user_tokens(self):
+        app.config['RATE_LIMITS']['status'] = {'user': (60, 1),
+                                               'team': (120, 1)}
+        response = self.client.post('/', data=dict(ApiTests.status,
+                                                   user_id='U1'))
+        assert response.data == NO_ACTIVE_GAME_ERROR
+        response = self.client.post('/', data=ApiTests.status)
+        assert response.data == RATE_LIMITED_ERROR
+        assert registry.counters["ratelimit.rejected.team.status"] == 1
+
+        # The team's bucket has refilled, the user's would not have.
+        self.now[0] += 0.5
+        response = self.client.post('/', data=ApiTests.status)
+        assert response.data == NO_ACTIVE_GAME_ERROR
+
+    def test_rejection_is_not_replayed(self):
+        get_deduplicator().clear()
+        form = dict(ApiTests.status, text='nonsense', trigger_id='1')
+        assert self.client.post('/', data=form).data == INVALID_COMMAND_ERROR
+        form = dict(form, trigger_id='2')
+        assert self.client.post('/', data=form).data == RATE_LIMITED_ERROR
+        self.now[0] += 1
+        assert self.client.post('/', data=form).data == INVALID_COMMAND_ERROR
+
+    def test_shared_buckets(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'buckets')
+            timer = lambda: self.now[0]
+            first = SharedTokenBuckets(path, slots=16, timer=timer)
+            second = SharedTokenBuckets(path, slots=16, timer=timer)
+            assert first.take(u'a', 1, 2)
+            assert second.take(u'a', 1, 2)
+            assert not first.take(u'a', 1, 2)
+            assert second.take(u'b', 1, 2)
+            self.now[0] += 0.5
+            assert not second.take(u'a', 1, 2)
+            self.now[0] += 0.5
+            assert first.take(u'a', 1, 2)
+            first.give_back(u'a', 2)
+            assert second.take(u'a', 1, 2)
+            assert not second.take(u'a', 1, 2)
+            first.close()
+            second.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+@needs_database
+class WriteBehindTests(BaseTestCase):
+    """Test cases for buffering moves and flushing them in batches"""
+
+    def setUp(self):
+        super(WriteBehindTests, self).setUp()
+        self.journal_dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.journal_dir, 'moves.journal')
+        app.config['WRITE_BEHIND'] = True
+        app.config['WRITE_BEHIND_JOURNAL'] = self.prefix
+        app.config['WRITE_BEHIND_INTERVAL'] = 3600
+        app.config['WRITE_BEHIND_BATCH'] = 100
+
+    def tearDown(self):
+        shutdown_write_behind()
+        app.config['WRITE_BEHIND'] = False
+        shutil.rmtree(self.journal_dir)
+        super(WriteBehindTests, self).tearDown()
+
+    def test_move_is_buffered(self):
+        (game, (first_move, second_move), response) = play_game(
+            self.client, [])
+        response = self.client.post('/', data=first_move)
+        assert "has made a move" in json.loads(response.data)['text']
+        assert Piece.query.count() == 0
+        assert get_write_behind().pending() == 1
+
+        response = self.client.post('/', data=second_move)
+        assert response.data == SQUARE_TAKEN_ERROR
+        response = self.client.post('/', data=ApiTests.status)
+        text = json.loads(response.data)['text']
+        assert " X " in text or " O " in text
+        assert list(active_games('T2W2QQW5A'))[0]['move_count'] == 1
+
+        version = game.version
+        assert get_write_behind().flush() == 1
+        assert get_write_behind().pending() == 0
+        db.session.expire_all()
+        game = Game.query.first()
+        assert game.pieces.count() == 1
+        assert game.is_taken(1, 0)
+        assert game.version == version + 1
+        assert game.move_count == 1
+        assert game.events.one().sequence == 1
+
+    def test_changed_game_is_not_overwritten(self):
+        (game, (first_move, second_move), response) = play_game(
+            self.client, [])
+        self.client.post('/', data=first_move)
+        table = Game.__table__
+        db.session.execute(table.update().values(
+            version=table.c.version + 1, current_player_name='nobody'))
+        db.session.commit()
+
+        assert get_write_behind().flush() == 1
+        db.session.expire_all()
+        game = Game.query.first()
+        assert game.pieces.count() == 0
+        assert game.move_count == 0
+        assert game.current_player_name == 'nobody'
+
+    def test_game_loaded_before_flush(self):
+        (game, (first_move, second_move), response) = play_game(
+            self.client, [])
+        self.client.post('/', data=first_move)
+        buffer = get_write_behind()
+        stale = Game.query.first()
+        player = stale.player1
+        version = stale.version
+        db.session.expunge(stale)
+        assert buffer.flush() == 1
+
+        stale.move_count = 2
+        buffer.record_move(stale, player, 2, 2)
+        assert buffer.flush() == 1
+        db.session.expire_all()
+        game = Game.query.first()
+        assert game.version == version + 2
+        assert game.pieces.count() == 2
+
+    def test_finished_game_is_counted(self):
+        play_game(self.client, WINNING_MOVES)
+        assert PlayerRecord.query.count() == 0
+        assert get_write_behind().flush() == 5
+        assert Game.query.one().finished == True
+        assert sorted((record.wins, record.losses) for record in
+                      PlayerRecord.query) == [(0, 1), (0, 1), (1, 0), (1, 0)]
+
+    def test_recover(self):
+        (game, (first_move, second_move), response) = play_game(
+            self.client, [])
+        self.client.post('/', data=first_move)
+        buffer = get_write_behind()
+        buffer.close()
+
+        # A journal whose process has died is flushed by the next process.
+        dead_path = self.prefix + '.999999999'
+        os.rename(buffer.journal_path, dead_path)
+        open(buffer.journal_path, 'w').close()
+        assert recover(self.prefix) == 1
+        assert recover(self.prefix) == 0
+        assert not os.path.exists(dead_path)
+        db.session.expire_all()
+        assert Piece.query.count() == 1
+        assert Game.query.first().is_taken(1, 0)
+
+    def test_several_workers_are_refused(self):
+        os.environ['WEB_CONCURRENCY'] = '4'
+        try:
+            self.assertRaises(RuntimeError, get_write_behind)
+        finally:
+            del os.environ['WEB_CONCURRENCY']
+
+
+@needs_database
+class ShardTests(BaseTestCase):
+    """Test cases for routing teams to shards and moving them between"""
+
+    other_challenge = dict(
+        ApiTests.bob_challenge,
+        team_id='T2W2OTHER',
+        channel_id='C2W2OTHER'
+    )
+
+    def setUp(self):
+        super(ShardTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        binds = dict((name, 'sqlite:///' +
+                      os.path.join(self.directory, name + '.db'))
+                     for name in ('east', 'west'))
+        app.config['SHARDS'] = binds
+        app.config['SQLALCHEMY_BINDS'] = binds
+        for name in binds:
+            db.Model.metadata.create_all(shard_engine(name))
+        directory_cache.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        for name in ('east', 'west'):
+            shard_engine(name).dispose()
+        directory_cache.clear()
+        super(ShardTests, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def place(self, team_id, shard, moving=False):
+        db.engine.execute(TeamShard.__table__.insert(), team_id=team_id,
+                          shard=shard, moving=moving)
+
+    def count(self, shard, table):
+        return shard_engine(shard).execute(
+            "SELECT count(*) FROM " + table).scalar()
+
+    def test_routing(self):
+        self.place('T2W2QQW5A', 'east')
+        (game, (first_move, second_move), response) = play_game(
+            self.client, [])
+        assert self.count('east', 'game') == 1
+        assert self.count(DEFAULT_SHARD, 'game') == 0
+        assert self.count(DEFAULT_SHARD, 'team') == 0
+
+        self.client.post('/', data=self.other_challenge)
+        (shard, moving) = locate_team('T2W2OTHER')
+        assert shard == HashRing(['default', 'east', 'west']).get('T2W2OTHER')
+        assert self.count(shard, 'challenge') == 1 + (shard == 'east')
+
+    def test_existing_team_stays_on_default(self):
+        db.session.add(Team('T2W2QQW5A'))
+        db.session.commit()
+        assert locate_team('T2W2QQW5A') == (DEFAULT_SHARD, False)
+        assert bind_team('T2W2QQW5A')
+        assert db.session.bind is db.engine
+
+    def test_move_team(self):
+        self.place('T2W2QQW5A', 'east')
+        self.place('T2W2OTHER', 'west')
+        self.client.post('/', data=self.other_challenge)
+        (game, (first_move, second_move), response) = play_game(
+            self.client, [])
+        self.client.post('/', data=first_move)
+        bind_shard(DEFAULT_SHARD)
+
+        moved = move_team('T2W2QQW5A', 'west', batch_size=2, wait=0)
+        assert moved['game'] == 1
+        assert moved['player'] == 2
+        assert moved['piece'] == 1
+        assert locate_team('T2W2QQW5A') == ('west', False)
+        assert self.count('east', 'game') == 0
+        assert self.count('east', 'player') == 0
+        assert self.count('west', 'channel') == 2
+
+        response = self.client.post('/', data=dict(second_move, text='top'))
+        assert "has made a move" in json.loads(response.data)['text']
+        game = Game.query.one()
+        assert game.move_count == 2
+        assert set([game.player1.user_name, game.player2.user_name]) == \
+            set(['michael', 'victoria'])
+        assert Challenge.query.filter_by(opponent_name='alice').count() == 1
+
+    def test_failed_move(self):
+        self.place('T2W2QQW5A', 'east')
+        play_game(self.client, [])
+        bind_shard(DEFAULT_SHARD)
+
+        copy_rows = shards._copy_rows
+
+        def fail(source, target, table, *args):
+            copied = copy_rows(source, target, table, *args)
+            if table.name == 'game_archive':
+                raise RuntimeError("copy failed")
+            return copied
+
+        shards._copy_rows = fail
+        try:
+            self.assertRaises(RuntimeError, move_team, 'T2W2QQW5A', 'west',
+                              wait=0)
+        finally:
+            shards._copy_rows = copy_rows
+        assert locate_team('T2W2QQW5A') == ('east', False)
+        assert self.count('west', 'game') == 0
+        assert self.count('east', 'game') == 1
+
+    def test_move_alongside_inserts(self):
+        self.place('T2W2QQW5A', 'east')
+        self.place('T2W2OTHER', 'west')
+        self.client.post('/', data=self.other_challenge)
+        self.client.post('/', data=dict(ApiTests.alice_accept,
+                                        team_id='T2W2OTHER',
+                                        channel_id='C2W2OTHER'))
+        play_game(self.client, WINNING_MOVES)
+        play_game(self.client, DRAWN_MOVES)
+        bind_shard(DEFAULT_SHARD)
+        west = shard_engine('west')
+        games = Game.__table__
+        row = dict(west.execute(games.select()).first())
+        del row['id']
+        inserted = []
+        copy_rows = shards._copy_rows
+
+        class Interleaved(object):
+            """Adds another team's game before the second batch is read."""
+
+            def __init__(self, engine):
+                self.engine = engine
+                self.batches = 0
+
+            def execute(self, *args):
+                self.batches += 1
+                if self.batches == 2:
+                    inserted.append(west.execute(games.insert(), row)
+                                    .inserted_primary_key[0])
+                return self.engine.execute(*args)
+
+        def interleave(source, target, table, *args):
+            if table.name == 'game':
+                source = Interleaved(source)
+            return copy_rows(source, target, table, *args)
+
+        shards._copy_rows = interleave
+        try:
+            moved = move_team('T2W2QQW5A', 'west', batch_size=1, wait=0)
+        finally:
+            shards._copy_rows = copy_rows
+        assert moved['game'] == 2
+        assert len(inserted) == 1
+        ids = [id for (id,) in west.execute(select([games.c.id]))]
+        assert len(ids) == 4
+        assert inserted[0] == max(ids)
+
+    def test_stats_on_shard(self):
+        self.place('T2W2QQW5A', 'east')
+        (game, players, response) = play_game(self.client, WINNING_MOVES)
+        winner = players[0]['user_name']
+        bind_shard(DEFAULT_SHARD)
+        assert self.count('east', 'player_record') == 4
+        assert self.count(DEFAULT_SHARD, 'player_record') == 0
+
+        response = self.client.post('/', data=StatsTests.stats)
+        assert json.loads(response.data)['text'].startswith("michael has ")
+        bind_shard(DEFAULT_SHARD)
+        response = self.client.post('/', data=StatsTests.leaderboard)
+        lines = json.loads(response.data)['text'].split("\n")
+        assert lines[1] == "1. {0} with 1 win, 0 losses and 0 draws" \
+            .format(winner)
+
+    def test_moving_team_is_refused(self):
+        self.place('T2W2QQW5A', 'east', moving=True)
+        response = self.client.post('/', data=ApiTests.michael_challenge)
+        assert response.data == TEAM_MOVING_ERROR
+        for command in (StatsTests.stats, StatsTests.leaderboard):
+            response = self.client.post('/', data=command)
+            assert response.data == TEAM_MOVING_ERROR
+        response = self.client.get('/teams/T2W2QQW5A/games?token=%s' %
+                                   os.environ['SLACK_TOKEN'])
+        assert response.status_code == 503
+        assert self.count('east', 'team') == 0
+
+    def test_sweep_every_shard(self):
+        for (team_id, shard) in (('T2W2QQW5A', 'east'), ('T2W2OTHER', 'west'),
+                                 ('T2W2THIRD', DEFAULT_SHARD)):
+            bind_shard(shard)
+            channel = Channel('C2W35PTRV', Team(team_id))
+            michael = Player('U2W2V2KL6', 'michael', channel)
+            victoria = Player('U2W2USDLG', 'victoria', channel)
+            game = Game(BOARD_SIZE, 'victoria', channel, michael, victoria)
+            game.finished = True
+            db.session.add(game)
+            db.session.commit()
+
+        assert sweep()["games_archived"] == 3
+        assert db.session.bind is db.engine
+        for shard in ('east', 'west', DEFAULT_SHARD):
+            assert self.count(shard, 'game') == 0
+            assert self.count(shard, 'game_archive') == 1
+
 
 if __name__ == '__main__':
     unittest.main()